@@ -1,18 +1,52 @@
 #!/usr/bin/python3
 
-import json
+import serving  # first: picks the async mode and monkey-patches for it
+import os
 import time
 import random
-import threading
-from datetime import datetime
 from flask import Flask, jsonify, request
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
+from scheduler import TickScheduler
+from snapshot import SnapshotStore
+import rooms
+import history
+import wire
+import wirecache
+import sendqueue
+import simclock
+import metrics
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all domains
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", json=wirecache.SocketJSON, **serving.socketio_options())
+
+# Every client's outbound queue, bounded by holding back clients that lag (see sendqueue.py)
+send_queues = sendqueue.SendQueues(socketio)
+
+# Prometheus metrics, served at /metrics (see metrics.py)
+server_metrics = metrics.ServerMetrics(lambda: len(subscriptions.clients), send_queues)
+server_metrics.instrument(app)
+
+# Seconds between sensor updates
+UPDATE_INTERVAL = .01
+
+# Simulated time, from the DUMMYAPI_SIM_* environment variables (see simclock.py)
+clock = simclock.SimClock(**simclock.env_options())
+
+# Source of the sensor fluctuations; DUMMYAPI_SEED makes runs repeatable
+rng = random.Random(os.environ.get('DUMMYAPI_SEED'))
+
+# The one timer loop that runs the sensor updates
+scheduler = TickScheduler(on_overrun=server_metrics.on_overrun, clock=clock)
+
+# What each connected Socket.IO client subscribed to
+subscriptions = rooms.SubscriptionRegistry()
+
+# Recent sensor values, about a minute of them at the update interval
+HISTORY_SIZE = 6000
+history_store = history.HistoryStore({"sensors": HISTORY_SIZE})
 
 # Sample data structure - we'll simulate IoT sensor data
 sensors = {
@@ -24,7 +58,7 @@ sensors = {
             "unit": "celsius",
             "value": 22.5,
             "status": "online",
-            "last_updated": datetime.now().isoformat()
+            "last_updated": clock.stamp()
         },
         {
             "id": "hum-001",
@@ -33,7 +67,7 @@ sensors = {
             "unit": "percent",
             "value": 45.2,
             "status": "online",
-            "last_updated": datetime.now().isoformat()
+            "last_updated": clock.stamp()
         },
         {
             "id": "pres-001",
@@ -42,81 +76,215 @@ sensors = {
             "unit": "hPa",
             "value": 1013.25,
             "status": "online",
-            "last_updated": datetime.now().isoformat()
+            "last_updated": clock.stamp()
         }
     ]
 }
 
-# Function to update sensor data randomly
-def update_sensor_data():
+# Immutable snapshots of the sensors, with their lookup indexes by id and type
+# (see snapshot.py). The update job changes the sensors above in place; REST
+# handlers and socket emitters read snapshots.current instead.
+snapshots = SnapshotStore({"sensors": {"items": sensors["sensors"]}})
+
+# Function to update sensor data randomly, stamping them with the tick's timestamp.
+# Returns the changed fields (collection -> sensor id -> field -> value).
+def update_sensor_data(timestamp):
+    changes = {}
     for sensor in sensors["sensors"]:
         # Generate random fluctuation based on sensor type
         if sensor["type"] == "temperature":
-            fluctuation = random.uniform(-0.5, 0.5)
+            fluctuation = rng.uniform(-0.5, 0.5)
             if 15 <= sensor["value"] + fluctuation <= 30:
                 sensor["value"] = round(sensor["value"] + fluctuation, 2)
         elif sensor["type"] == "humidity":
-            fluctuation = random.uniform(-1.0, 1.0)
+            fluctuation = rng.uniform(-1.0, 1.0)
             if 30 <= sensor["value"] + fluctuation <= 70:
                 sensor["value"] = round(sensor["value"] + fluctuation, 2)
         elif sensor["type"] == "pressure":
-            fluctuation = random.uniform(-0.25, 0.25)
+            fluctuation = rng.uniform(-0.25, 0.25)
             if 990 <= sensor["value"] + fluctuation <= 1030:
                 sensor["value"] = round(sensor["value"] + fluctuation, 2)
         
         # Update timestamp
-        sensor["last_updated"] = datetime.now().isoformat()
+        sensor["last_updated"] = timestamp
+        changes[sensor["id"]] = {"value": sensor["value"], "last_updated": timestamp}
     
-    return sensors
+    return {"sensors": changes}
+
+def sensors_payload(snapshot):
+    """The sensors of a snapshot, as they are sent"""
+    return {"sensors": snapshot.data["sensors"]["items"]}
 
-# Background task for periodic updates
+def group_payload(group, snapshot):
+    """The sensors of a snapshot a subscription group asked for, or None if there are none"""
+    if group.everything:
+        return sensors_payload(snapshot)
+    positions = snapshot.positions["sensors"]
+    items = snapshot.data["sensors"]["items"]
+    sensor_type = lambda collection, sensor_id: items[positions[sensor_id]]["type"]
+    selected = group.slice({"sensors": positions}, sensor_type).get("sensors")
+    if not selected:
+        return None
+    return {"sensors": [items[index] for index in sorted(selected.values())]}
+
+def catch_up(sid):
+    """Send a client that stopped lagging the current values of its sensors"""
+    group = subscriptions.group_of(sid)
+    payload = group_payload(group, snapshots.current) if group is not None else None
+    if payload is not None:
+        raw = server_metrics.encode("sensor_update", wire.encoder(group.fmt), payload)
+        socketio.emit('sensor_update', wire.socket_payload(raw), to=sid)
+        server_metrics.emitted("sensor_update", raw)
+
+# Periodic update job
 def background_update():
-    while True:
-        updated_data = update_sensor_data()
-        socketio.emit('sensor_update', updated_data)
-        time.sleep(.01)  # Update every 5 seconds
+    start = time.perf_counter()
+    now, timestamp = clock.tick()
+    changes = update_sensor_data(timestamp)
+    # Only this job changes the sensors, so publishing needs no lock
+    snapshot = snapshots.apply({"seq": snapshots.current.seq + 1, "changes": changes})
+    server_metrics.update_seconds.observe(("sensors",), time.perf_counter() - start)
+    history_store.record(now, {"sensors": {sensor_id: {"value": fields["value"]}
+                                           for sensor_id, fields in changes["sensors"].items()}})
+    
+    # Every message carries whole sensors, so clients that lag (see
+    # sendqueue.py) just skip ticks and get the newest values once they drained
+    start = time.perf_counter()
+    skip = send_queues.skip
+    held = {}
+    for sid, backlog in send_queues.backlogs():
+        held.setdefault(subscriptions.group_of(sid), []).append(backlog)
+    
+    # One message per subscription group, with only the sensors it asked for
+    for group in subscriptions.groups():
+        payload = group_payload(group, snapshot)
+        if payload is None:
+            continue
+        raw = server_metrics.encode("sensor_update", wire.encoder(group.fmt), payload)
+        socketio.emit('sensor_update', wire.socket_payload(raw), to=group.room, skip_sid=skip)
+        backlogs = held.get(group, ())
+        for backlog in backlogs:
+            backlog.skip()
+        server_metrics.emitted("sensor_update", raw, group.members - len(backlogs))
+    
+    for sid, backlog in send_queues.check(subscriptions.sids):
+        catch_up(sid)
+    server_metrics.emit_seconds.observe(("sensor_update",), time.perf_counter() - start)
+
+scheduler.add_job('sensors', UPDATE_INTERVAL, background_update)
+
+def encoded_response(payload):
+    """Send a payload in the wire format the request asked for"""
+    fmt = wire.negotiate(request)
+    return wire.response(server_metrics.encode("response", wire.encoder(fmt), payload), fmt)
 
 # REST API Routes
 @app.route('/api/sensors', methods=['GET'])
 def get_all_sensors():
-    return jsonify(sensors)
+    return encoded_response(sensors_payload(snapshots.current))
 
 @app.route('/api/sensors/<sensor_id>', methods=['GET'])
 def get_sensor(sensor_id):
-    for sensor in sensors["sensors"]:
-        if sensor["id"] == sensor_id:
-            return jsonify(sensor)
+    snapshot = snapshots.current
+    index = snapshot.positions["sensors"].get(sensor_id)
+    if index is not None:
+        return encoded_response(snapshot.data["sensors"]["items"][index])
     return jsonify({"error": "Sensor not found"}), 404
 
+@app.route('/api/sensors/<sensor_id>/history', methods=['GET'])
+def get_sensor_history(sensor_id):
+    """Get the recent values of a sensor, downsampled (see history.py)"""
+    if sensor_id not in snapshots.current.positions["sensors"]:
+        return jsonify({"error": "Sensor not found"}), 404
+    try:
+        query = history.HistoryQuery(request.args)
+    except history.HistoryError as e:
+        return jsonify({"error": str(e)}), 400
+    result = query.run(history_store, "sensors", sensor_id)
+    if result is None:
+        return jsonify({"error": "No history for this sensor yet"}), 404
+    return encoded_response(dict(result, id=sensor_id))
+
 @app.route('/api/sensors/type/<sensor_type>', methods=['GET'])
 def get_sensors_by_type(sensor_type):
-    matching_sensors = [sensor for sensor in sensors["sensors"] if sensor["type"] == sensor_type]
-    if matching_sensors:
-        return jsonify({"sensors": matching_sensors})
+    snapshot = snapshots.current
+    positions = snapshot.by_type["sensors"].get(sensor_type)
+    if positions:
+        items = snapshot.data["sensors"]["items"]
+        return encoded_response({"sensors": [items[index] for index in positions]})
     return jsonify({"error": f"No sensors of type {sensor_type} found"}), 404
 
 # Socket.IO events
 @socketio.on('connect')
 def handle_connect():
     print('Client connected')
-    emit('sensor_update', sensors)  # Send initial data on connect
+    # Everyone starts out subscribed to every sensor
+    old_group, group = subscriptions.set(request.sid, [(rooms.ALL,)], wire.socket_format(request))
+    join_room(group.room)
+    server_metrics.connections.inc()
+    raw = wire.encoder(group.fmt)(sensors_payload(snapshots.current))
+    emit('sensor_update', wire.socket_payload(raw))  # Send initial data on connect
+    server_metrics.emitted("sensor_update", raw)
 
 @socketio.on('disconnect')
 def handle_disconnect():
     print('Client disconnected')
+    subscriptions.remove(request.sid)
+    send_queues.remove(request.sid)
+
+def sensor_subscription(data):
+    """Turn a subscribe/unsubscribe payload ({id} or {type}) into a subscription, or None if it is invalid"""
+    if isinstance(data, dict) and 'collection' not in data and (data.get('id') is not None or data.get('type') is not None):
+        data = dict(data, collection='sensors')
+    return rooms.subscription_key(data)
+
+def change_subscription(old_group, group):
+    """Move the current client to its new subscription group"""
+    if old_group is group:
+        return
+    if old_group is not None:
+        leave_room(old_group.room)
+    join_room(group.room)
+
+@socketio.on('subscribe')
+def handle_subscribe(data=None):
+    """Only receive updates for one sensor ({id}) or one type of sensor ({type})"""
+    key = sensor_subscription(data)
+    if key is None:
+        emit('error', {'error': 'Invalid subscription'})
+        return
+    change_subscription(*subscriptions.subscribe(request.sid, key))
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data=None):
+    """Stop receiving updates for a subscription"""
+    key = sensor_subscription(data)
+    if key is None:
+        emit('error', {'error': 'Invalid subscription'})
+        return
+    change_subscription(*subscriptions.unsubscribe(request.sid, key))
 
 # Start the background task when the server starts
 @socketio.on('start_background')
 def start_background_task():
-    thread = threading.Thread(target=background_update)
-    thread.daemon = True
-    thread.start()
+    # Every dashboard asks for this, but there is only ever one scheduler
+    scheduler.start()
+
+@app.route('/_admin/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    return jsonify({'jobs': scheduler.stats()})
+
+@app.route('/_admin/clients', methods=['GET'])
+def get_client_queues():
+    return jsonify(send_queues.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return server_metrics.response()
 
 if __name__ == '__main__':
-    # Start the background update task
-    thread = threading.Thread(target=background_update)
-    thread.daemon = True
-    thread.start()
+    # Start the background updates
+    scheduler.start()
     
-    # Run the Flask app with SocketIO
-    socketio.run(app, host='0.0.0.0', port=5000, debug=True)
+    # Run the Flask app with SocketIO (see serving.py for the async modes)
+    serving.run(socketio, app, port=5000)
@@ -1,125 +1,33 @@
 #!/usr/bin/python
 
-import json
-import time
-import random
-import threading
-import copy
-from datetime import datetime
+import serving  # first: picks the async mode and monkey-patches for it
 from flask import Flask, jsonify, request, send_from_directory
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO
 from flask_cors import CORS
-import os
+import wirecache
+from query import Query, QueryError
+import history
+import sendqueue
+import metrics
+from simulation import Simulation
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all domains
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", json=wirecache.SocketJSON, **serving.socketio_options())
 
-# Path to the data configuration file
-CONFIG_FILE = 'data_config.json'
+# Every client's outbound queue, bounded by holding back clients that lag (see sendqueue.py)
+send_queues = sendqueue.SendQueues(socketio)
 
-# Global data store
-data_store = {}
-config = {}
+# Prometheus metrics, served at /metrics (see metrics.py)
+server_metrics = metrics.ServerMetrics(lambda: len(sim.subscriptions.clients), send_queues)
+server_metrics.instrument(app)
 
-def load_config():
-    """Load configuration from JSON file"""
-    global data_store, config
-    
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            config_data = json.load(f)
-            
-        # Set global configuration
-        config = config_data.get('config', {})
-        
-        # Initialize data store from collections
-        for collection in config_data.get('collections', []):
-            collection_name = collection.get('name')
-            if collection_name:
-                # Add timestamp to each item
-                for item in collection.get('items', []):
-                    item['last_updated'] = datetime.now().isoformat()
-                
-                # Store collection in data_store
-                data_store[collection_name] = {
-                    'items': collection.get('items', [])
-                }
-        
-        print(f"Loaded configuration with {len(data_store)} collections")
-        return True
-    except Exception as e:
-        print(f"Error loading configuration: {str(e)}")
-        return False
-
-def get_formatted_value(value, precision=None):
-    """Format a value according to its type and precision"""
-    if isinstance(value, float) and precision is not None:
-        return round(value, precision)
-    return value
-
-def update_data():
-    """Update all data items according to their update rules"""
-    global data_store
-    
-    for collection_name, collection in data_store.items():
-        for item in collection['items']:
-            # Skip items without update rules
-            if 'update_rules' not in item:
-                continue
-                
-            # Apply update rules for each field
-            for field, rules in item['update_rules'].items():
-                if field not in item:
-                    continue
-                    
-                rule_type = rules.get('type')
-                
-                if rule_type == 'random_float':
-                    min_change = rules.get('min_change', -1.0)
-                    max_change = rules.get('max_change', 1.0)
-                    min_value = rules.get('min_value', float('-inf'))
-                    max_value = rules.get('max_value', float('inf'))
-                    precision = rules.get('precision', 2)
-                    
-                    change = random.uniform(min_change, max_change)
-                    new_value = item[field] + change
-                    
-                    # Apply constraints
-                    new_value = max(min_value, min(max_value, new_value))
-                    item[field] = get_formatted_value(new_value, precision)
-                
-                elif rule_type == 'random_int':
-                    min_change = rules.get('min_change', -1)
-                    max_change = rules.get('max_change', 1)
-                    min_value = rules.get('min_value', 0)
-                    max_value = rules.get('max_value', 100)
-                    
-                    change = random.randint(min_change, max_change)
-                    new_value = item[field] + change
-                    
-                    # Apply constraints
-                    new_value = max(min_value, min(max_value, new_value))
-                    item[field] = int(new_value)
-                
-                elif rule_type == 'random_choice':
-                    choices = rules.get('choices', [])
-                    if choices:
-                        item[field] = random.choice(choices)
-            
-            # Update timestamp
-            item['last_updated'] = datetime.now().isoformat()
-    
-    return copy.deepcopy(data_store)
+# Path to the data configuration file
+CONFIG_FILE = 'data_config.json'
 
-# Background task for periodic updates
-def background_update():
-    update_interval = config.get('update_interval', 5)  # Default update interval is 5 seconds
-    while True:
-        updated_data = update_data()
-        socketio.emit('data_update', updated_data)
-        time.sleep(update_interval)
+# The data store, its updates and its Socket.IO clients (see simulation.py)
+sim = Simulation(CONFIG_FILE, app, socketio, send_queues, server_metrics)
 
 # Serve static files (for the dashboard)
 @app.route('/')
@@ -130,44 +38,97 @@ def index():
 @app.route('/api/', methods=['GET'])
 def get_collections():
     """Get a list of all available collections"""
-    return jsonify({'collections': list(data_store.keys())})
+    data = sim.snapshots.current.data
+    return jsonify({'collections': list(data.keys())})
 
 @app.route('/api/<collection_name>', methods=['GET'])
 def get_collection(collection_name):
-    """Get all items in a specific collection"""
-    if collection_name in data_store:
-        return jsonify(data_store[collection_name])
+    """Get the items in a specific collection, optionally paged, projected and filtered (see query.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name in snapshot.data:
+        try:
+            query = Query(request.args)
+        except QueryError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        args = (snapshot.data[collection_name]['items'], snapshot.positions[collection_name],
+                snapshot.by_type[collection_name], snapshot.type_paths[collection_name])
+        if wirecache.wants_ndjson(request):
+            # One item per line, read lazily from this snapshot as the response goes out
+            return wirecache.ndjson_response(query.stream(*args))
+        
+        def build():
+            collection = snapshot.data[collection_name]
+            items, next_cursor = query.run(*args)
+            result = dict(collection)
+            result['items'] = items
+            if next_cursor is not None:
+                result['next_cursor'] = next_cursor
+            return result
+        return sim.cached_response(snapshot, ('collection', collection_name, query.key), build)
     return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
 
 @app.route('/api/<collection_name>/<item_id>', methods=['GET'])
 def get_item(collection_name, item_id):
-    """Get a specific item by its ID within a collection"""
-    if collection_name in data_store:
-        for item in data_store[collection_name]['items']:
-            if item.get('id') == item_id:
-                return jsonify(item)
+    """Get a specific item by its ID within a collection, optionally projected (see query.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name in snapshot.data:
+        index = snapshot.positions[collection_name].get(item_id)
+        if index is not None:
+            try:
+                query = Query(request.args)
+            except QueryError as e:
+                return jsonify({"error": str(e)}), 400
+            return sim.encoded_response(query.view(snapshot.data[collection_name]['items'][index]))
         return jsonify({"error": f"Item with ID '{item_id}' not found"}), 404
     return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
 
+@app.route('/api/<collection_name>/<item_id>/history', methods=['GET'])
+def get_item_history(collection_name, item_id):
+    """Get the recent values of an item's numeric fields, downsampled (see history.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name not in snapshot.data:
+        return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
+    index = snapshot.positions[collection_name].get(item_id)
+    if index is None:
+        return jsonify({"error": f"Item with ID '{item_id}' not found"}), 404
+    try:
+        query = history.HistoryQuery(request.args)
+    except history.HistoryError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # History is kept under the id the patches use
+    key = snapshot.data[collection_name]['items'][index].get('id', index)
+    result = query.run(sim.history_store, collection_name, key)
+    if result is None:
+        return jsonify({"error": f"No history for '{query.field or item_id}'"}), 404
+    return sim.encoded_response(dict(result, collection=collection_name, id=key))
+
 @app.route('/api/<collection_name>/type/<type_value>', methods=['GET'])
 def get_items_by_type(collection_name, type_value):
-    """Get all items of a specific type within a collection"""
-    if collection_name in data_store:
-        matching_items = [item for item in data_store[collection_name]['items'] 
-                         if item.get('type') == type_value]
-        if matching_items:
-            return jsonify({"items": matching_items})
+    """Get all items of a specific type within a collection, optionally projected (see query.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name in snapshot.data:
+        # Positions of the items of this type, in collection order
+        positions = snapshot.by_type[collection_name].get(type_value)
+        if positions:
+            try:
+                query = Query(request.args)
+            except QueryError as e:
+                return jsonify({"error": str(e)}), 400
+            items = snapshot.data[collection_name]['items']
+            return sim.cached_response(snapshot, ('type', collection_name, type_value, query.view_key),
+                                   lambda: {"items": [query.view(items[index]) for index in positions]})
         return jsonify({"error": f"No items of type '{type_value}' found"}), 404
     return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
 
-@app.route('/api/schema', methods=['GET'])
-def get_schema():
-    """Get the current data schema"""
+def build_schema(data):
+    """Describe the item structure of every collection in a snapshot"""
     schema = {
         "collections": []
     }
     
-    for collection_name, collection in data_store.items():
+    for collection_name, collection in data.items():
         schema_collection = {"name": collection_name, "items": []}
         
         # Add sample item structure from first item (if available)
@@ -179,32 +140,28 @@ def get_schema():
         
         schema["collections"].append(schema_collection)
     
-    return jsonify(schema)
+    return schema
+
+@app.route('/api/schema', methods=['GET'])
+def get_schema():
+    """Get the current data schema"""
+    snapshot = sim.snapshots.current
+    return sim.cached_response(snapshot, ('schema',), lambda: build_schema(snapshot.data))
 
-# Socket.IO events
-@socketio.on('connect')
-def handle_connect():
-    print('Client connected')
-    emit('data_update', data_store)  # Send initial data on connect
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics (see metrics.py)"""
+    return server_metrics.response()
 
-@socketio.on('disconnect')
-def handle_disconnect():
-    print('Client disconnected')
+@app.route('/_admin/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    """Get run statistics (durations, lag, overruns) of the update jobs"""
+    return jsonify({'jobs': sim.scheduler.stats()})
 
-@socketio.on('start_background')
-def start_background_task():
-    thread = threading.Thread(target=background_update)
-    thread.daemon = True
-    thread.start()
+@app.route('/_admin/clients', methods=['GET'])
+def get_client_queues():
+    """Get every Socket.IO client's send queue and how far the lagging ones are held back"""
+    return jsonify(send_queues.stats())
 
 if __name__ == '__main__':
-    if load_config():
-        # Start the background update task
-        thread = threading.Thread(target=background_update)
-        thread.daemon = True
-        thread.start()
-        
-        # Run the Flask app with SocketIO
-        socketio.run(app, host='0.0.0.0', port=5000, debug=True)
-    else:
-        print(f"Failed to load configuration from {CONFIG_FILE}")
+    sim.main(__file__)
@@ -1,144 +1,123 @@
-import json
-import time
+import serving  # first: picks the async mode and monkey-patches for it
 import random
-import threading
-import copy
+import time
 import math
-from datetime import datetime
 from flask import Flask, jsonify, request, send_from_directory
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from flask_cors import CORS
-import os
+import plans
+import wirecache
+import wire
+from query import Query, QueryError
+import history
+import rooms
+import sendqueue
+import metrics
+import spatial
+import posstream
+from simulation import Simulation
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all domains
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(app, cors_allowed_origins="*", json=wirecache.SocketJSON, **serving.socketio_options())
 
-# Path to the data configuration file
-CONFIG_FILE = 'data_config_geo.json'
+# Every client's outbound queue, bounded by holding back clients that lag (see sendqueue.py)
+send_queues = sendqueue.SendQueues(socketio)
 
-# Global data store
-data_store = {}
-config = {}
+# Prometheus metrics, served at /metrics (see metrics.py)
+server_metrics = metrics.ServerMetrics(lambda: len(sim.subscriptions.clients), send_queues)
+server_metrics.instrument(app)
 
-def load_config():
-    """Load configuration from JSON file"""
-    global data_store, config
-    
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            config_data = json.load(f)
-            
-        # Set global configuration
-        config = config_data.get('config', {})
-        
-        # Initialize data store from collections
-        for collection in config_data.get('collections', []):
-            collection_name = collection.get('name')
-            if collection_name:
-                # Add timestamp to each item
-                for item in collection.get('items', []):
-                    item['last_updated'] = datetime.now().isoformat()
-                
-                # Store collection in data_store
-                data_store[collection_name] = {
-                    'type': collection.get('type', 'standard'),
-                    'items': collection.get('items', [])
-                }
-        
-        print(f"Loaded configuration with {len(data_store)} collections")
-        return True
-    except Exception as e:
-        print(f"Error loading configuration: {str(e)}")
-        return False
-
-def get_formatted_value(value, precision=None):
-    """Format a value according to its type and precision"""
-    if isinstance(value, float) and precision is not None:
-        return round(value, precision)
-    return value
-
-def get_nested_value(obj, path):
-    """Get a nested value from an object using a dot-separated path"""
-    parts = path.split('.')
-    current = obj
-    for part in parts:
-        if isinstance(current, dict) and part in current:
-            current = current[part]
-        elif isinstance(current, list) and part.isdigit() and int(part) < len(current):
-            current = current[int(part)]
-        else:
-            return None
-    return current
+# Path to the data configuration file
+CONFIG_FILE = 'data_config_geo.json'
 
-def set_nested_value(obj, path, value):
-    """Set a nested value in an object using a dot-separated path"""
-    parts = path.split('.')
-    current = obj
-    
-    # Navigate to the parent of the target property
-    for i, part in enumerate(parts[:-1]):
-        if part not in current:
-            # If the next part is a number, create a list
-            if parts[i + 1].isdigit():
-                current[part] = []
-            else:
-                current[part] = {}
-                
-        if isinstance(current[part], dict):
-            current = current[part]
-        elif isinstance(current[part], list):
-            next_idx = int(parts[i + 1])
-            while len(current[part]) <= next_idx:
-                current[part].append({})
-            current = current[part][next_idx]
+def compile_geo_movement(item, path, rules, ctx):
+    """Compile a geo_movement rule, which moves a Point feature based on speed and heading"""
+    geometry = item.get('geometry')
+    if path != 'geometry.coordinates' or not isinstance(geometry, dict) or geometry.get('type') != 'Point':
+        return None
     
-    # Set the value
-    current[parts[-1]] = value
-
-def update_geojson_point(coordinates, update_rule):
-    """Update a GeoJSON Point geometry based on movement rules"""
     # Extract update rule parameters
-    speed_knots = update_rule.get('speed_knots', 10)
-    heading_variation = update_rule.get('heading_variation', 10)
-    speed_variation = update_rule.get('speed_variation', 1)
-    bounds = update_rule.get('bounds', [-180, -90, 180, 90])
-    
-    # Calculate random variations for this update
-    speed = speed_knots + random.uniform(-speed_variation, speed_variation)
-    heading = random.uniform(-heading_variation, heading_variation)
+    speed_knots = rules.get('speed_knots', 10)
+    heading_variation = rules.get('heading_variation', 10)
+    speed_variation = rules.get('speed_variation', 1)
+    min_lon, min_lat, max_lon, max_lat = rules.get('bounds', [-180, -90, 180, 90])
     
     # Convert speed from knots to degrees per update interval (approximate)
     # 1 knot ≈ 0.0003 degrees of longitude per 5 seconds at the equator
     # This is a very simplified calculation and doesn't account for latitude
-    update_interval = config.get('update_interval', 5)
-    speed_deg = speed * 0.0003 * (update_interval / 5)
+    degrees_per_knot = 0.0003 * (ctx.interval / 5)
     
-    # Current coordinates
-    lon, lat = coordinates
+    # Random variations as base + span * random(), with the heading already in radians
+    min_speed_deg = (speed_knots - speed_variation) * degrees_per_knot
+    speed_span = 2 * speed_variation * degrees_per_knot
+    min_angle = -math.radians(heading_variation)
+    angle_span = 2 * math.radians(heading_variation)
+    rnd = ctx.rng.random
+    sin = math.sin
+    cos = math.cos
     
-    # Calculate new position
-    # Note: This is a simplified calculation that doesn't account for the
-    # curvature of the Earth properly, but works for small movements
-    angle_rad = math.radians(heading)
-    new_lon = lon + speed_deg * math.sin(angle_rad)
-    new_lat = lat + speed_deg * math.cos(angle_rad)
+    def step(fields):
+        # Calculate random variations for this update
+        speed_deg = min_speed_deg + speed_span * rnd()
+        angle_rad = min_angle + angle_span * rnd()
+        lon, lat = geometry['coordinates']
+        
+        # Calculate new position, kept within bounds
+        # Note: This is a simplified calculation that doesn't account for the
+        # curvature of the Earth properly, but works for small movements
+        new_lon = lon + speed_deg * sin(angle_rad)
+        new_lat = lat + speed_deg * cos(angle_rad)
+        if new_lon > max_lon:
+            new_lon = max_lon
+        elif new_lon < min_lon:
+            new_lon = min_lon
+        if new_lat > max_lat:
+            new_lat = max_lat
+        elif new_lat < min_lat:
+            new_lat = min_lat
+        if new_lon != lon or new_lat != lat:
+            geometry['coordinates'] = fields[path] = [new_lon, new_lat]
+    return step
+
+def compile_random_incidents(item, path, rules, ctx):
+    """Compile a random_incidents rule, which adds traffic incidents to a feature"""
+    properties = item.get('properties')
+    if path != 'properties.incidents' or not isinstance(properties, dict):
+        return None
     
-    # Ensure the new position is within bounds
-    min_lon, min_lat, max_lon, max_lat = bounds
-    new_lon = max(min_lon, min(max_lon, new_lon))
-    new_lat = max(min_lat, min(max_lat, new_lat))
+    probability = rules.get('probability', 0.1)
+    max_incidents = max(1, rules.get('max_incidents', 1))
+    rng = ctx.rng
     
-    return [new_lon, new_lat]
+    def step(fields):
+        # Check if we should add a new incident
+        if rng.random() >= probability:
+            return
+        
+        # Work on a copy, patches may still reference the current list
+        current_incidents = list(properties.get('incidents') or [])
+        
+        # Remove old incidents randomly to keep under max
+        while len(current_incidents) >= max_incidents:
+            current_incidents.pop(rng.randint(0, len(current_incidents) - 1))
+        
+        # Add new incident
+        current_incidents.append(generate_random_incident(rng))
+        properties['incidents'] = fields[path] = current_incidents
+    return step
 
-def generate_random_incident():
+plans.register_rule('geo_movement', compile_geo_movement)
+plans.register_rule('random_incidents', compile_random_incidents)
+
+def generate_random_incident(rng=random):
     """Generate a random traffic incident"""
     incident_types = ["accident", "construction", "event", "closure"]
     severities = ["minor", "moderate", "major"]
     
-    incident_type = random.choice(incident_types)
-    severity = random.choice(severities)
+    incident_type = rng.choice(incident_types)
+    severity = rng.choice(severities)
     
     descriptions = {
         "accident": ["Vehicle collision", "Multi-car accident", "Traffic accident", "Minor fender bender"],
@@ -149,143 +128,225 @@ def generate_random_incident():
     
     return {
         "type": incident_type,
-        "description": random.choice(descriptions.get(incident_type, ["Incident"])),
+        "description": rng.choice(descriptions.get(incident_type, ["Incident"])),
         "severity": severity,
-        "reported": datetime.now().isoformat()
+        "reported": sim.clock.stamp()
     }
 
-def update_data():
-    """Update all data items according to their update rules"""
-    global data_store
-    
-    for collection_name, collection in data_store.items():
-        collection_type = collection.get('type', 'standard')
-        
-        for item in collection['items']:
-            # Skip items without update rules
-            if 'update_rules' not in item:
-                continue
-                
-            # For GeoJSON items, we may need to handle nested properties
-            if collection_type == 'geojson':
-                # Apply update rules for fields
-                for field_path, rules in item['update_rules'].items():
-                    rule_type = rules.get('type')
-                    
-                    # Special handling for geo_movement rule type
-                    if rule_type == 'geo_movement':
-                        if field_path == 'geometry.coordinates' and item['geometry']['type'] == 'Point':
-                            current_coords = item['geometry']['coordinates']
-                            new_coords = update_geojson_point(current_coords, rules)
-                            item['geometry']['coordinates'] = new_coords
-                    
-                    # Special handling for random_incidents rule type
-                    elif rule_type == 'random_incidents':
-                        if field_path == 'properties.incidents':
-                            # Check if we should add a new incident
-                            if random.random() < rules.get('probability', 0.1):
-                                current_incidents = get_nested_value(item, field_path) or []
-                                max_incidents = rules.get('max_incidents', 1)
-                                
-                                # Remove old incidents randomly to keep under max
-                                while len(current_incidents) >= max_incidents:
-                                    current_incidents.pop(random.randint(0, len(current_incidents) - 1))
-                                
-                                # Add new incident
-                                current_incidents.append(generate_random_incident())
-                                set_nested_value(item, field_path, current_incidents)
-                    
-                    # Handle standard rule types for nested properties
-                    else:
-                        current_value = get_nested_value(item, field_path)
-                        if current_value is not None:
-                            if rule_type == 'random_float':
-                                min_change = rules.get('min_change', -1.0)
-                                max_change = rules.get('max_change', 1.0)
-                                min_value = rules.get('min_value', float('-inf'))
-                                max_value = rules.get('max_value', float('inf'))
-                                precision = rules.get('precision', 2)
-                                
-                                change = random.uniform(min_change, max_change)
-                                new_value = current_value + change
-                                
-                                # Apply constraints
-                                new_value = max(min_value, min(max_value, new_value))
-                                set_nested_value(item, field_path, get_formatted_value(new_value, precision))
-                            
-                            elif rule_type == 'random_int':
-                                min_change = rules.get('min_change', -1)
-                                max_change = rules.get('max_change', 1)
-                                min_value = rules.get('min_value', 0)
-                                max_value = rules.get('max_value', 100)
-                                
-                                change = random.randint(min_change, max_change)
-                                new_value = current_value + change
-                                
-                                # Apply constraints
-                                new_value = max(min_value, min(max_value, new_value))
-                                set_nested_value(item, field_path, int(new_value))
-                            
-                            elif rule_type == 'random_choice':
-                                choices = rules.get('choices', [])
-                                if choices:
-                                    set_nested_value(item, field_path, random.choice(choices))
-            else:
-                # Standard (non-geojson) item update
-                # Apply update rules for each field
-                for field, rules in item['update_rules'].items():
-                    if field not in item:
-                        continue
-                        
-                    rule_type = rules.get('type')
-                    
-                    if rule_type == 'random_float':
-                        min_change = rules.get('min_change', -1.0)
-                        max_change = rules.get('max_change', 1.0)
-                        min_value = rules.get('min_value', float('-inf'))
-                        max_value = rules.get('max_value', float('inf'))
-                        precision = rules.get('precision', 2)
-                        
-                        change = random.uniform(min_change, max_change)
-                        new_value = item[field] + change
-                        
-                        # Apply constraints
-                        new_value = max(min_value, min(max_value, new_value))
-                        item[field] = get_formatted_value(new_value, precision)
-                    
-                    elif rule_type == 'random_int':
-                        min_change = rules.get('min_change', -1)
-                        max_change = rules.get('max_change', 1)
-                        min_value = rules.get('min_value', 0)
-                        max_value = rules.get('max_value', 100)
-                        
-                        change = random.randint(min_change, max_change)
-                        new_value = item[field] + change
-                        
-                        # Apply constraints
-                        new_value = max(min_value, min(max_value, new_value))
-                        item[field] = int(new_value)
-                    
-                    elif rule_type == 'random_choice':
-                        choices = rules.get('choices', [])
-                        if choices:
-                            item[field] = random.choice(choices)
-            
-            # Update timestamp
-            if collection_type == 'geojson' and 'properties' in item:
-                item['properties']['last_updated'] = datetime.now().isoformat()
+class GeoSimulation(Simulation):
+    """The simulation plus spatial indexes, map viewports and position streams of the GeoJSON collections"""
+
+    def __init__(self, *args):
+        # Grid index over the features of each GeoJSON collection
+        self.spatial_indexes = {}
+
+        # Binary position streams of the GeoJSON collections with Point features
+        self.position_streams = {}
+
+        # Zoom level from which viewports get features instead of clusters, per collection
+        self.cluster_below_zoom = {}
+
+        # Map viewports registered by Socket.IO clients, one room per distinct viewport
+        self.viewports = rooms.RoomRegistry('view')
+
+        # Clients streaming a collection's positions, one room per collection
+        self.position_rooms = rooms.RoomRegistry('positions')
+        super().__init__(*args)
+
+    def type_path(self, collection):
+        """Get the field that holds the type of a collection's items"""
+        # GeoJSON features keep their type in properties
+        if collection.get('type') == 'geojson':
+            return 'properties.type'
+        return 'type'
+
+    def store_entry(self, collection, items):
+        return {
+            'type': collection.get('type', 'standard'),
+            'items': items
+        }
+
+    def index_collections(self, config_data):
+        self.spatial_indexes = {}
+        self.cluster_below_zoom = {}
+        self.position_streams = {}
+        super().index_collections(config_data)
+
+    def index_collection(self, collection):
+        """Index a GeoJSON collection's features for bbox and nearest queries and the position stream
+
+        Every other zoom level below the clustering threshold can be clustered;
+        the spatial index builds those levels when they are first viewed.
+        Other collections get no indexes.
+        """
+        collection_name = collection.get('name')
+        self.spatial_indexes.pop(collection_name, None)
+        self.cluster_below_zoom.pop(collection_name, None)
+        self.position_streams.pop(collection_name, None)
+        if collection_name not in self.data_store or self.data_store[collection_name]['type'] != 'geojson':
+            return
+        items = self.data_store[collection_name]['items']
+        cell_size = collection.get('spatial_cell_size', self.config.get('spatial_cell_size'))
+        max_zoom = collection.get('cluster_below_zoom', self.config.get('cluster_below_zoom', 8))
+        self.cluster_below_zoom[collection_name] = max_zoom
+        self.spatial_indexes[collection_name] = spatial.GridIndex.build(items, cell_size, range(0, max_zoom, 2))
+
+        # Quantized positions for the binary position stream
+        stream = posstream.PositionStream(items)
+        if stream.ids:
+            self.position_streams[collection_name] = stream
+
+    def update_spatial_indexes(self, changes):
+        """Move the indexed features whose coordinates changed in a tick"""
+        for collection_name, index in self.spatial_indexes.items():
+            item_changes = changes.get(collection_name)
+            if item_changes:
+                index.move([(item_id, fields['geometry.coordinates']) for item_id, fields in item_changes.items()
+                            if 'geometry.coordinates' in fields])
+
+    def publish_changes(self, changes):
+        """Sequence a tick's changes and publish the snapshot and indexes they lead to; call with store_lock held"""
+        patch = super().publish_changes(changes)
+        if patch is not None:
+            self.update_spatial_indexes(changes)
+        return patch
+
+    def prepare_send(self, patch):
+        """Advance the position streams to a patch, returning the frame of each collection whose points moved"""
+        frames = {}
+        for collection_name, stream in self.position_streams.items():
+            item_changes = patch['changes'].get(collection_name)
+            if item_changes:
+                frame = stream.delta(patch['seq'], item_changes)
+                if frame is not None:
+                    frames[collection_name] = frame
+        return frames
+
+    def viewport_key(self, data):
+        """Turn a viewport payload into a hashable key, or None if it is invalid
+
+        Viewports zoomed out past the collection's clustering threshold share a
+        key per cluster level rather than per zoom level.
+        """
+        collection_name = data.get('collection')
+        bbox = spatial.parse_bbox(data.get('bbox'))
+        zoom = data.get('zoom')
+        if collection_name not in self.spatial_indexes or bbox is None or not isinstance(zoom, (int, float)):
+            return None
+        if zoom >= self.cluster_below_zoom[collection_name]:
+            return (collection_name, bbox, 'features')
+        return (collection_name, bbox, 'clusters', self.spatial_indexes[collection_name].cluster_zoom(zoom))
+
+    def get_viewport(self, key, fmt):
+        """Get the features (or clusters) inside a viewport, encoded once per version, viewport and wire format"""
+        snapshot = self.snapshots.current
+
+        def build():
+            collection_name, bbox, mode = key[:3]
+            index = self.spatial_indexes[collection_name]
+            message = {'seq': snapshot.seq, 'collection': collection_name, 'bbox': list(bbox)}
+            if mode == 'clusters':
+                # [centroid lon, centroid lat, count] per cell
+                message['clusters'] = index.query_clusters(key[3], *bbox)
             else:
-                item['last_updated'] = datetime.now().isoformat()
-    
-    return copy.deepcopy(data_store)
+                message['features'] = [feature for feature in indexed_features(snapshot, collection_name, index.query_bbox(*bbox))
+                                       if in_bbox(feature, bbox)]
+            return message
+        return self.encoded.get(snapshot.seq, ('viewport', key, fmt), build, wire.encoder(fmt))
+
+    def stream_viewports(self, patch, skip):
+        """Send every registered viewport of a changed collection what is now in view, except to the clients in skip"""
+        start = time.perf_counter()
+        held = held_back(self.viewports, skip, self.spatial_indexes)
+        for (key, fmt), room, members in self.viewports.active():
+            if key[0] in patch['changes']:
+                raw = self.get_viewport(key, fmt)
+                self.socketio.emit('viewport_data', wire.socket_payload(raw), to=room, skip_sid=skip)
+                self.server_metrics.emitted('viewport_data', raw, members - held.get((key, fmt), 0))
+        self.server_metrics.emit_seconds.observe(('viewport_data',), time.perf_counter() - start)
+
+    def send_patch(self, patch, frames):
+        """Broadcast a published patch to subscribers, viewports and position streams
+
+        Clients that lag are skipped and caught up once their queue drained (see sendqueue.py).
+        """
+        skip = self.send_queues.skip
+        self.broadcast(patch, skip)
+        self.stream_viewports(patch, skip)
+        start = time.perf_counter()
+        held = held_back(self.position_rooms, skip, self.position_streams)
+        for collection_name, room, members in self.position_rooms.active():
+            frame = frames.get(collection_name)
+            if frame is not None:
+                self.socketio.emit('positions', (collection_name, frame), to=room, skip_sid=skip)
+                self.server_metrics.emitted('positions', frame, members - held.get(collection_name, 0))
+        self.server_metrics.emit_seconds.observe(('positions',), time.perf_counter() - start)
+        self.catch_up_drained()
+
+    def send_keyframe(self, collection_name, stream, to):
+        metadata, frame = stream.keyframe()
+        metadata['collection'] = collection_name
+        self.socketio.emit('positions_keyframe', (metadata, frame), to=to)
+        return frame
+
+    def catch_up(self, sid, backlog):
+        """Send a client that stopped lagging what it was held back from
+
+        That is the changes merged into one patch, what is now in its viewports
+        and a new keyframe for each of its position streams.
+        """
+        super().catch_up(sid, backlog)
+        if self.subscriptions.group_of(sid) is None:
+            return
+        for collection_name in self.spatial_indexes:
+            viewport = self.viewports.key_of((sid, collection_name))
+            if viewport is not None:
+                raw = self.get_viewport(*viewport)
+                self.socketio.emit('viewport_data', wire.socket_payload(raw), to=sid)
+                self.server_metrics.emitted('viewport_data', raw)
+        for collection_name, stream in self.position_streams.items():
+            if self.position_rooms.key_of((sid, collection_name)) is not None:
+                frame = self.send_keyframe(collection_name, stream, sid)
+                self.server_metrics.emitted('positions_keyframe', frame)
+
+    def push_snapshots(self, collection_names=None):
+        """Send what a reload changed in some collections (by default all of them) to the clients following them
+
+        That is a new snapshot to every subscription group covering one of the
+        collections, what is now in their viewports and a new keyframe for their
+        position streams.
+        """
+        super().push_snapshots(collection_names)
+        changed = lambda collection_name: collection_names is None or collection_name in collection_names
+        for (key, fmt), room, members in self.viewports.active():
+            if changed(key[0]) and key[0] in self.spatial_indexes:
+                raw = self.get_viewport(key, fmt)
+                self.socketio.emit('viewport_data', wire.socket_payload(raw), to=room)
+                self.server_metrics.emitted('viewport_data', raw, members)
+        for collection_name, room, members in self.position_rooms.active():
+            stream = self.position_streams.get(collection_name)
+            if changed(collection_name) and stream is not None:
+                frame = self.send_keyframe(collection_name, stream, room)
+                self.server_metrics.emitted('positions_keyframe', frame, members)
+
+    def handle_disconnect(self):
+        super().handle_disconnect()
+        sid = request.sid
+        self.viewports.remove(lambda member: member[0] == sid)
+        self.position_rooms.remove(lambda member: member[0] == sid)
 
-# Background task for periodic updates
-def background_update():
-    update_interval = config.get('update_interval', 5)  # Default update interval is 5 seconds
-    while True:
-        updated_data = update_data()
-        socketio.emit('data_update', updated_data)
-        time.sleep(update_interval)
+def held_back(registry, skip, collection_names):
+    """Count the clients in skip per key of a RoomRegistry whose members are (sid, collection name)"""
+    counts = {}
+    for sid in skip:
+        for collection_name in collection_names:
+            key = registry.key_of((sid, collection_name))
+            if key is not None:
+                counts[key] = counts.get(key, 0) + 1
+    return counts
+
+# The data store, its updates, indexes and Socket.IO clients (see simulation.py)
+sim = GeoSimulation(CONFIG_FILE, app, socketio, send_queues, server_metrics)
 
 # Serve static files (for the dashboard)
 @app.route('/')
@@ -296,66 +357,171 @@ def index():
 @app.route('/api/collections', methods=['GET'])
 def get_collections():
     """Get a list of all available collections"""
+    data = sim.snapshots.current.data
     collection_info = {name: {'type': collection.get('type', 'standard')} 
-                      for name, collection in data_store.items()}
+                      for name, collection in data.items()}
     return jsonify({'collections': collection_info})
 
 @app.route('/api/collections/<collection_name>', methods=['GET'])
 def get_collection(collection_name):
-    """Get all items in a specific collection"""
-    if collection_name in data_store:
-        return jsonify(data_store[collection_name])
+    """Get the items in a specific collection, optionally paged, projected and filtered (see query.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name in snapshot.data:
+        try:
+            query = Query(request.args)
+        except QueryError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        args = (snapshot.data[collection_name]['items'], snapshot.positions[collection_name],
+                snapshot.by_type[collection_name], snapshot.type_paths[collection_name])
+        if wirecache.wants_ndjson(request):
+            # One item per line, read lazily from this snapshot as the response goes out
+            return wirecache.ndjson_response(query.stream(*args))
+        
+        def build():
+            collection = snapshot.data[collection_name]
+            items, next_cursor = query.run(*args)
+            result = dict(collection)
+            result['items'] = items
+            if next_cursor is not None:
+                result['next_cursor'] = next_cursor
+            return result
+        return sim.cached_response(snapshot, ('collection', collection_name, query.key), build)
     return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
 
 @app.route('/api/collections/<collection_name>/<item_id>', methods=['GET'])
 def get_item(collection_name, item_id):
-    """Get a specific item by its ID within a collection"""
-    if collection_name in data_store:
-        for item in data_store[collection_name]['items']:
-            if item.get('id') == item_id:
-                return jsonify(item)
+    """Get a specific item by its ID within a collection, optionally projected (see query.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name in snapshot.data:
+        index = snapshot.positions[collection_name].get(item_id)
+        if index is not None:
+            try:
+                query = Query(request.args)
+            except QueryError as e:
+                return jsonify({"error": str(e)}), 400
+            return sim.encoded_response(query.view(snapshot.data[collection_name]['items'][index]))
         return jsonify({"error": f"Item with ID '{item_id}' not found"}), 404
     return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
 
+@app.route('/api/collections/<collection_name>/<item_id>/history', methods=['GET'])
+def get_item_history(collection_name, item_id):
+    """Get the recent values of an item's numeric fields, downsampled (see history.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name not in snapshot.data:
+        return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
+    index = snapshot.positions[collection_name].get(item_id)
+    if index is None:
+        return jsonify({"error": f"Item with ID '{item_id}' not found"}), 404
+    try:
+        query = history.HistoryQuery(request.args)
+    except history.HistoryError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # History is kept under the id the patches use
+    key = snapshot.data[collection_name]['items'][index].get('id', index)
+    result = query.run(sim.history_store, collection_name, key)
+    if result is None:
+        return jsonify({"error": f"No history for '{query.field or item_id}'"}), 404
+    return sim.encoded_response(dict(result, collection=collection_name, id=key))
+
 @app.route('/api/collections/<collection_name>/type/<type_value>', methods=['GET'])
 def get_items_by_type(collection_name, type_value):
-    """Get all items of a specific type within a collection"""
-    if collection_name in data_store:
-        collection_type = data_store[collection_name].get('type', 'standard')
-        
-        # For GeoJSON collections, look for the type in properties
-        if collection_type == 'geojson':
-            matching_items = [item for item in data_store[collection_name]['items'] 
-                             if item.get('properties', {}).get('type') == type_value]
-        else:
-            matching_items = [item for item in data_store[collection_name]['items'] 
-                             if item.get('type') == type_value]
-        
-        if matching_items:
-            return jsonify({"items": matching_items})
+    """Get all items of a specific type within a collection, optionally projected (see query.py)"""
+    snapshot = sim.snapshots.current
+    if collection_name in snapshot.data:
+        # For GeoJSON collections the type index uses properties.type
+        positions = snapshot.by_type[collection_name].get(type_value)
+        if positions:
+            try:
+                query = Query(request.args)
+            except QueryError as e:
+                return jsonify({"error": str(e)}), 400
+            items = snapshot.data[collection_name]['items']
+            return sim.cached_response(snapshot, ('type', collection_name, type_value, query.view_key),
+                                   lambda: {"items": [query.view(items[index]) for index in positions]})
         return jsonify({"error": f"No items of type '{type_value}' found"}), 404
     return jsonify({"error": f"Collection '{collection_name}' not found"}), 404
 
+def indexed_features(snapshot, collection_name, item_ids):
+    """Look up indexed features in a snapshot, keeping collection order"""
+    positions = snapshot.positions[collection_name]
+    items = snapshot.data[collection_name]['items']
+    indexes = sorted(positions[item_id] for item_id in item_ids if item_id in positions)
+    return [items[index] for index in indexes]
+
+def in_bbox(feature, bbox):
+    """Check a Point feature against a bbox (other geometries were already checked by the index)"""
+    point = spatial.point_of(feature)
+    if point is None:
+        return True
+    min_lon, min_lat, max_lon, max_lat = bbox
+    lon, lat = point
+    in_lon = min_lon <= lon <= max_lon if min_lon <= max_lon else (lon >= min_lon or lon <= max_lon)
+    return in_lon and min_lat <= lat <= max_lat
+
 @app.route('/api/geojson/<collection_name>', methods=['GET'])
 def get_geojson_collection(collection_name):
-    """Get a collection as a GeoJSON FeatureCollection"""
-    if collection_name in data_store and data_store[collection_name].get('type') == 'geojson':
+    """Get a collection as a GeoJSON FeatureCollection, optionally only the features in ?bbox=minLon,minLat,maxLon,maxLat"""
+    snapshot = sim.snapshots.current
+    data = snapshot.data
+    if collection_name in data and data[collection_name].get('type') == 'geojson':
+        if 'bbox' in request.args:
+            bbox = spatial.parse_bbox(request.args['bbox'])
+            if bbox is None:
+                return jsonify({"error": "bbox must be minLon,minLat,maxLon,maxLat"}), 400
+            
+            # The index follows the live store, so recheck the candidates against this snapshot
+            item_ids = sim.spatial_indexes[collection_name].query_bbox(*bbox)
+            features = [feature for feature in indexed_features(snapshot, collection_name, item_ids)
+                        if in_bbox(feature, bbox)]
+            return sim.encoded_response({
+                "type": "FeatureCollection",
+                "bbox": list(bbox),
+                "features": features
+            })
+        
         # Create a proper GeoJSON FeatureCollection
-        feature_collection = {
+        feature_collection = lambda: {
             "type": "FeatureCollection",
-            "features": data_store[collection_name]['items']
+            "features": data[collection_name]['items']
         }
-        return jsonify(feature_collection)
+        return sim.cached_response(snapshot, ('geojson', collection_name), feature_collection)
     return jsonify({"error": f"GeoJSON collection '{collection_name}' not found"}), 404
 
-@app.route('/api/schema', methods=['GET'])
-def get_schema():
-    """Get the current data schema"""
+@app.route('/api/geojson/<collection_name>/nearest', methods=['GET'])
+def get_nearest_features(collection_name):
+    """Get the n Point features closest to ?lon=&lat= (n defaults to 10), closest first"""
+    snapshot = sim.snapshots.current
+    data = snapshot.data
+    if collection_name in data and data[collection_name].get('type') == 'geojson':
+        try:
+            lon = float(request.args['lon'])
+            lat = float(request.args['lat'])
+            n = int(request.args.get('n', 10))
+        except (KeyError, ValueError):
+            return jsonify({"error": "lon and lat are required, n must be an integer"}), 400
+        if n < 1:
+            return jsonify({"error": "n must be at least 1"}), 400
+        
+        positions = snapshot.positions[collection_name]
+        items = data[collection_name]['items']
+        nearest = [(distance, item_id) for distance, item_id in sim.spatial_indexes[collection_name].nearest(lon, lat, n)
+                   if item_id in positions]
+        return sim.encoded_response({
+            "type": "FeatureCollection",
+            "features": [items[positions[item_id]] for distance, item_id in nearest],
+            "distances_km": [distance for distance, item_id in nearest]
+        })
+    return jsonify({"error": f"GeoJSON collection '{collection_name}' not found"}), 404
+
+def build_schema(data):
+    """Describe the item structure of every collection in a snapshot"""
     schema = {
         "collections": []
     }
     
-    for collection_name, collection in data_store.items():
+    for collection_name, collection in data.items():
         schema_collection = {
             "name": collection_name, 
             "type": collection.get('type', 'standard'),
@@ -388,32 +554,87 @@ def get_schema():
         
         schema["collections"].append(schema_collection)
     
-    return jsonify(schema)
+    return schema
+
+@app.route('/api/schema', methods=['GET'])
+def get_schema():
+    """Get the current data schema"""
+    snapshot = sim.snapshots.current
+    return sim.cached_response(snapshot, ('schema',), lambda: build_schema(snapshot.data))
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics (see metrics.py)"""
+    return server_metrics.response()
+
+@app.route('/_admin/scheduler', methods=['GET'])
+def get_scheduler_stats():
+    """Get run statistics (durations, lag, overruns) of the update jobs"""
+    return jsonify({'jobs': sim.scheduler.stats()})
+
+@app.route('/_admin/clients', methods=['GET'])
+def get_client_queues():
+    """Get every Socket.IO client's send queue and how far the lagging ones are held back"""
+    return jsonify(send_queues.stats())
 
 # Socket.IO events
-@socketio.on('connect')
-def handle_connect():
-    print('Client connected')
-    emit('data_update', data_store)  # Send initial data on connect
+@socketio.on('viewport')
+def handle_viewport(data=None):
+    """Stream the features of a GeoJSON collection inside a map viewport ({collection, bbox, zoom})
 
-@socketio.on('disconnect')
-def handle_disconnect():
-    print('Client disconnected')
+    Zoomed out, the client gets clusters instead of features. A viewport
+    without a bbox stops the stream for that collection.
+    """
+    if not isinstance(data, dict) or data.get('collection') not in sim.spatial_indexes:
+        emit('error', {'error': 'Invalid viewport'})
+        return
+    
+    key = None
+    if data.get('bbox') is not None:
+        key = sim.viewport_key(data)
+        if key is None:
+            emit('error', {'error': 'Invalid viewport'})
+            return
+    
+    # Clients with the same viewport and wire format share a room
+    group = sim.subscriptions.group_of(request.sid)
+    fmt = group.fmt if group is not None else wire.DEFAULT
+    old_room, room = sim.viewports.set((request.sid, data['collection']), (key, fmt) if key is not None else None)
+    if old_room != room:
+        if old_room is not None:
+            leave_room(old_room)
+        if room is not None:
+            join_room(room)
+    if key is not None:
+        emit('viewport_data', wire.socket_payload(sim.get_viewport(key, fmt)))
+
+@socketio.on('subscribe_positions')
+def handle_subscribe_positions(data=None):
+    """Stream the quantized positions of a collection's points as binary frames (see posstream.py)
 
-@socketio.on('start_background')
-def start_background_task():
-    thread = threading.Thread(target=background_update)
-    thread.daemon = True
-    thread.start()
+    Also sent again by a client that missed a frame, to get a new keyframe.
+    """
+    collection_name = data.get('collection') if isinstance(data, dict) else None
+    stream = sim.position_streams.get(collection_name)
+    if stream is None:
+        emit('error', {'error': f"No position stream for '{collection_name}'"})
+        return
+    
+    old_room, room = sim.position_rooms.set((request.sid, collection_name), collection_name)
+    if old_room != room:
+        join_room(room)
+    metadata, frame = stream.keyframe()
+    metadata['collection'] = collection_name
+    emit('positions_keyframe', (metadata, frame))
+
+@socketio.on('unsubscribe_positions')
+def handle_unsubscribe_positions(data=None):
+    """Stop streaming a collection's positions"""
+    collection_name = data.get('collection') if isinstance(data, dict) else None
+    if collection_name in sim.position_streams:
+        old_room, room = sim.position_rooms.set((request.sid, collection_name), None)
+        if old_room is not None:
+            leave_room(old_room)
 
 if __name__ == '__main__':
-    if load_config():
-        # Start the background update task
-        thread = threading.Thread(target=background_update)
-        thread.daemon = True
-        thread.start()
-        
-        # Run the Flask app with SocketIO
-        socketio.run(app, host='0.0.0.0', port=5000, debug=True)
-    else:
-        print(f"Failed to load configuration from {CONFIG_FILE}")
\ No newline at end of file
+    sim.main(__file__)
@@ -1,18 +1,34 @@
 #!/usr/bin/python
 
 import json
+import os
 import time
 import random
 import threading
-from datetime import datetime
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify
 from flask_cors import CORS
 import paho.mqtt.client as mqtt
+import metrics
+import simclock
 
 # Initialize Flask app
 app = Flask(__name__)
 CORS(app)  # Enable CORS for all domains
 
+# Prometheus metrics, served at /metrics (see metrics.py); MQTT clients
+# connect to the broker, so there is no connected clients gauge
+server_metrics = metrics.ServerMetrics()
+server_metrics.instrument(app)
+
+# Simulated time, from the DUMMYAPI_SIM_* environment variables (see simclock.py)
+clock = simclock.SimClock(**simclock.env_options())
+
+# Source of the sensor fluctuations; DUMMYAPI_SEED makes runs repeatable
+rng = random.Random(os.environ.get('DUMMYAPI_SEED'))
+
+# Seconds of simulated time between updates
+UPDATE_INTERVAL = 5
+
 # MQTT Configuration
 MQTT_BROKER = "localhost"  # Change to your MQTT broker address if not running locally
 MQTT_PORT = 1883
@@ -31,7 +47,7 @@ sensors = {
             "unit": "celsius",
             "value": 22.5,
             "status": "online",
-            "last_updated": datetime.now().isoformat()
+            "last_updated": clock.stamp()
         },
         {
             "id": "hum-001",
@@ -40,7 +56,7 @@ sensors = {
             "unit": "percent",
             "value": 45.2,
             "status": "online",
-            "last_updated": datetime.now().isoformat()
+            "last_updated": clock.stamp()
         },
         {
             "id": "pres-001",
@@ -49,30 +65,37 @@ sensors = {
             "unit": "hPa",
             "value": 1013.25,
             "status": "online",
-            "last_updated": datetime.now().isoformat()
+            "last_updated": clock.stamp()
         }
     ]
 }
 
-# Function to update sensor data randomly
-def update_sensor_data():
+# Lookup indexes by id and by type. Sensors are only ever updated in place
+# and never change id or type, so these stay current.
+sensors_by_id = {sensor["id"]: sensor for sensor in sensors["sensors"]}
+sensors_by_type = {}
+for sensor in sensors["sensors"]:
+    sensors_by_type.setdefault(sensor["type"], []).append(sensor)
+
+# Function to update sensor data randomly, stamping them with the tick's timestamp
+def update_sensor_data(timestamp):
     for sensor in sensors["sensors"]:
         # Generate random fluctuation based on sensor type
         if sensor["type"] == "temperature":
-            fluctuation = random.uniform(-0.5, 0.5)
+            fluctuation = rng.uniform(-0.5, 0.5)
             if 15 <= sensor["value"] + fluctuation <= 30:
                 sensor["value"] = round(sensor["value"] + fluctuation, 2)
         elif sensor["type"] == "humidity":
-            fluctuation = random.uniform(-1.0, 1.0)
+            fluctuation = rng.uniform(-1.0, 1.0)
             if 30 <= sensor["value"] + fluctuation <= 70:
                 sensor["value"] = round(sensor["value"] + fluctuation, 2)
         elif sensor["type"] == "pressure":
-            fluctuation = random.uniform(-0.25, 0.25)
+            fluctuation = rng.uniform(-0.25, 0.25)
             if 990 <= sensor["value"] + fluctuation <= 1030:
                 sensor["value"] = round(sensor["value"] + fluctuation, 2)
         
         # Update timestamp
-        sensor["last_updated"] = datetime.now().isoformat()
+        sensor["last_updated"] = timestamp
     
     return sensors
 
@@ -90,20 +113,31 @@ def connect_mqtt():
 
 # Background task for periodic updates and MQTT publishing
 def background_update():
+    encode = lambda payload: json.dumps(payload, default=str)
     while True:
-        updated_data = update_sensor_data()
+        start = time.perf_counter()
+        updated_data = update_sensor_data(clock.stamp())
+        server_metrics.update_seconds.observe(("sensors",), time.perf_counter() - start)
+        
         # Convert to JSON and publish to MQTT topic
-        json_data = json.dumps(updated_data, default=str)
+        start = time.perf_counter()
+        json_data = server_metrics.encode("mqtt", encode, updated_data)
         mqtt_client.publish(MQTT_TOPIC, json_data)
+        server_metrics.emitted("mqtt", json_data)
         
         # Also publish individual sensor data to specific topics
         for sensor in updated_data["sensors"]:
             sensor_topic = f"sensors/{sensor['type']}/{sensor['id']}"
-            sensor_json = json.dumps(sensor, default=str)
+            sensor_json = server_metrics.encode("mqtt", encode, sensor)
             mqtt_client.publish(sensor_topic, sensor_json)
+            server_metrics.emitted("mqtt", sensor_json)
+        server_metrics.emit_seconds.observe(("mqtt",), time.perf_counter() - start)
         
         print(f"Published data to MQTT topic: {MQTT_TOPIC}")
-        time.sleep(5)  # Update every 5 seconds
+        # Update every 5 seconds of simulated time
+        if clock.is_virtual:
+            clock.advance_to(clock.elapsed() + UPDATE_INTERVAL)
+        time.sleep(clock.wall_seconds(UPDATE_INTERVAL))
 
 # REST API Routes
 @app.route('/api/sensors', methods=['GET'])
@@ -112,18 +146,22 @@ def get_all_sensors():
 
 @app.route('/api/sensors/<sensor_id>', methods=['GET'])
 def get_sensor(sensor_id):
-    for sensor in sensors["sensors"]:
-        if sensor["id"] == sensor_id:
-            return jsonify(sensor)
+    sensor = sensors_by_id.get(sensor_id)
+    if sensor is not None:
+        return jsonify(sensor)
     return jsonify({"error": "Sensor not found"}), 404
 
 @app.route('/api/sensors/type/<sensor_type>', methods=['GET'])
 def get_sensors_by_type(sensor_type):
-    matching_sensors = [sensor for sensor in sensors["sensors"] if sensor["type"] == sensor_type]
+    matching_sensors = sensors_by_type.get(sensor_type)
     if matching_sensors:
         return jsonify({"sensors": matching_sensors})
     return jsonify({"error": f"No sensors of type {sensor_type} found"}), 404
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return server_metrics.response()
+
 if __name__ == '__main__':
     # Connect to MQTT broker
     connect_mqtt()
@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+
+# Benchmark: one of the servers under load, end to end.
+#
+# Starts api.py, api_generic.py or api_geo.py on a synthetic config of about
+# --items items (generated from the first item of every collection in the
+# server's config, see generate.py), connects --clients Socket.IO clients and
+# runs --rest-concurrency loops of REST requests from a weighted mix, then
+# reports:
+#
+#   ticks        duration of the update jobs (sampled from /_admin/scheduler)
+#   fan-out      time from a tick stamping its changes (last_updated) to a
+#                client receiving them, p50/p99 over all clients
+#   REST         requests per second and latency p50/p99
+#   clients      messages and bytes per client per second
+#   RSS          peak and final resident memory of the server process
+#
+#   python bench_load.py --server api_geo --items 100000 --clients 200 --duration 30
+#   python bench_load.py --server api_generic --rest 'api/sensors=3,api/schema=1' --output results.jsonl
+#
+# Results are printed as JSON, and appended as one line to --output, so runs
+# can be compared across changes. The clients run in this process on asyncio
+# with a minimal WebSocket client; on a machine with few cores they compete
+# with the server for CPU, so compare runs made on the same machine.
+# api.py has no config, so it always serves its three sensors.
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_FILES = {
+    'api_generic': 'data_config.json',
+    'api_geo': 'data_config_geo.json',
+}
+
+# Events that carry a tick's changes, and the timestamp the tick gave them
+TICK_EVENTS = (b'42["data_patch"', b'42["sensor_update"')
+STAMP = re.compile(rb'last_updated":"([^"]+)"')
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='load one of the dummy API servers and measure it')
+    parser.add_argument('-s', '--server', choices=['api', 'api_generic', 'api_geo'], default='api_geo', help='server to benchmark')
+    parser.add_argument('-n', '--items', type=int, default=10000, help='approximate number of items to serve')
+    parser.add_argument('-m', '--clients', type=int, default=100, help='number of Socket.IO clients')
+    parser.add_argument('-d', '--duration', type=float, default=30, help='seconds to measure for')
+    parser.add_argument('-i', '--interval', type=float, default=1, help='update interval of the synthetic config')
+    parser.add_argument('-r', '--rest', type=str, default=None,
+                        help="REST mix as 'path=weight,...' (default: the collection list and the first collection)")
+    parser.add_argument('-c', '--rest-concurrency', type=int, default=4, help='concurrent REST request loops, 0 for none')
+    parser.add_argument('-a', '--async-mode', type=str, default=os.environ.get('DUMMYAPI_ASYNC', 'gevent'),
+                        help='DUMMYAPI_ASYNC for the server (threading runs the debugger and reloader)')
+    parser.add_argument('-p', '--port', type=int, default=5099, help='port to run the server on')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the synthetic config')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON Lines file to append the results to')
+    return parser.parse_args()
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(fraction * len(values)))], 3)
+
+def summary(values):
+    return {'samples': len(values), 'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99),
+            'max': round(max(values), 3) if values else None}
+
+# Synthetic config
+
+def point_generator(item):
+    """A point generator inside the bounds of an item's movement rule, so generated features spread out"""
+    rules = item.get('properties', {}).get('update_rules', {}).get('geometry.coordinates', {})
+    return {'$gen': 'point', 'bounds': rules.get('bounds', [-180, -90, 180, 90])}
+
+def synthetic_config(config_file, items, interval, seed):
+    """Grow every collection of a config to its share of items with a generate block"""
+    with open(config_file, 'r') as f:
+        config_data = json.load(f)
+
+    collections = [c for c in config_data.get('collections', []) if c.get('items')]
+    per_collection = max(1, items // max(1, len(collections)))
+    for collection in collections:
+        template = json.loads(json.dumps(collection['items'][0]))
+        template.pop('id', None)
+        if template.get('geometry', {}).get('type') == 'Point':
+            template['geometry']['coordinates'] = point_generator(template)
+        collection['generate'] = {
+            'count': max(0, per_collection - len(collection['items'])),
+            'id_pattern': f"{collection['name']}-{{n}}",
+            'template': template,
+        }
+    config_data.setdefault('config', {}).update(update_interval=interval, seed=seed)
+    for collection in collections:
+        collection.pop('update_interval', None)
+    return config_data
+
+# Server
+
+def start_server(args, workdir):
+    """Start the server with its working directory (and config) in workdir"""
+    env = dict(os.environ, DUMMYAPI_ASYNC=args.async_mode, DUMMYAPI_PORT=str(args.port), PYTHONUNBUFFERED='1')
+    log = open(os.path.join(workdir, 'server.log'), 'w')
+    return subprocess.Popen([sys.executable, os.path.join(HERE, f"{args.server}.py")], cwd=workdir, env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+# Minimal HTTP/1.1 and WebSocket clients
+
+async def http_get(reader, writer, path):
+    """GET path on a keep-alive connection, return (status, body)"""
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+    await writer.drain()
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    status = int(lines[0].split()[1])
+    headers = {k.strip().lower(): v.strip() for k, _, v in (line.partition(':') for line in lines[1:] if line)}
+    if headers.get('transfer-encoding') == 'chunked':
+        body = b''
+        while True:
+            size = int((await reader.readuntil(b'\r\n')).strip(), 16)
+            chunk = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            body += chunk[:-2]
+    else:
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return status, body
+
+async def open_http(port):
+    return await asyncio.open_connection('127.0.0.1', port)
+
+def ws_frame(text):
+    data = text.encode()
+    mask = os.urandom(4)
+    if len(data) < 126:
+        header = bytes([0x81, 0x80 | len(data)])
+    else:
+        header = bytes([0x81, 0x80 | 126]) + struct.pack('>H', len(data))
+    return header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+
+async def ws_read(reader):
+    """Read one message, joining continuation frames"""
+    payload = b''
+    while True:
+        first, second = await reader.readexactly(2)
+        length = second & 0x7f
+        if length == 126:
+            length = struct.unpack('>H', await reader.readexactly(2))[0]
+        elif length == 127:
+            length = struct.unpack('>Q', await reader.readexactly(8))[0]
+        payload += await reader.readexactly(length)
+        if first & 0x80:
+            return payload
+
+class Results:
+    def __init__(self):
+        self.connected = 0
+        self.failed = 0
+        self.messages = 0
+        self.bytes = 0
+        self.fanout_ms = []
+        self.rest_ms = []
+        self.rest_errors = 0
+        self.ticks = {}
+        self.rss = []
+
+async def socket_client(port, results, stop):
+    """Connect like a dashboard and count what arrives until stop is set"""
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write((f"GET /socket.io/?EIO=4&transport=websocket HTTP/1.1\r\nHost: localhost\r\n"
+                      f"Upgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Key: {key}\r\n"
+                      f"Sec-WebSocket-Version: 13\r\n\r\n").encode())
+        await reader.readuntil(b'\r\n\r\n')
+        await ws_read(reader)  # engine.io open packet
+        writer.write(ws_frame('40'))
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError):
+        results.failed += 1
+        return
+    results.connected += 1
+    try:
+        while not stop.is_set():
+            try:
+                message = await asyncio.wait_for(ws_read(reader), 1)
+            except asyncio.TimeoutError:
+                continue
+            received = time.time()
+            if message == b'2':
+                writer.write(ws_frame('3'))
+                continue
+            results.messages += 1
+            results.bytes += len(message)
+            if message.startswith(TICK_EVENTS):
+                stamp = STAMP.search(message)
+                if stamp:
+                    results.fanout_ms.append((received - datetime.fromisoformat(stamp.group(1).decode()).timestamp()) * 1000)
+    except (OSError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+async def rest_loop(port, mix, results, stop, rng):
+    paths, weights = zip(*mix)
+    reader, writer = await open_http(port)
+    while not stop.is_set():
+        path = rng.choices(paths, weights)[0]
+        start = time.perf_counter()
+        try:
+            status, body = await http_get(reader, writer, path)
+        except (OSError, asyncio.IncompleteReadError):
+            results.rest_errors += 1
+            reader, writer = await open_http(port)
+            continue
+        if status != 200:
+            results.rest_errors += 1
+        else:
+            results.rest_ms.append((time.perf_counter() - start) * 1000)
+    writer.close()
+
+async def sample_server(port, pid, results, stop):
+    """Sample the scheduler's job durations and the server's memory twice a second"""
+    reader, writer = await open_http(port)
+    last_runs = {}
+    while not stop.is_set():
+        results.rss.append(rss_mb(pid))
+        status, body = await http_get(reader, writer, '/_admin/scheduler')
+        for name, job in json.loads(body)['jobs'].items():
+            if job['runs'] != last_runs.get(name):
+                last_runs[name] = job['runs']
+                samples = results.ticks.setdefault(name, {'durations': [], 'stats': None})
+                samples['durations'].append(job['last_duration_ms'])
+                samples['stats'] = job
+        await asyncio.sleep(0.5)
+    writer.close()
+
+async def wait_until_up(port, process, timeout=600):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}")
+        try:
+            reader, writer = await open_http(port)
+            status, body = await http_get(reader, writer, '/_admin/scheduler')
+            writer.close()
+            if status == 200:
+                return
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError("Server did not come up")
+
+async def run_load(args, process, mix):
+    results = Results()
+    stop = asyncio.Event()
+    started = time.monotonic()
+    await wait_until_up(args.port, process)
+    startup = time.monotonic() - started
+
+    tasks = [asyncio.create_task(sample_server(args.port, process.pid, results, stop))]
+    for n in range(args.clients):
+        tasks.append(asyncio.create_task(socket_client(args.port, results, stop)))
+        # Connect in batches so the listen backlog keeps up
+        if n % 100 == 99:
+            await asyncio.sleep(0.05)
+    rng = random.Random(args.seed)
+    for _ in range(args.rest_concurrency):
+        tasks.append(asyncio.create_task(rest_loop(args.port, mix, results, stop, rng)))
+
+    measured = time.monotonic()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.monotonic() - measured
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return results, startup, elapsed
+
+def default_mix(server, config_data):
+    if server == 'api':
+        return [('/api/sensors', 1)]
+    first = config_data['collections'][0]['name']
+    if server == 'api_generic':
+        return [('/api/', 1), (f"/api/{first}", 1)]
+    return [('/api/collections', 1), (f"/api/collections/{first}", 1)]
+
+def parse_mix(text):
+    mix = []
+    for part in text.split(','):
+        path, _, weight = part.partition('=')
+        mix.append(('/' + path.strip().lstrip('/'), float(weight or 1)))
+    return mix
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def report(args, mix, results, startup, elapsed, item_count):
+    rss = [value for value in results.rss if value is not None]
+    clients = max(1, results.connected)
+    return {
+        'timestamp': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'server': args.server,
+        'async_mode': args.async_mode,
+        'items': item_count,
+        'update_interval': args.interval,
+        'duration_s': round(elapsed, 3),
+        'startup_s': round(startup, 3),
+        'ticks_ms': {name: dict(summary(samples['durations']), max=samples['stats']['max_duration_ms'],
+                                runs=samples['stats']['runs'], overruns=samples['stats']['overruns'])
+                     for name, samples in results.ticks.items()},
+        'fanout_latency_ms': summary(results.fanout_ms),
+        'rest': dict(summary(results.rest_ms), concurrency=args.rest_concurrency,
+                     mix={path: weight for path, weight in mix},
+                     requests_per_s=round(len(results.rest_ms) / elapsed, 1), errors=results.rest_errors),
+        'clients': {
+            'requested': args.clients,
+            'connected': results.connected,
+            'failed': results.failed,
+            'messages_per_client_per_s': round(results.messages / clients / elapsed, 2),
+            'bytes_per_client_per_s': round(results.bytes / clients / elapsed, 1),
+        },
+        'rss_mb': {'peak': round(max(rss), 1) if rss else None, 'end': round(rss[-1], 1) if rss else None},
+    }
+
+def main():
+    args = parseArgs()
+    workdir = tempfile.mkdtemp(prefix='bench_load_')
+    try:
+        config_data = {'collections': [{'name': 'sensors'}]}
+        item_count = 3
+        if args.server in CONFIG_FILES:
+            config_data = synthetic_config(os.path.join(HERE, CONFIG_FILES[args.server]), args.items, args.interval, args.seed)
+            with open(os.path.join(workdir, CONFIG_FILES[args.server]), 'w') as f:
+                json.dump(config_data, f)
+            item_count = sum(len(c.get('items', [])) + c.get('generate', {}).get('count', 0)
+                             for c in config_data['collections'])
+        mix = parse_mix(args.rest) if args.rest else default_mix(args.server, config_data)
+
+        print(f"Benchmarking {args.server} ({args.async_mode}) with {item_count} items, {args.clients} clients "
+              f"and {args.rest_concurrency} REST loops for {args.duration:g} seconds", file=sys.stderr)
+        process = start_server(args, workdir)
+        try:
+            results, startup, elapsed = asyncio.run(run_load(args, process, mix))
+        except RuntimeError as e:
+            with open(os.path.join(workdir, 'server.log')) as f:
+                sys.stderr.write(f.read())
+            sys.exit(f"Benchmark failed: {e}")
+        finally:
+            process.terminate()
+            process.wait()
+
+        result = report(args, mix, results, startup, elapsed, item_count)
+        print(json.dumps(result, indent=2))
+        if results.rest_errors:
+            print(f"{results.rest_errors} REST requests failed, check the paths in the mix", file=sys.stderr)
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
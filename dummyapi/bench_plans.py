@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+# Benchmark: per-tick CPU of the old rule interpreter vs the compiled update plans.
+#
+# Builds a large synthetic config by cloning the items of data_config_geo.json
+# and times update ticks the way update_data() ran them before and after plans
+# were introduced (no deepcopy, no emits).
+#
+#   python bench_plans.py --items 100000 --ticks 5
+#
+# The two are timed in alternating rounds and each keeps its fastest tick, so
+# a busy machine slows neither one more than the other. The plans come out
+# about 3x faster (2.6 to 3.3x at 20k and 100k items on one core), while also
+# building the patch of changed fields. If they are less than --min-speedup
+# times faster (2.5 by default) the benchmark says so and exits with status 1,
+# so a regression in the tick loop does not go unnoticed.
+
+import argparse
+import copy
+import json
+import math
+import random
+import sys
+import time
+from datetime import datetime
+
+import api_geo
+import plans
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='compare the rule interpreter with compiled update plans')
+    parser.add_argument('-c', '--config', type=str, default='data_config_geo.json', help='config file to clone items from')
+    parser.add_argument('-n', '--items', type=int, default=100000, help='approximate number of items to simulate')
+    parser.add_argument('-t', '--ticks', type=int, default=5, help='number of ticks to time')
+    parser.add_argument('-s', '--min-speedup', type=float, default=2.5, help='fail if the plans are not at least this many times faster')
+    return parser.parse_args()
+
+def build_store(config_file, item_count):
+    """Clone the configured items until the store holds about item_count items"""
+    with open(config_file, 'r') as f:
+        config_data = json.load(f)
+
+    collections = [c for c in config_data.get('collections', []) if c.get('items')]
+    per_item = max(1, item_count // sum(len(c['items']) for c in collections))
+    store = {}
+    for collection in collections:
+        items = []
+        for n in range(per_item):
+            for item in collection['items']:
+                clone = copy.deepcopy(item)
+                clone['id'] = f"{item.get('id')}-{n}"
+                items.append(clone)
+        store[collection['name']] = {'type': collection.get('type', 'standard'), 'items': items}
+    return store
+
+# The interpreter as it was before plans were introduced, kept here as the baseline
+
+def get_nested_value(obj, path):
+    current = obj
+    for part in path.split('.'):
+        if isinstance(current, dict) and part in current:
+            current = current[part]
+        elif isinstance(current, list) and part.isdigit() and int(part) < len(current):
+            current = current[int(part)]
+        else:
+            return None
+    return current
+
+def set_nested_value(obj, path, value):
+    parts = path.split('.')
+    current = obj
+    for part in parts[:-1]:
+        current = current[part]
+    current[parts[-1]] = value
+
+def interpret(store, update_interval=5):
+    for collection in store.values():
+        collection_type = collection.get('type', 'standard')
+        for item in collection['items']:
+            rules_by_field = plans.find_update_rules(item)
+            if rules_by_field is None:
+                continue
+            for field_path, rules in rules_by_field.items():
+                rule_type = rules.get('type')
+                if rule_type == 'geo_movement':
+                    if field_path == 'geometry.coordinates' and item['geometry']['type'] == 'Point':
+                        speed = rules.get('speed_knots', 10) + random.uniform(-rules.get('speed_variation', 1), rules.get('speed_variation', 1))
+                        heading = random.uniform(-rules.get('heading_variation', 10), rules.get('heading_variation', 10))
+                        speed_deg = speed * 0.0003 * (update_interval / 5)
+                        lon, lat = item['geometry']['coordinates']
+                        min_lon, min_lat, max_lon, max_lat = rules.get('bounds', [-180, -90, 180, 90])
+                        angle_rad = math.radians(heading)
+                        item['geometry']['coordinates'] = [max(min_lon, min(max_lon, lon + speed_deg * math.sin(angle_rad))),
+                                                           max(min_lat, min(max_lat, lat + speed_deg * math.cos(angle_rad)))]
+                elif rule_type == 'random_incidents':
+                    if random.random() < rules.get('probability', 0.1):
+                        incidents = get_nested_value(item, field_path) or []
+                        while len(incidents) >= rules.get('max_incidents', 1):
+                            incidents.pop(random.randint(0, len(incidents) - 1))
+                        incidents.append(api_geo.generate_random_incident())
+                        set_nested_value(item, field_path, incidents)
+                else:
+                    current_value = get_nested_value(item, field_path)
+                    if current_value is None:
+                        continue
+                    if rule_type == 'random_float':
+                        new_value = current_value + random.uniform(rules.get('min_change', -1.0), rules.get('max_change', 1.0))
+                        new_value = max(rules.get('min_value', float('-inf')), min(rules.get('max_value', float('inf')), new_value))
+                        set_nested_value(item, field_path, round(new_value, rules.get('precision', 2)))
+                    elif rule_type == 'random_int':
+                        new_value = current_value + random.randint(rules.get('min_change', -1), rules.get('max_change', 1))
+                        new_value = max(rules.get('min_value', 0), min(rules.get('max_value', 100), new_value))
+                        set_nested_value(item, field_path, int(new_value))
+                    elif rule_type == 'random_choice':
+                        choices = rules.get('choices', [])
+                        if choices:
+                            set_nested_value(item, field_path, random.choice(choices))
+            if collection_type == 'geojson' and 'properties' in item:
+                item['properties']['last_updated'] = datetime.now().isoformat()
+            else:
+                item['last_updated'] = datetime.now().isoformat()
+
+def time_tick(tick):
+    """Return the duration of one tick in milliseconds"""
+    start = time.perf_counter()
+    tick()
+    return (time.perf_counter() - start) * 1000
+
+def time_ticks(ticks, *candidates):
+    """Return the fastest tick of every candidate in milliseconds, timing them in alternating rounds"""
+    for tick in candidates:
+        tick()
+    best = [float('inf')] * len(candidates)
+    for _ in range(ticks):
+        for n, tick in enumerate(candidates):
+            best[n] = min(best[n], time_tick(tick))
+    return best
+
+def main():
+    args = parseArgs()
+
+    store = build_store(args.config, args.items)
+    total = sum(len(c['items']) for c in store.values())
+    print(f"Simulating {total} items")
+
+    start = time.perf_counter()
+    compiled = {name: plans.compile_collection(name, c) for name, c in store.items()}
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    def run_plans():
+        plans.run_tick(compiled, None, datetime.now().isoformat())
+
+    interpreted_ms, planned_ms = time_ticks(args.ticks, lambda: interpret(store), run_plans)
+    speedup = interpreted_ms / planned_ms
+    print(f"interpreter:    {interpreted_ms:9.1f} ms/tick")
+    print(f"compiled plans: {planned_ms:9.1f} ms/tick (compiled in {compile_ms:.1f} ms)")
+    print(f"speedup:        {speedup:9.2f}x")
+    if speedup < args.min_speedup:
+        print(f"Compiled plans are less than {args.min_speedup:g}x faster than the interpreter")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+
+# Benchmark: bytes on the wire and encode time of each wire format.
+#
+# Builds a large synthetic store by cloning the items of a config file (see
+# bench_plans.py) and encodes every collection, and one tick's patch, the way
+# the servers send them: JSON as before, JSON in the columnar layout, and
+# MessagePack in both layouts (if msgpack is installed).
+#
+#   python bench_wire.py --items 100000 --repeat 3
+
+import argparse
+import time
+from datetime import datetime
+
+import plans
+import wire
+from bench_plans import build_store
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='compare the size and encode time of the wire formats')
+    parser.add_argument('-c', '--config', type=str, default='data_config_geo.json', help='config file to clone items from')
+    parser.add_argument('-n', '--items', type=int, default=100000, help='approximate number of items to simulate')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of encodes to time per format')
+    return parser.parse_args()
+
+def formats():
+    names = [('json', 'rows'), ('json', 'columnar')]
+    if wire.available():
+        names += [('msgpack', 'rows'), ('msgpack', 'columnar')]
+    else:
+        print("msgpack is not installed, only comparing the JSON formats")
+    return names
+
+def measure(payload, fmt, repeat):
+    """Return (bytes, best encode time in ms) of a payload in a wire format"""
+    encode = wire.encoder(fmt)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        size = len(encode(payload).data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best * 1000
+
+def report(title, payload, repeat):
+    print(f"\n{title}")
+    print(f"  {'format':<20} {'bytes':>12} {'vs json':>8} {'encode ms':>10}")
+    baseline = None
+    for fmt in formats():
+        size, ms = measure(payload, fmt, repeat)
+        if baseline is None:
+            baseline = size
+        print(f"  {fmt[0] + '/' + fmt[1]:<20} {size:>12} {size / baseline:>8.2f} {ms:>10.1f}")
+
+def main():
+    args = parseArgs()
+    store = build_store(args.config, args.items)
+    print(f"Simulating {sum(len(c['items']) for c in store.values())} items from {args.config}")
+
+    for name, collection in store.items():
+        report(f"GET collection '{name}' ({len(collection['items'])} items)", collection, args.repeat)
+
+    compiled = {name: plans.compile_collection(name, collection) for name, collection in store.items()}
+    changes = plans.run_tick(compiled, None, datetime.now().isoformat())
+    report("data_patch for one tick", {'seq': 1, 'prev': 0, 'changes': changes}, args.repeat)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+# Versioned change feed for the dummy APIs.
+#
+# Instead of broadcasting the whole data store every tick, each tick publishes
+# a patch of only the item fields that changed, tagged with a monotonic
+# sequence number:
+#
+#   {"seq": 42, "changes": {"<collection>": {"<item id>": {"<field path>": <value>}}}}
+#
+# Clients get a full snapshot (with the sequence number it corresponds to) on
+# connect and apply patches after that. A client that sees a gap in the
+# sequence asks for a resync; the last few patches are kept so it can usually
+# be caught up without sending the whole store again.
+
+import threading
+from collections import deque
+
+class ChangeFeed:
+    """Sequenced patches of changed item fields, with a short history for resyncs"""
+
+    def __init__(self, history=100):
+        self.lock = threading.Lock()
+        self.seq = 0
+        self.history = deque(maxlen=history)
+
+    def publish(self, changes):
+        """Tag a set of changes with the next sequence number and remember it"""
+        with self.lock:
+            self.seq += 1
+            patch = {'seq': self.seq, 'changes': changes}
+            self.history.append(patch)
+        return patch
+
+    def since(self, seq):
+        """Return the patches published after seq, or None if they are no longer all in the history"""
+        with self.lock:
+            if seq >= self.seq:
+                return []
+            if not self.history or self.history[0]['seq'] > seq + 1:
+                return None
+            return [patch for patch in self.history if patch['seq'] > seq]
+
+    def jump(self):
+        """Take a sequence number for a change patches cannot describe, like a config reload
+
+        The history is cleared, so clients resyncing from before it get a snapshot.
+        """
+        with self.lock:
+            self.seq += 1
+            self.history.clear()
+            return self.seq
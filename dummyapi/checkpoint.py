@@ -0,0 +1,304 @@
+#!/usr/bin/python
+
+# Checkpoints of the simulation state, for warm restarts.
+#
+# Every few seconds a background thread writes the fields the update rules
+# change (values, coordinates, incident lists...) of every collection to a
+# binary file. On startup the servers map that file and put the saved values
+# back into the items built from the config, before the update plans are
+# compiled, so the simulation continues where it left off: vessels stay where
+# they were, sensor values keep drifting from their last reading.
+#
+# Checkpoints are written from the published snapshot (see snapshot.py),
+# which is never mutated, so writing one needs no lock and never holds up a
+# tick. The file is written next to its final name and renamed over it, so a
+# crash mid-write leaves the previous checkpoint intact.
+#
+# File layout (little-endian):
+#
+#   8 bytes   magic b'DAPICKP1'
+#   uint32    length of the JSON header
+#   header    {"seq": <feed seq>, "created": <unix time>,
+#              "collections": {<name>: {"fingerprint": ..., "count": <items>,
+#                                       "columns": [{"path", "kind", "count", "offset", "size"}]}}}
+#   columns   each 8-byte aligned, offsets from the start of the file
+#
+# A column holds one field path of the items that have it in one kind of
+# value: count uint32 item positions followed by
+#
+#   f64    count float64 values
+#   i64    count int64 values
+#   point  count (float64 lon, float64 lat) pairs
+#   json   a UTF-8 JSON list of count values (anything else)
+#
+# Numeric columns are read straight out of the mapped file. A collection is
+# only restored if its fingerprint (a hash of its entry in the config file)
+# matches, so editing a collection starts it fresh.
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+
+import plans
+from snapshot import get_path
+
+MAGIC = b'DAPICKP1'
+PREFIX = struct.Struct('<8sI')
+ALIGN = 8
+
+# Seconds between checkpoints unless the config says otherwise
+DEFAULT_INTERVAL = 30
+
+def fingerprint(collection_config):
+    """Hash a collection's entry in the config file"""
+    text = json.dumps(collection_config, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def rule_paths(items):
+    """Get the field paths any item's update rules change, in first-seen order"""
+    paths = {}
+    seen = set()
+    for item in items:
+        rules = plans.find_update_rules(item)
+        # Generated items share their rules object
+        if not isinstance(rules, dict) or id(rules) in seen:
+            continue
+        seen.add(id(rules))
+        for path in rules:
+            paths[path] = None
+    return list(paths)
+
+def kind_of(value):
+    if type(value) is float:
+        return 'f64'
+    if type(value) is int and -2**63 <= value < 2**63:
+        return 'i64'
+    if (type(value) is list and len(value) == 2
+            and type(value[0]) in (int, float) and type(value[1]) in (int, float)):
+        return 'point'
+    return 'json'
+
+def to_bytes(values):
+    """Get the bytes of an array in little-endian order"""
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+def encode_column(kind, values):
+    """Encode the values of one column"""
+    if kind == 'f64':
+        return to_bytes(array('d', values))
+    if kind == 'i64':
+        return to_bytes(array('q', values))
+    if kind == 'point':
+        flat = array('d')
+        for lon, lat in values:
+            flat.append(lon)
+            flat.append(lat)
+        return to_bytes(flat)
+    return json.dumps(values, separators=(',', ':')).encode('utf-8')
+
+def collect_columns(items, paths):
+    """Split the current values of some paths into columns: [(path, kind, positions, values)]"""
+    columns = []
+    for path in paths:
+        by_kind = {}
+        for index, item in enumerate(items):
+            value = get_path(item, path)
+            if value is None:
+                continue
+            positions, values = by_kind.setdefault(kind_of(value), (array('I'), []))
+            positions.append(index)
+            values.append(value)
+        for kind, (positions, values) in by_kind.items():
+            columns.append((path, kind, positions, values))
+    return columns
+
+def write_checkpoint(filename, seq, collections):
+    """Write a checkpoint of {name: (fingerprint, items, paths)} atomically"""
+    header = {'seq': seq, 'created': time.time(), 'collections': {}}
+    blocks = []
+    for name, (digest, items, paths) in collections.items():
+        columns = []
+        for path, kind, positions, values in collect_columns(items, paths):
+            data = to_bytes(positions)
+            # Keep the values 8-byte aligned after the uint32 positions
+            data += b'\0' * (-len(data) % ALIGN)
+            data += encode_column(kind, values)
+            columns.append({'path': path, 'kind': kind, 'count': len(positions), 'size': len(data)})
+            blocks.append(data)
+        header['collections'][name] = {'fingerprint': digest, 'count': len(items), 'columns': columns}
+
+    # Offsets depend on the header's length, which depends on the offsets;
+    # reserve room for them by sizing the header with large placeholders
+    column_headers = [column for entry in header['collections'].values() for column in entry['columns']]
+    for column in column_headers:
+        column['offset'] = 10 ** 15
+    start = PREFIX.size + len(json.dumps(header).encode('utf-8'))
+    start += -start % ALIGN
+    offset = start
+    for column, data in zip(column_headers, blocks):
+        column['offset'] = offset
+        offset += len(data) + (-len(data) % ALIGN)
+    header_bytes = json.dumps(header).encode('utf-8')
+
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary, 'wb') as f:
+        f.write(PREFIX.pack(MAGIC, len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\0' * (start - PREFIX.size - len(header_bytes)))
+        for data in blocks:
+            f.write(data)
+            f.write(b'\0' * (-len(data) % ALIGN))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, filename)
+
+def setter(path):
+    """Get a function that sets a dot-separated path of an item, if the item has it"""
+    parts = path.split('.')
+    if len(parts) == 1:
+        key = parts[0]
+        def assign(item, value):
+            item[key] = value
+    elif len(parts) == 2:
+        # e.g. geometry.coordinates or properties.speed, without resolving the path every time
+        outer, key = parts
+        def assign(item, value):
+            container = item.get(outer)
+            if isinstance(container, dict):
+                container[key] = value
+    else:
+        def assign(item, value):
+            target = plans.resolve(item, path)
+            if target is not None:
+                target[0][target[1]] = value
+    return assign
+
+def numbers(view, typecode):
+    """View little-endian numbers in a buffer, copying them only on big-endian machines"""
+    if sys.byteorder == 'little':
+        return view.cast(typecode)
+    values = array(typecode, bytes(view))
+    values.byteswap()
+    return values
+
+class Checkpoint:
+    """A checkpoint file mapped into memory"""
+
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, header_size = PREFIX.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                raise ValueError(f"{filename} is not a checkpoint")
+            self.header = json.loads(self.map[PREFIX.size:PREFIX.size + header_size])
+        except Exception:
+            self.close()
+            raise
+        self.seq = self.header['seq']
+        self.created = self.header['created']
+
+    def close(self):
+        if getattr(self, 'map', None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def column_values(self, column):
+        """Get (positions, values) of a column, reading numbers straight from the map"""
+        view = memoryview(self.map)[column['offset']:column['offset'] + column['size']]
+        count = column['count']
+        positions_size = 4 * count
+        positions = numbers(view[:positions_size], 'I')
+        values = view[positions_size + (-positions_size % ALIGN):]
+        kind = column['kind']
+        if kind == 'f64':
+            return positions, numbers(values, 'd')
+        if kind == 'i64':
+            return positions, numbers(values, 'q')
+        if kind == 'point':
+            flat = iter(numbers(values, 'd').tolist())
+            return positions, [[lon, lat] for lon, lat in zip(flat, flat)]
+        return positions, json.loads(bytes(values).rstrip(b'\0'))
+
+    def restore(self, name, items, digest):
+        """Put a collection's saved values back into its items; return how many fields were restored, or None"""
+        entry = self.header['collections'].get(name)
+        if entry is None or entry['fingerprint'] != digest or entry['count'] != len(items):
+            return None
+        restored = 0
+        for column in entry['columns']:
+            positions, values = self.column_values(column)
+            assign = setter(column['path'])
+            # Converted in one go, indexing the mapped numbers one by one is slower
+            if not isinstance(values, list):
+                values = values.tolist()
+            for index, value in zip(positions.tolist(), values):
+                assign(items[index], value)
+            restored += column['count']
+        return restored
+
+def load(filename):
+    """Map a checkpoint file, or return None if there is no usable one"""
+    if not filename or not os.path.exists(filename):
+        return None
+    try:
+        return Checkpoint(filename)
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Ignoring checkpoint {filename}: {e}")
+        return None
+
+class Checkpointer:
+    """Background thread that writes a checkpoint every interval seconds when the state changed"""
+
+    def __init__(self, filename, interval, collect):
+        # collect() returns (seq, {name: (fingerprint, items, paths)}) from an immutable snapshot
+        self.filename = filename
+        self.interval = interval
+        self.collect = collect
+        self.last_seq = None
+        self.stopped = threading.Event()
+        self.write_lock = threading.Lock()
+        self.thread = None
+        self.writes = 0
+        self.last_duration = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='checkpointer', daemon=True)
+            self.thread.start()
+
+    def stop(self, final=True):
+        """Stop the thread, writing one last checkpoint if the state changed"""
+        self.stopped.set()
+        if final:
+            self.write()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write()
+            except Exception as e:
+                print(f"Error writing checkpoint: {str(e)}")
+
+    def write(self):
+        """Write a checkpoint now unless nothing changed since the last one"""
+        with self.write_lock:
+            seq, collections = self.collect()
+            if seq == self.last_seq:
+                return False
+            started = time.perf_counter()
+            write_checkpoint(self.filename, seq, collections)
+            self.last_duration = time.perf_counter() - started
+            self.last_seq = seq
+            self.writes += 1
+            return True
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+# Columnar simulation engine for the dummy APIs.
+#
+# The random_float, random_int and random_choice update rules are turned into
+# NumPy arrays once (when the config is loaded) and then advanced for every
+# item in a single batched step per tick. The item dicts in the data store are
+# still the JSON views served over REST and Socket.IO; after each step the
+# values that changed are written back into them, so clients see exactly the
+# same shape.
+#
+# Every other rule type is still run by the compiled plans in plans.py.
+# NumPy is optional. If it is not installed the servers keep using the plans
+# for every rule.
+
+import json
+
+import plans
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Rule types this engine knows how to batch
+COLUMNAR_RULES = ('random_float', 'random_int', 'random_choice')
+
+def available():
+    """Return True if NumPy is installed and the columnar engine can be used"""
+    return np is not None
+
+# How close to a half a scaled value has to be for np.round and round() to maybe disagree
+HALF_TOLERANCE = 1e-6
+
+def round_like_python(values, precision):
+    """Round an array in place to exactly what round(value, precision) gives
+
+    np.round scales, rounds half to even and scales back, so it can pick the
+    other neighbour of a value that is (nearly) halfway, where round() works
+    on the exact decimal value. Only those few values are redone with round().
+    """
+    scaled = values * 10.0 ** precision
+    near_half = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < HALF_TOLERANCE)
+    originals = values[near_half].tolist()
+    np.round(values, precision, out=values)
+    for index, value in zip(near_half.tolist(), originals):
+        values[index] = round(value, precision)
+    return values
+
+class FloatColumn:
+    """All random_float fields sharing the same precision"""
+
+    def __init__(self, precision):
+        self.precision = precision
+        self.targets = []
+        self.values = []
+        self.min_change = []
+        self.max_change = []
+        self.min_value = []
+        self.max_value = []
+
+    def add(self, target, value, rules):
+        self.targets.append(target)
+        self.values.append(value)
+        self.min_change.append(rules.get('min_change', -1.0))
+        self.max_change.append(rules.get('max_change', 1.0))
+        self.min_value.append(rules.get('min_value', float('-inf')))
+        self.max_value.append(rules.get('max_value', float('inf')))
+
+    def freeze(self):
+        self.values = np.array(self.values, dtype=np.float64)
+        self.min_change = np.array(self.min_change, dtype=np.float64)
+        self.max_change = np.array(self.max_change, dtype=np.float64)
+        self.min_value = np.array(self.min_value, dtype=np.float64)
+        self.max_value = np.array(self.max_value, dtype=np.float64)
+
+    def step(self, rng):
+        values = self.values + rng.uniform(self.min_change, self.max_change)
+        np.clip(values, self.min_value, self.max_value, out=values)
+        if self.precision is not None:
+            round_like_python(values, self.precision)
+        changed = np.flatnonzero(values != self.values)
+        self.values = values
+        return changed.tolist(), values[changed].tolist()
+
+class IntColumn:
+    """All random_int fields"""
+
+    def __init__(self):
+        self.targets = []
+        self.values = []
+        self.min_change = []
+        self.max_change = []
+        self.min_value = []
+        self.max_value = []
+
+    def add(self, target, value, rules):
+        self.targets.append(target)
+        self.values.append(value)
+        self.min_change.append(rules.get('min_change', -1))
+        self.max_change.append(rules.get('max_change', 1))
+        self.min_value.append(rules.get('min_value', 0))
+        self.max_value.append(rules.get('max_value', 100))
+
+    def freeze(self):
+        self.values = np.array(self.values, dtype=np.float64)
+        self.min_change = np.array(self.min_change, dtype=np.int64)
+        # randint() is inclusive on both ends, integers() is not
+        self.max_change = np.array(self.max_change, dtype=np.int64) + 1
+        self.min_value = np.array(self.min_value, dtype=np.float64)
+        self.max_value = np.array(self.max_value, dtype=np.float64)
+
+    def step(self, rng):
+        values = self.values + rng.integers(self.min_change, self.max_change)
+        np.clip(values, self.min_value, self.max_value, out=values)
+        values = np.trunc(values)
+        changed = np.flatnonzero(values != self.values)
+        self.values = values
+        return changed.tolist(), values[changed].astype(np.int64).tolist()
+
+class ChoiceColumn:
+    """All random_choice fields sharing the same list of choices"""
+
+    def __init__(self, choices):
+        self.choices = choices
+        self.targets = []
+        self.values = []
+
+    def add(self, target, value, rules):
+        self.targets.append(target)
+        # Index of the current value in choices, -1 if it is not one of them
+        self.values.append(self.choices.index(value) if value in self.choices else -1)
+
+    def freeze(self):
+        self.values = np.array(self.values, dtype=np.int64)
+
+    def step(self, rng):
+        values = rng.integers(0, len(self.choices), size=len(self.targets))
+        changed = np.flatnonzero(values != self.values)
+        self.values = values
+        choices = self.choices
+        return changed.tolist(), [choices[i] for i in values[changed].tolist()]
+
+class ColumnarEngine:
+    """Batched replacement for the per-item random_float/random_int/random_choice interpreter"""
+
+    def __init__(self, item_plans, seed=None):
+        self.rng = np.random.default_rng(seed)
+        self.columns = {}
+
+        for compiled in item_plans.values():
+            for plan in compiled:
+                for field, rules in plan.rules.items():
+                    if rules.get('type') in COLUMNAR_RULES:
+                        self.add_field(plan, field, rules)
+
+        for column in self.columns.values():
+            column.freeze()
+
+    def add_field(self, plan, field, rules):
+        """Register one item field with the column for its rule"""
+        target = plans.resolve_value(plan.item, field)
+        if target is None:
+            return
+
+        value = target[0][target[1]]
+        rule_type = rules['type']
+
+        if rule_type == 'random_float':
+            precision = rules.get('precision', 2)
+            key = (rule_type, precision)
+            if key not in self.columns:
+                self.columns[key] = FloatColumn(precision)
+        elif rule_type == 'random_int':
+            key = (rule_type,)
+            if key not in self.columns:
+                self.columns[key] = IntColumn()
+        else:
+            choices = rules.get('choices', [])
+            if not choices:
+                return
+            key = (rule_type, json.dumps(choices, sort_keys=True))
+            if key not in self.columns:
+                self.columns[key] = ChoiceColumn(list(choices))
+
+        self.columns[key].add((plan, field) + target, value, rules)
+
+    def step(self, patch, timestamp):
+        """Advance every columnar field by one tick, writing changed values back into the items
+
+        Changed fields are added to the tick's patch (collection -> item id ->
+        field path -> value) next to the plans' own changes, and the items they
+        belong to are stamped, like ItemPlan.run() does.
+        """
+        for column in self.columns.values():
+            targets = column.targets
+            indexes, values = column.step(self.rng)
+            for index, value in zip(indexes, values):
+                plan, field, container, key = targets[index]
+                container[key] = value
+                collection_patch = patch.get(plan.collection)
+                if collection_patch is None:
+                    collection_patch = patch[plan.collection] = {}
+                fields = collection_patch.get(plan.item_id)
+                if fields is None:
+                    fields = collection_patch[plan.item_id] = {}
+                    plan.stamp['last_updated'] = fields[plan.stamp_path] = timestamp
+                fields[field] = value
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# Synthetic collections for the dummy APIs.
+#
+# Instead of writing out every item, a collection in the config file can have
+# a generator that expands a template into any number of items when the
+# config is loaded:
+#
+#   {
+#     "name": "sensors",
+#     "generate": {
+#       "count": 500000,
+#       "id_pattern": "temp-{n:06}",
+#       "seed": 42,
+#       "template": {
+#         "name": {"$gen": "format", "pattern": "Temperature Sensor {n}"},
+#         "type": "temperature",
+#         "value": {"$gen": "float", "min": 15, "max": 30, "precision": 2},
+#         "status": {"$gen": "choice", "choices": ["online", "offline"], "weights": [9, 1]},
+#         "update_rules": {...}
+#       }
+#     }
+#   }
+#
+# Template values are copied as they are, except for generator specs (objects
+# with a "$gen" key):
+#
+#   float     min, max, precision    uniform random number
+#   int       min, max               uniform random integer (inclusive)
+#   choice    choices, weights       random pick, optionally weighted
+#   point     bounds, distribution   [lon, lat] inside [minLon, minLat, maxLon, maxLat];
+#                                    distribution "uniform" (default) or "clustered"
+#                                    (clusters, spread: gaussian blobs around random centres)
+#   sequence  start                  the item number plus start (0 by default)
+#   format    pattern                str.format(pattern, n=<item number>)
+#
+# Items are numbered from "start" (1 by default) and get their id from
+# id_pattern. Generated items follow any items listed in the collection.
+# Generators without a "seed" are seeded from the servers' config['seed'], if
+# it is set.
+#
+# The template is compiled once into builders, so expanding it only creates
+# the per-item dicts. Constant parts that are never changed in place are
+# shared by every item instead of copied: update_rules objects (plans only
+# read them) and constant lists of plain values (update steps replace values,
+# they never modify them, see plans.py).
+#
+# generate_items() is lazy, but expand_collection() still builds the whole
+# list: the data store keeps every item for the REST reads, snapshots and
+# indexes, and the plans and columnar engine hold references into each one,
+# so nothing would be freed by feeding the compile step from the generator.
+# What expansion avoids is a second copy: items are built straight into the
+# store's list, never into an intermediate one.
+
+import bisect
+import gc
+import itertools
+import random
+
+# Key that marks a template value as a generator spec
+GEN_KEY = '$gen'
+
+# Gaussian offsets drawn per clustered point generator
+OFFSET_TABLE_SIZE = 4096
+
+def is_spec(value):
+    return isinstance(value, dict) and GEN_KEY in value
+
+def is_shareable(value):
+    """Check whether a template value can be the same object in every item
+
+    Plain values and constant lists of plain values are, since update steps
+    replace them. Dicts are not: steps write into an item's nested dicts.
+    """
+    if isinstance(value, dict):
+        return False
+    if isinstance(value, list):
+        return all(not isinstance(child, (dict, list)) for child in value)
+    return True
+
+def compile_spec(spec, rng):
+    """Compile a generator spec into a function of the item number"""
+    kind = spec[GEN_KEY]
+    rnd = rng.random
+
+    if kind == 'float':
+        low = spec.get('min', 0.0)
+        span = spec.get('max', 1.0) - low
+        precision = spec.get('precision', 2)
+        return lambda n: round(low + span * rnd(), precision)
+
+    if kind == 'int':
+        low = int(spec.get('min', 0))
+        count = int(spec.get('max', 100)) - low + 1
+        return lambda n: low + int(rnd() * count)
+
+    if kind == 'choice':
+        choices = spec['choices']
+        weights = spec.get('weights')
+        if weights is None:
+            size = len(choices)
+            return lambda n: choices[int(rnd() * size)]
+        cumulative = list(itertools.accumulate(weights))
+        total = cumulative[-1]
+        return lambda n: choices[bisect.bisect_right(cumulative, rnd() * total)]
+
+    if kind == 'point':
+        min_lon, min_lat, max_lon, max_lat = spec.get('bounds', [-180, -90, 180, 90])
+        lon_span = max_lon - min_lon
+        lat_span = max_lat - min_lat
+        if spec.get('distribution', 'uniform') == 'clustered':
+            centres = [(min_lon + lon_span * rnd(), min_lat + lat_span * rnd())
+                       for _ in range(max(1, spec.get('clusters', 5)))]
+            spread = spec.get('spread', max(lon_span, lat_span) / 20)
+            # Drawing gaussians is the slowest part of a big expansion, so
+            # points pick from a table of offsets drawn up front
+            offsets = [(rng.gauss(0, spread), rng.gauss(0, spread)) for _ in range(OFFSET_TABLE_SIZE)]
+            size = len(centres)
+
+            def clustered(n):
+                lon, lat = centres[int(rnd() * size)]
+                dlon, dlat = offsets[int(rnd() * OFFSET_TABLE_SIZE)]
+                return [round(max(min_lon, min(max_lon, lon + dlon)), 6),
+                        round(max(min_lat, min(max_lat, lat + dlat)), 6)]
+            return clustered
+        return lambda n: [round(min_lon + lon_span * rnd(), 6), round(min_lat + lat_span * rnd(), 6)]
+
+    if kind == 'sequence':
+        start = spec.get('start', 0)
+        return lambda n: n + start
+
+    if kind == 'format':
+        pattern = spec['pattern'].format
+        return lambda n: pattern(n=n)
+
+    raise ValueError(f"Unknown generator '{kind}'")
+
+def compile_template(template, rng):
+    """Compile a template value into a function of the item number"""
+    if is_spec(template):
+        return compile_spec(template, rng)
+
+    if isinstance(template, dict):
+        # Constant keys are copied in one go, only the rest are built per item
+        static = {}
+        dynamic = []
+        for key, value in template.items():
+            if key == 'update_rules' or is_shareable(value):
+                static[key] = value
+            else:
+                dynamic.append((key, compile_template(value, rng)))
+
+        def build_dict(n):
+            result = dict(static)
+            for key, build in dynamic:
+                result[key] = build(n)
+            return result
+        return build_dict
+
+    if isinstance(template, list):
+        builders = [compile_template(value, rng) for value in template]
+        return lambda n: [build(n) for build in builders]
+
+    return lambda n: template
+
+def generate_items(spec, default_seed=None):
+    """Yield the items described by a collection's "generate" block, one at a time"""
+    count = spec.get('count', 0)
+    if not isinstance(count, int) or count < 0:
+        raise ValueError(f"Invalid generate count '{count}'")
+    rng = random.Random(spec.get('seed', default_seed))
+    build = compile_template(spec.get('template', {}), rng)
+    id_pattern = spec.get('id_pattern', 'item-{n}').format
+    start = spec.get('start', 1)
+
+    for n in range(start, start + count):
+        item = build(n)
+        item['id'] = id_pattern(n=n)
+        yield item
+
+def expand_collection(collection, default_seed=None):
+    """Get a config collection's items, including the ones its generator describes
+
+    Generators without a seed of their own use default_seed, or a random one
+    if that is None too.
+    """
+    items = collection.get('items', [])
+    spec = collection.get('generate')
+    if spec:
+        items = list(items)
+        # Nothing created here is garbage, so the cyclic collector would only
+        # rescan the growing list over and over
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            items.extend(generate_items(spec, default_seed))
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+    return items
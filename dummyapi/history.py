@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+# Time-series history of the numeric fields the dummy APIs update.
+#
+# Every numeric field an update changes gets a bounded ring buffer of
+# (time, value) samples, kept in two array('d') columns: 16 bytes per sample,
+# where a dict per sample would cost a few hundred. Buffers are created on a
+# field's first sample and grow up to their capacity, after which the oldest
+# sample is overwritten.
+#
+# The history endpoints read a field's samples after an optional ?since= and
+# downsample them on the server when there are more than ?max_points=:
+#
+#   method=lttb    (default) Largest-Triangle-Three-Buckets, keeps max_points
+#                  real samples that preserve the shape of the line
+#   method=minmax  max_points buckets of equal width in time, each with its
+#                  min, max and mean, for drawing bands
+#
+# Times are Unix timestamps in seconds.
+
+import bisect
+import threading
+from array import array
+from datetime import datetime
+
+# Samples kept per field unless the config says otherwise
+DEFAULT_SIZE = 120
+
+# Default cap on the points one history response returns
+DEFAULT_MAX_POINTS = 500
+
+METHODS = ('lttb', 'minmax')
+
+class HistoryError(ValueError):
+    """Invalid history parameters"""
+
+class RingBuffer:
+    """Last samples of one field, oldest first once the buffer wraps at start"""
+
+    __slots__ = ('capacity', 'times', 'values', 'start')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d')
+        self.values = array('d')
+        # Position of the oldest sample once the buffer is full
+        self.start = 0
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, timestamp, value):
+        if len(self.times) < self.capacity:
+            self.times.append(timestamp)
+            self.values.append(value)
+            return
+        start = self.start
+        self.times[start] = timestamp
+        self.values[start] = value
+        self.start = (start + 1) % self.capacity
+
+    def samples(self, since=None):
+        """Return (times, values) in time order, only after since if given"""
+        start = self.start
+        times = self.times[start:] + self.times[:start]
+        values = self.values[start:] + self.values[:start]
+        if since is not None:
+            first = bisect.bisect_right(times, since)
+            times = times[first:]
+            values = values[first:]
+        return times, values
+
+def is_number(value):
+    return type(value) is float or type(value) is int
+
+class HistoryStore:
+    """Ring buffers by collection, item id and field path"""
+
+    def __init__(self, sizes=None, ignore=()):
+        # Samples kept per field, by collection name; 0 turns history off
+        self.sizes = sizes or {}
+        # Numeric field paths that are not values, like epoch-ms timestamps
+        self.ignore = frozenset(ignore)
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def record(self, timestamp, changes):
+        """Add the numeric values of a patch's changes (collection -> item id -> path -> value)"""
+        ignore = self.ignore
+        with self.lock:
+            for collection_name, item_changes in changes.items():
+                size = self.sizes.get(collection_name, 0)
+                if not size:
+                    continue
+                by_item = self.buffers.setdefault(collection_name, {})
+                for item_id, fields in item_changes.items():
+                    by_field = by_item.get(item_id)
+                    for path, value in fields.items():
+                        if not is_number(value) or path in ignore:
+                            continue
+                        if by_field is None:
+                            by_field = by_item[item_id] = {}
+                        buffer = by_field.get(path)
+                        if buffer is None:
+                            buffer = by_field[path] = RingBuffer(size)
+                        buffer.append(timestamp, value)
+
+    def resize(self, sizes):
+        """Take new sizes by collection name, dropping the history of collections whose size changed"""
+        with self.lock:
+            for collection_name in list(self.buffers):
+                if sizes.get(collection_name, 0) != self.sizes.get(collection_name, 0):
+                    del self.buffers[collection_name]
+            self.sizes = sizes
+
+    def drop(self, collection_name, item_ids):
+        """Forget the history of some items of a collection"""
+        with self.lock:
+            by_item = self.buffers.get(collection_name, {})
+            for item_id in item_ids:
+                by_item.pop(item_id, None)
+
+    def fields(self, collection_name, item_id):
+        """Get the field paths an item has history for"""
+        with self.lock:
+            return list(self.buffers.get(collection_name, {}).get(item_id, {}))
+
+    def samples(self, collection_name, item_id, path, since=None):
+        """Return (times, values) of one field, or None if it has no history"""
+        with self.lock:
+            buffer = self.buffers.get(collection_name, {}).get(item_id, {}).get(path)
+            if buffer is None:
+                return None
+            return buffer.samples(since)
+
+def lttb(times, values, threshold):
+    """Downsample to threshold points with Largest-Triangle-Three-Buckets"""
+    count = len(times)
+    if threshold >= count or threshold < 3:
+        if threshold < 3 and count > threshold:
+            # Too few points for triangles: keep the ends
+            picks = [0, count - 1][:threshold]
+            return [times[i] for i in picks], [values[i] for i in picks]
+        return list(times), list(values)
+
+    sampled_times = [times[0]]
+    sampled_values = [values[0]]
+    # The points between the first and the last, split into threshold - 2 buckets
+    every = (count - 2) / (threshold - 2)
+    a = 0
+    for bucket in range(threshold - 2):
+        # Average of the next bucket, the third corner of the triangles
+        next_start = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count)
+        span = next_end - next_start
+        avg_time = sum(times[next_start:next_end]) / span
+        avg_value = sum(values[next_start:next_end]) / span
+
+        # Keep the point of this bucket with the largest triangle
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        a_time = times[a]
+        a_value = values[a]
+        best = start
+        best_area = -1.0
+        for index in range(start, end):
+            area = abs((a_time - avg_time) * (values[index] - a_value)
+                       - (a_time - times[index]) * (avg_value - a_value))
+            if area > best_area:
+                best_area = area
+                best = index
+        sampled_times.append(times[best])
+        sampled_values.append(values[best])
+        a = best
+
+    sampled_times.append(times[-1])
+    sampled_values.append(values[-1])
+    return sampled_times, sampled_values
+
+def min_max_buckets(times, values, buckets):
+    """Split samples into buckets of equal width in time, returning their start time, min, max and mean"""
+    result = {'times': [], 'min': [], 'max': [], 'mean': []}
+    if not times:
+        return result
+    first = times[0]
+    width = (times[-1] - first) / buckets or 1.0
+    current = None
+    total = 0.0
+    count = 0
+    for timestamp, value in zip(times, values):
+        bucket = min(int((timestamp - first) / width), buckets - 1)
+        if bucket != current:
+            if current is not None:
+                result['mean'][-1] = total / count
+            current = bucket
+            total = 0.0
+            count = 0
+            result['times'].append(first + bucket * width)
+            result['min'].append(value)
+            result['max'].append(value)
+            result['mean'].append(None)
+        if value < result['min'][-1]:
+            result['min'][-1] = value
+        elif value > result['max'][-1]:
+            result['max'][-1] = value
+        total += value
+        count += 1
+    result['mean'][-1] = total / count
+    return result
+
+def parse_since(text):
+    """Parse ?since= as Unix seconds or an ISO 8601 time"""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise HistoryError(f"Invalid since '{text}', expected Unix seconds or an ISO 8601 time")
+
+class HistoryQuery:
+    """Parsed parameters of a history request"""
+
+    def __init__(self, args):
+        self.field = args.get('field') or None
+
+        since = args.get('since')
+        self.since = parse_since(since) if since else None
+
+        max_points = args.get('max_points')
+        try:
+            self.max_points = int(max_points) if max_points is not None else DEFAULT_MAX_POINTS
+        except ValueError:
+            raise HistoryError("max_points must be an integer")
+        if self.max_points < 1:
+            raise HistoryError("max_points must be at least 1")
+
+        self.method = args.get('method', 'lttb').lower()
+        if self.method not in METHODS:
+            raise HistoryError(f"Unknown method '{self.method}', expected one of {', '.join(METHODS)}")
+
+    def series(self, store, collection_name, item_id, path):
+        """Get one field's samples after downsampling, or None if it has no history"""
+        samples = store.samples(collection_name, item_id, path, self.since)
+        if samples is None:
+            return None
+        times, values = samples
+        if self.method == 'minmax':
+            if len(times) <= self.max_points:
+                return {'times': list(times), 'min': list(values), 'max': list(values), 'mean': list(values)}
+            return min_max_buckets(times, values, self.max_points)
+        times, values = lttb(times, values, self.max_points)
+        return {'times': times, 'values': values}
+
+    def run(self, store, collection_name, item_id):
+        """Return the history of the requested field (or of every field) of an item, or None if there is none"""
+        paths = [self.field] if self.field else store.fields(collection_name, item_id)
+        fields = {}
+        for path in paths:
+            series = self.series(store, collection_name, item_id, path)
+            if series is not None:
+                fields[path] = series
+        if not fields:
+            return None
+        return {'method': self.method, 'fields': fields}
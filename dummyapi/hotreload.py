@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# Reloading the config file of a running server.
+#
+# A watcher thread looks at the config file every reload_interval seconds
+# (1 by default, 0 turns it off). When its contents change, the server diffs
+# the new config against the one it runs and applies the difference to the
+# live store between two ticks, without restarting or disconnecting anyone:
+#
+#   unchanged collections  are not touched at all
+#   added collections      are built as on startup
+#   removed collections    are dropped, with their jobs, indexes and history
+#   changed collections    keep the items whose entry in the config did not
+#                          change, with their current values and compiled
+#                          update plans; items that are new or changed are
+#                          taken from the config as on startup, and items no
+#                          longer listed are dropped. Generated items are
+#                          kept unless the generator (or the seed) changed,
+#                          in which case they are all generated again.
+#
+# Changing a setting collections inherit from the config block (see
+# INHERITED_KEYS) changes every collection. Settings that only take effect
+# on startup (see RESTART_KEYS) are reported instead of applied.
+#
+# Indexes, update jobs and spatial indexes are rebuilt only for the
+# collections that changed. The reload then takes a new sequence number and
+# clears the patch history, and every Socket.IO subscription group (and
+# viewport, and position stream) that covers a changed collection gets a new
+# snapshot of it. Clients asking to resync from before the reload also get a
+# snapshot.
+#
+# The diff runs against the previous contents of the file rather than the
+# live store, since the store's values move with every tick.
+
+import json
+import os
+import threading
+import time
+
+# Seconds between looks at the config file unless config['reload_interval'] says otherwise
+RELOAD_INTERVAL = 1
+
+# Config settings every collection inherits unless it sets its own
+INHERITED_KEYS = ('update_interval', 'history_size', 'seed', 'engine', 'spatial_cell_size', 'cluster_below_zoom')
+
+# Config settings that only take effect when the server starts
+RESTART_KEYS = ('replay_file', 'replay_speed', 'record_file', 'checkpoint_file', 'checkpoint_interval', 'workers',
+                'shared_memory_mb', 'shared_snapshot_interval', 'sim_speed', 'sim_start')
+
+class ConfigDiff:
+    """What changed between two versions of a config file"""
+
+    def __init__(self, old_data, new_data):
+        old_config = old_data.get('config', {})
+        new_config = new_data.get('config', {})
+        self.old = {collection['name']: collection for collection in old_data.get('collections', [])
+                    if collection.get('name')}
+        self.new = {collection['name']: collection for collection in new_data.get('collections', [])
+                    if collection.get('name')}
+        self.restart = [key for key in RESTART_KEYS if old_config.get(key) != new_config.get(key)]
+        # Every collection changes with the settings they inherit
+        self.inherited = [key for key in INHERITED_KEYS if old_config.get(key) != new_config.get(key)]
+        self.seed_changed = old_config.get('seed') != new_config.get('seed')
+
+        self.added = [name for name in self.new if name not in self.old]
+        self.removed = [name for name in self.old if name not in self.new]
+        self.changed = [name for name in self.new if name in self.old
+                        and (self.inherited or self.old[name] != self.new[name])]
+
+    def names(self):
+        """Every collection that was added, removed or changed"""
+        return self.added + self.removed + self.changed
+
+    def settings_changed(self, name):
+        """Whether a changed collection's own settings (anything but its items) or the inherited ones changed"""
+        old = {key: value for key, value in self.old[name].items() if key not in ('items', 'generate')}
+        new = {key: value for key, value in self.new[name].items() if key not in ('items', 'generate')}
+        return bool(self.inherited) or old != new
+
+    def regenerate(self, name):
+        """Whether a changed collection's generated items must be generated again"""
+        old, new = self.old[name], self.new[name]
+        if old.get('generate') != new.get('generate'):
+            return True
+        return self.seed_changed and bool(new.get('generate')) and 'seed' not in new['generate']
+
+    def summary(self):
+        return f"{len(self.added)} added, {len(self.removed)} removed, {len(self.changed)} changed collections"
+
+def merge_items(old_entry, new_entry, live_items, regenerate, generate):
+    """Work out the items of a changed collection, returning (items, fresh items)
+
+    Listed items whose config entry is the same (by id, or by position for
+    items without one) stay the live items. So do the generated items
+    unless regenerate is set, in which case generate() makes new ones. The
+    other items come from the new entry; they are the fresh ones.
+    """
+    old_listed = old_entry.get('items', [])
+    old_by_id = {item.get('id', index): item for index, item in enumerate(old_listed)}
+    # The live store has the listed items first, then the generated ones
+    live_by_id = {item.get('id', index): item for index, item in enumerate(live_items[:len(old_listed)])}
+
+    items = []
+    fresh = []
+    for index, item in enumerate(new_entry.get('items', [])):
+        item_id = item.get('id', index)
+        live = live_by_id.get(item_id)
+        if live is not None and old_by_id.get(item_id) == item:
+            items.append(live)
+        else:
+            items.append(item)
+            fresh.append(item)
+
+    if regenerate:
+        generated = generate()
+        items.extend(generated)
+        fresh.extend(generated)
+    else:
+        items.extend(live_items[len(old_listed):])
+    return items, fresh
+
+class ConfigWatcher:
+    """Background thread that calls on_change(text, config data) when the config file changes"""
+
+    def __init__(self, filename, interval, text, on_change):
+        # text is the contents the server was started with
+        self.filename = filename
+        self.interval = interval
+        self.text = text
+        self.on_change = on_change
+        self.stat = self.file_stat()
+        self.thread = threading.Thread(target=self.run, name='config-watcher', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def file_stat(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def check(self):
+        stat = self.file_stat()
+        if stat is None or stat == self.stat:
+            return
+        self.stat = stat
+        with open(self.filename, 'r') as f:
+            text = f.read()
+        if text == self.text:
+            return
+        try:
+            config_data = json.loads(text)
+        except ValueError as e:
+            # Probably saved halfway, the next save will be picked up
+            print(f"Not reloading {self.filename}: {str(e)}")
+            return
+        self.text = text
+        self.on_change(text, config_data)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Error watching {self.filename}: {str(e)}")
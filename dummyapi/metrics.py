@@ -0,0 +1,220 @@
+#!/usr/bin/python
+
+# Prometheus metrics for the dummy API servers.
+#
+# Every server serves GET /metrics in the Prometheus text format:
+#
+#   dummyapi_update_duration_seconds{job}         histogram  computing one update
+#   dummyapi_serialize_duration_seconds{kind}     histogram  encoding one payload
+#                                                            (patch, snapshot, collection, ...)
+#   dummyapi_emit_duration_seconds{event}         histogram  sending one update to every client
+#   dummyapi_emitted_bytes_total{event}           counter    payload bytes sent, once per recipient
+#   dummyapi_emitted_messages_total{event}        counter    messages sent, once per recipient
+#                                                            (once per publish for MQTT)
+#   dummyapi_connections_total                    counter    Socket.IO connections accepted
+#   dummyapi_connected_clients                    gauge      Socket.IO clients connected now
+#   dummyapi_http_requests_total{route,method,status}  counter  REST requests by route template
+#   dummyapi_tick_overruns_total{job}             counter    updates that ran past their interval
+#   dummyapi_lagging_clients                      gauge      clients held back for a full send queue
+#                                                            (see sendqueue.py)
+#   dummyapi_client_queue_max_packets             gauge      longest client send queue at the last check
+#   dummyapi_client_max_lag_seconds               gauge      how long the longest lagging client has lagged
+#   dummyapi_held_ticks_total                     counter    ticks held back from lagging clients
+#   dummyapi_client_catch_ups_total               counter    lagging clients that caught up
+#
+# The instrumentation is meant to stay on: recording a value is a dict lookup
+# and an addition, without locks (a lost increment when two threads race is
+# fine for monitoring), and histograms keep one count per bucket. Text is only
+# built when /metrics is scraped. Payload sizes come from the already encoded
+# payloads, so nothing is encoded twice to measure it.
+
+import bisect
+import time
+
+from flask import Response, request
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Histogram buckets in seconds, from 100 microseconds to 10 seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """A number that only goes up, per combination of label values, or read from a function when scraped"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=(), read=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.read = read
+
+    def inc(self, labels=(), amount=1):
+        """Add amount for a tuple of label values"""
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        if self.read is not None:
+            yield self.name, '', self.read()
+            return
+        for labels, value in list(self.values.items()):
+            yield self.name, format_labels(self.labels, labels), value
+
+class Gauge(Counter):
+    """A value that goes up and down, or is read from a function when scraped"""
+
+    kind = 'gauge'
+
+    def set(self, labels=(), value=0):
+        self.values[labels] = value
+
+class Histogram:
+    """Counts of observed durations by bucket, plus their sum, per combination of label values"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labels, labels, f'le="{format_value(bound)}"'), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, labels), total
+            yield f"{self.name}_count", format_labels(self.labels, labels), cumulative
+
+class Registry:
+    """The metrics of one server, in the order they are rendered"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            samples = list(metric.samples())
+            if not samples:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+def payload_size(raw):
+    """Bytes of an encoded payload (wirecache.RawJSON, wire.RawBytes, str or bytes)"""
+    if isinstance(raw, (bytes, bytearray)):
+        return len(raw)
+    if isinstance(raw, str):
+        return len(raw)
+    text = getattr(raw, 'text', None)
+    # JSON is encoded with ensure_ascii, so characters are bytes
+    return len(text) if text is not None else len(raw.data)
+
+class ServerMetrics:
+    """The metrics every dummy API server exposes"""
+
+    def __init__(self, connected_clients=None, send_queues=None):
+        # connected_clients() returns the number of connected Socket.IO
+        # clients when scraped, send_queues is their sendqueue.SendQueues;
+        # servers without Socket.IO leave both out
+        self.registry = Registry()
+        add = self.registry.add
+        self.update_seconds = add(Histogram('dummyapi_update_duration_seconds',
+                                            'Time spent computing one update.', ('job',)))
+        self.serialize_seconds = add(Histogram('dummyapi_serialize_duration_seconds',
+                                               'Time spent encoding one payload.', ('kind',)))
+        self.emit_seconds = add(Histogram('dummyapi_emit_duration_seconds',
+                                          'Time spent sending one update to every client.', ('event',)))
+        self.emitted_bytes = add(Counter('dummyapi_emitted_bytes_total',
+                                         'Payload bytes sent to clients, counted once per recipient.', ('event',)))
+        self.emitted_messages = add(Counter('dummyapi_emitted_messages_total',
+                                            'Messages sent to clients, counted once per recipient.', ('event',)))
+        self.connections = add(Counter('dummyapi_connections_total', 'Socket.IO connections accepted.'))
+        if connected_clients is not None:
+            add(Gauge('dummyapi_connected_clients', 'Socket.IO clients connected now.', read=connected_clients))
+        self.requests = add(Counter('dummyapi_http_requests_total', 'REST requests by route template.',
+                                    ('route', 'method', 'status')))
+        self.overruns = add(Counter('dummyapi_tick_overruns_total',
+                                    'Updates that took longer than their interval.', ('job',)))
+        if send_queues is not None:
+            add(Gauge('dummyapi_lagging_clients', 'Socket.IO clients held back because their send queue is full.',
+                      read=send_queues.lagging_count))
+            add(Gauge('dummyapi_client_queue_max_packets', 'Longest Socket.IO client send queue at the last check.',
+                      read=send_queues.max_depth))
+            add(Gauge('dummyapi_client_max_lag_seconds', 'How long the longest lagging client has been held back.',
+                      read=send_queues.max_lag))
+            add(Counter('dummyapi_held_ticks_total', 'Ticks held back from lagging clients, merged or dropped.',
+                        read=send_queues.held_ticks))
+            add(Counter('dummyapi_client_catch_ups_total', 'Lagging clients that caught up.',
+                        read=lambda: send_queues.caught_up))
+
+    def emitted(self, event, raw, recipients=1):
+        """Count one emit of an encoded payload to a number of clients"""
+        if recipients > 0:
+            key = (event,)
+            self.emitted_bytes.inc(key, payload_size(raw) * recipients)
+            self.emitted_messages.inc(key, recipients)
+
+    def encode(self, kind, encoder, payload):
+        """Encode a payload, recording how long it took"""
+        start = time.perf_counter()
+        raw = encoder(payload)
+        self.serialize_seconds.observe((kind,), time.perf_counter() - start)
+        return raw
+
+    def on_encode(self, key, seconds):
+        """EncodeCache hook: key is the cache key, whose first part names the view"""
+        self.serialize_seconds.observe((key[0] if isinstance(key, tuple) else str(key),), seconds)
+
+    def on_overrun(self, job, duration, lag):
+        """TickScheduler hook"""
+        self.overruns.inc((job.name,))
+
+    def instrument(self, app):
+        """Count every request by route template (never by raw path, which could be anything)"""
+        requests = self.requests
+
+        @app.after_request
+        def count_request(response):
+            rule = request.url_rule
+            requests.inc((rule.rule if rule is not None else 'unmatched', request.method, response.status_code))
+            return response
+
+    def response(self):
+        """The /metrics response"""
+        return Response(self.registry.render(), mimetype=None, content_type=CONTENT_TYPE)
@@ -0,0 +1,273 @@
+#!/usr/bin/python
+
+# Compiled update plans for the dummy APIs.
+#
+# Interpreting update_rules on every tick means re-reading the rule type,
+# re-fetching every default with dict.get() and re-splitting dotted field paths
+# for every field of every item. Instead, load_config() compiles each item's
+# rules once into an ItemPlan: a list of small bound functions that already
+# hold the resolved container/key of their field and their clamped bounds. The
+# tick loop then only has to call them.
+#
+# New rule types are added with register_rule(). A compiler receives the item,
+# the field path, the rule dict and a CompileContext, and returns a step
+# function of one argument (or None if the rule does not apply to that item).
+# The argument is the item's dict of changed fields for this tick: a step
+# that changes its field writes the new value into the item and into
+# fields[path], and leaves fields alone otherwise. That is what lets each
+# tick produce a patch of only the fields that actually changed. Steps must
+# replace mutable values (lists, dicts) instead of modifying them in place,
+# since patches keep references to them.
+#
+# Only items with a changed field get a new last_updated timestamp. An item
+# whose steps changed nothing keeps its timestamp and stays out of the patch,
+# where the interpreter used to stamp every item with rules every tick. Each
+# plan stamps itself and adds its fields to the collection's patch as it
+# runs, so a tick is a single pass over the plans.
+
+import gc
+import random
+
+# Rule compilers by rule type
+RULE_COMPILERS = {}
+
+# Where run_tick stamps changed items: on GeoJSON features, or on the item
+STAMP_PATHS = ('properties.last_updated', 'last_updated')
+
+def register_rule(rule_type, compiler):
+    """Register the compiler used for a rule type"""
+    RULE_COMPILERS[rule_type] = compiler
+
+def find_update_rules(item):
+    """Return the update rules of an item, which GeoJSON features keep in their properties"""
+    if 'update_rules' in item:
+        return item['update_rules']
+    properties = item.get('properties')
+    if isinstance(properties, dict) and 'update_rules' in properties:
+        return properties['update_rules']
+    return None
+
+def resolve(item, path):
+    """Resolve a dot-separated field path to the (container, key) pair that holds its value"""
+    parts = path.split('.')
+    container = item
+    for part in parts[:-1]:
+        if isinstance(container, dict) and part in container:
+            container = container[part]
+        elif isinstance(container, list) and part.isdigit() and int(part) < len(container):
+            container = container[int(part)]
+        else:
+            return None
+
+    key = parts[-1]
+    if isinstance(container, dict) and key in container:
+        return container, key
+    if isinstance(container, list) and key.isdigit() and int(key) < len(container):
+        return container, int(key)
+    return None
+
+def resolve_value(item, path):
+    """Resolve a field path, skipping fields that are missing or null"""
+    target = resolve(item, path)
+    if target is None or target[0][target[1]] is None:
+        return None
+    return target
+
+def compile_random_float(item, path, rules, ctx):
+    target = resolve_value(item, path)
+    if target is None:
+        return None
+    container, key = target
+    min_change = rules.get('min_change', -1.0)
+    max_change = rules.get('max_change', 1.0)
+    min_value = rules.get('min_value', float('-inf'))
+    max_value = rules.get('max_value', float('inf'))
+    precision = rules.get('precision', 2)
+    # uniform(a, b) is a + (b - a) * random(), inlined to skip a Python-level call
+    span = max_change - min_change
+    rnd = ctx.rng.random
+
+    # Bounds are clamped with comparisons, which are cheaper than calling min() and max()
+    if precision is None:
+        def step(fields):
+            current_value = container[key]
+            new_value = current_value + min_change + span * rnd()
+            if new_value > max_value:
+                new_value = max_value
+            elif new_value < min_value:
+                new_value = min_value
+            if new_value != current_value:
+                container[key] = fields[path] = new_value
+    else:
+        def step(fields):
+            current_value = container[key]
+            new_value = current_value + min_change + span * rnd()
+            if new_value > max_value:
+                new_value = max_value
+            elif new_value < min_value:
+                new_value = min_value
+            new_value = round(new_value, precision)
+            if new_value != current_value:
+                container[key] = fields[path] = new_value
+    return step
+
+def compile_random_int(item, path, rules, ctx):
+    target = resolve_value(item, path)
+    if target is None:
+        return None
+    container, key = target
+    min_change = rules.get('min_change', -1)
+    max_change = rules.get('max_change', 1)
+    min_value = rules.get('min_value', 0)
+    max_value = rules.get('max_value', 100)
+    # randint(a, b) inlined as a + int(random() * (b - a + 1))
+    width = max_change - min_change + 1
+    rnd = ctx.rng.random
+
+    def step(fields):
+        current_value = container[key]
+        new_value = current_value + min_change + int(rnd() * width)
+        if new_value > max_value:
+            new_value = max_value
+        elif new_value < min_value:
+            new_value = min_value
+        new_value = int(new_value)
+        if new_value != current_value:
+            container[key] = fields[path] = new_value
+    return step
+
+def compile_random_choice(item, path, rules, ctx):
+    target = resolve_value(item, path)
+    choices = list(rules.get('choices', []))
+    if target is None or not choices:
+        return None
+    container, key = target
+    count = len(choices)
+    rnd = ctx.rng.random
+
+    def step(fields):
+        new_value = choices[int(rnd() * count)]
+        if new_value != container[key]:
+            container[key] = fields[path] = new_value
+    return step
+
+register_rule('random_float', compile_random_float)
+register_rule('random_int', compile_random_int)
+register_rule('random_choice', compile_random_choice)
+
+class CompileContext:
+    """Settings shared by every rule compiled for one collection"""
+
+    def __init__(self, rng=random, interval=5, skip_types=()):
+        # Source of randomness for the steps
+        self.rng = rng
+        # Seconds between ticks of the collection
+        self.interval = interval
+        # Rule types handled elsewhere (e.g. by the columnar engine)
+        self.skip_types = skip_types
+
+def collection_rng(seed, collection_name):
+    """Get the source of randomness for a collection's steps
+
+    Unseeded collections share the random module. Seeded ones get their own
+    generator, seeded from the seed and the collection name, so one
+    collection's sequence does not depend on when the others tick.
+    """
+    if seed is None:
+        return random
+    return random.Random(f"{seed}:{collection_name}")
+
+class ItemPlan:
+    """The compiled update steps of one item plus where its last_updated timestamp lives"""
+
+    __slots__ = ('collection', 'item_id', 'item', 'rules', 'steps', 'stamp', 'stamp_path')
+
+    def __init__(self, collection, item_id, item, rules, steps, stamp, stamp_path):
+        self.collection = collection
+        self.item_id = item_id
+        self.item = item
+        self.rules = rules
+        self.steps = steps
+        self.stamp = stamp
+        self.stamp_path = stamp_path
+
+    def run(self, patch, timestamp):
+        """Run the steps, adding the changed fields to the collection's patch and stamping the item if any changed"""
+        fields = {}
+        for step in self.steps:
+            step(fields)
+        if fields:
+            self.stamp['last_updated'] = fields[self.stamp_path] = timestamp
+            patch[self.item_id] = fields
+
+def compile_item(item, collection_name, collection_type, item_id, ctx):
+    """Compile the update rules of one item, or return None if it has none"""
+    rules_by_field = find_update_rules(item)
+    if rules_by_field is None:
+        return None
+
+    steps = []
+    for path, rules in rules_by_field.items():
+        rule_type = rules.get('type')
+        if rule_type in ctx.skip_types:
+            continue
+        compiler = RULE_COMPILERS.get(rule_type)
+        if compiler is None:
+            continue
+        step = compiler(item, path, rules, ctx)
+        if step is not None:
+            steps.append(step)
+
+    if collection_type == 'geojson' and 'properties' in item:
+        stamp, stamp_path = item['properties'], STAMP_PATHS[0]
+    else:
+        stamp, stamp_path = item, STAMP_PATHS[1]
+    return ItemPlan(collection_name, item_id, item, rules_by_field, steps, stamp, stamp_path)
+
+def compile_collection(collection_name, collection, ctx=None, reuse=None):
+    """Compile the plans of every item in a collection
+
+    reuse maps id() of an item to a plan already compiled for it, which is
+    kept instead of compiling the item again if the item kept its id.
+    """
+    if ctx is None:
+        ctx = CompileContext()
+    collection_type = collection.get('type', 'standard')
+    compiled = []
+    # Compiling allocates a few closures per item; with the collector running,
+    # large configs spend most of their load time in repeated full collections
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for index, item in enumerate(collection['items']):
+            # Patches address items by id, or by position if they have none
+            item_id = item.get('id', index)
+            plan = reuse.get(id(item)) if reuse else None
+            if plan is not None and plan.item_id == item_id:
+                compiled.append(plan)
+                continue
+            plan = compile_item(item, collection_name, collection_type, item_id, ctx)
+            if plan is not None:
+                compiled.append(plan)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return compiled
+
+def run_tick(item_plans, engine, timestamp):
+    """Advance every plan by one tick and return the patch of changed fields
+
+    The patch maps collection name -> item id -> dotted field path -> new
+    value. Only items that changed get their last_updated timestamp bumped.
+    """
+    patch = {}
+    for collection_name, compiled in item_plans.items():
+        collection_patch = {}
+        for plan in compiled:
+            plan.run(collection_patch, timestamp)
+        if collection_patch:
+            patch[collection_name] = collection_patch
+    if engine is not None:
+        # Advance all random_* fields in one batched step, merging into the plans' changes
+        engine.step(patch, timestamp)
+    return patch
@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# Query parameters for the collection endpoints.
+#
+#   ?limit=100                    at most this many items per page
+#   ?cursor=<next_cursor>         continue after the previous page
+#   ?fields=id,properties.speed   only these fields (dot-separated paths)
+#   ?where=properties.speed>10    only matching items, repeat for more (all must match)
+#   ?include_rules=true           keep update_rules, which are left out by default
+#
+# The single item and by-type endpoints take fields and include_rules too, so
+# every REST read shapes its items the same way.
+#
+# where supports ==, !=, >, >=, <, <= (and = for ==). Values are parsed as
+# JSON when they can be (numbers, true/false, null) and are strings otherwise.
+#
+# Equality on the item id or on the collection's type field is answered from
+# the snapshot store's indexes; every other predicate only filters those
+# candidates (or the whole collection), stopping as soon as a page is full.
+# Cursors are item positions, which never change, so paging stays stable
+# while the data updates.
+
+import base64
+import bisect
+import json
+import operator
+
+from snapshot import get_path
+
+class QueryError(ValueError):
+    """Invalid query parameters"""
+
+# Longest operators first, so '>=' is not read as '>'
+OPERATORS = [
+    ('>=', operator.ge),
+    ('<=', operator.le),
+    ('!=', operator.ne),
+    ('==', operator.eq),
+    ('>', operator.gt),
+    ('<', operator.lt),
+    ('=', operator.eq),
+]
+
+OPERATOR_FUNCTIONS = dict(OPERATORS)
+
+def parse_value(text):
+    """Parse a predicate value as a JSON scalar, falling back to the plain string"""
+    try:
+        value = json.loads(text)
+    except ValueError:
+        return text
+    return text if isinstance(value, (list, dict)) else value
+
+def parse_where(text):
+    """Parse 'path<op>value' into (path, operator symbol, value)"""
+    for symbol, fn in OPERATORS:
+        path, found, value = text.partition(symbol)
+        if found and path:
+            return (path.strip(), '==' if symbol == '=' else symbol, parse_value(value.strip()))
+    raise QueryError(f"Invalid where '{text}', expected <field><op><value>")
+
+def matches(item, predicates):
+    """Check an item against every (path, operator symbol, value) predicate"""
+    for path, symbol, value in predicates:
+        try:
+            if not OPERATOR_FUNCTIONS[symbol](get_path(item, path), value):
+                return False
+        except TypeError:
+            # e.g. comparing a string field with a number
+            return False
+    return True
+
+def project(item, paths):
+    """Copy only the given dot-separated paths of an item, keeping their nesting"""
+    result = {}
+    for path in paths:
+        parts = path.split('.')
+        value = item
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            target = result
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            target[parts[-1]] = value
+    return result
+
+def without_rules(item):
+    """Copy an item without its update_rules (at the top level or in properties)"""
+    if 'update_rules' in item:
+        item = {key: value for key, value in item.items() if key != 'update_rules'}
+    properties = item.get('properties')
+    if isinstance(properties, dict) and 'update_rules' in properties:
+        item = dict(item)
+        item['properties'] = {key: value for key, value in properties.items() if key != 'update_rules'}
+    return item
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps({'after': position}).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(text):
+    try:
+        padded = text + '=' * (-len(text) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))['after']
+    except (ValueError, KeyError, TypeError):
+        raise QueryError("Invalid cursor")
+    if not isinstance(position, int) or position < -1:
+        raise QueryError("Invalid cursor")
+    return position
+
+class Query:
+    """Parsed query parameters for a collection"""
+
+    def __init__(self, args):
+        limit = args.get('limit')
+        try:
+            self.limit = int(limit) if limit is not None else None
+        except ValueError:
+            raise QueryError("limit must be an integer")
+        if self.limit is not None and self.limit < 1:
+            raise QueryError("limit must be at least 1")
+
+        cursor = args.get('cursor')
+        self.after = decode_cursor(cursor) if cursor else -1
+
+        fields = args.get('fields')
+        self.fields = tuple(path.strip() for path in fields.split(',') if path.strip()) if fields else None
+
+        self.where = tuple(parse_where(text) for text in args.getlist('where'))
+        self.include_rules = args.get('include_rules', '').lower() in ('1', 'true', 'yes')
+
+    @property
+    def key(self):
+        """Hashable form of the query, for caching its result"""
+        return (self.limit, self.after, self.fields, self.where, self.include_rules)
+
+    @property
+    def view_key(self):
+        """Hashable form of the parts that shape each item (fields and include_rules)"""
+        return (self.fields, self.include_rules)
+
+    def view(self, item):
+        """Shape one item: only the requested fields, and without update_rules unless asked for"""
+        if self.fields is not None:
+            return project(item, self.fields)
+        if not self.include_rules:
+            return without_rules(item)
+        return item
+
+    def candidates(self, positions, by_type, type_path, count):
+        """Get the positions that can match, from an index when a predicate allows it"""
+        for path, symbol, value in self.where:
+            if symbol != '==':
+                continue
+            if path == 'id':
+                index = positions.get(value)
+                if index is None and not isinstance(value, str):
+                    # Ids in the URL parse as JSON, but may be strings in the data
+                    index = positions.get(str(value))
+                return [index] if index is not None else []
+            if path == type_path:
+                return by_type.get(value, [])
+        return range(count)
+
+    def matching(self, items, positions, by_type, type_path):
+        """Yield (position, item after projection) for every match after the cursor, ignoring the limit"""
+        candidates = self.candidates(positions, by_type, type_path, len(items))
+        start = bisect.bisect_right(candidates, self.after)
+        for index in candidates[start:]:
+            item = items[index]
+            if self.where and not matches(item, self.where):
+                continue
+            yield index, self.view(item)
+
+    def stream(self, items, positions, by_type, type_path):
+        """Yield the items of one page, then {"next_cursor": ...} if there are more"""
+        count = 0
+        last = None
+        for index, item in self.matching(items, positions, by_type, type_path):
+            if self.limit is not None and count == self.limit:
+                yield {'next_cursor': encode_cursor(last)}
+                return
+            yield item
+            count += 1
+            last = index
+
+    def run(self, items, positions, by_type, type_path):
+        """Return (matching items after projection, cursor for the next page or None)"""
+        results = []
+        next_cursor = None
+        last = None
+        for index, item in self.matching(items, positions, by_type, type_path):
+            if self.limit is not None and len(results) == self.limit:
+                next_cursor = encode_cursor(last)
+                break
+            results.append(item)
+            last = index
+        return results, next_cursor
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+
+# Recording and replaying simulations.
+#
+# With config['record_file'] set, the servers write the data store they start
+# from and then every tick's changes to an append-only log. With
+# config['replay_file'] set, they serve such a log instead of simulating: the
+# recorded changes go out through the same change feed, REST endpoints and
+# Socket.IO events as live ones, at the recorded pace times
+# config['replay_speed'] (1 by default; 10 is ten times faster, 0 is as fast
+# as possible). Together with config['seed'] this gives repeatable load for
+# benchmarking the servers and their clients.
+#
+# Log layout: the magic bytes b'DAPIRPL1', then frames of
+#
+#   float64  seconds since the recording started
+#   uint32   sequence number
+#   uint32   payload length
+#   payload  zlib-compressed JSON
+#
+# all little-endian. The first frame's payload is the data store at the start
+# of the recording; every other frame's payload is one tick's changes as
+# [[collection, [[item id, {field path: value}], ...]], ...], lists rather
+# than objects so item ids that are positions stay integers.
+#
+# Frames are encoded and written on a background thread, so recording adds
+# only a queue put to each tick.
+
+import json
+import queue
+import struct
+import threading
+import time
+import zlib
+
+MAGIC = b'DAPIRPL1'
+FRAME = struct.Struct('<dII')
+
+def encode_payload(obj):
+    return zlib.compress(json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+def decode_payload(data):
+    return json.loads(zlib.decompress(data))
+
+def changes_to_list(changes):
+    return [[collection_name, list(item_changes.items())] for collection_name, item_changes in changes.items()]
+
+def changes_from_list(rows):
+    return {collection_name: {item_id: fields for item_id, fields in item_changes}
+            for collection_name, item_changes in rows}
+
+def read_frames(filename):
+    """Yield (seconds, seq, payload) for every frame of a log"""
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{filename} is not a recording")
+        while True:
+            prefix = f.read(FRAME.size)
+            if len(prefix) < FRAME.size:
+                # End of the log, or a frame cut short by a crash
+                return
+            seconds, seq, size = FRAME.unpack(prefix)
+            data = f.read(size)
+            if len(data) < size:
+                return
+            yield seconds, seq, decode_payload(data)
+
+def load_start(filename):
+    """Return (seq, data store) the recording starts from"""
+    for seconds, seq, payload in read_frames(filename):
+        return seq, payload
+    raise ValueError(f"{filename} is empty")
+
+class Recorder:
+    """Appends the starting snapshot and then every published patch to a log"""
+
+    def __init__(self, filename, seq, data):
+        # data is a snapshot's data, which is never mutated, so it can be
+        # encoded later on the writer thread
+        self.filename = filename
+        self.queue = queue.SimpleQueue()
+        self.started = time.monotonic()
+        self.frames = 0
+        self.queue.put((0.0, seq, data))
+        self.thread = threading.Thread(target=self.run, name='recorder', daemon=True)
+        self.thread.start()
+
+    def record(self, patch):
+        """Queue a published patch for writing"""
+        self.queue.put((time.monotonic() - self.started, patch['seq'], changes_to_list(patch['changes'])))
+
+    def stop(self):
+        """Write what is queued and close the log"""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        with open(self.filename, 'wb') as f:
+            f.write(MAGIC)
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                seconds, seq, payload = frame
+                data = encode_payload(payload)
+                f.write(FRAME.pack(seconds, seq, len(data)))
+                f.write(data)
+                self.frames += 1
+                # Keep the log readable up to the last tick if the server dies
+                if self.queue.empty():
+                    f.flush()
+
+class Replayer:
+    """Background thread that feeds a recording's changes to publish() at the recorded pace"""
+
+    def __init__(self, filename, speed, publish):
+        self.filename = filename
+        self.speed = speed
+        self.publish = publish
+        self.thread = None
+        self.frames = 0
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='replayer', daemon=True)
+            self.thread.start()
+
+    def run(self):
+        frames = read_frames(self.filename)
+        # The first frame is the starting data store, already loaded
+        next(frames, None)
+        started = time.monotonic()
+        for seconds, seq, payload in frames:
+            if self.speed:
+                delay = started + seconds / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.publish(changes_from_list(payload))
+            self.frames += 1
+        print(f"Replay of {self.filename} finished after {self.frames} ticks "
+              f"in {time.monotonic() - started:.1f} seconds")
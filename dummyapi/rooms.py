@@ -0,0 +1,305 @@
+#!/usr/bin/python
+
+# Socket.IO subscriptions for the dummy APIs.
+#
+# Clients send subscribe/unsubscribe events to choose what they receive:
+#
+#   {"collection": "vessels"}                    a whole collection
+#   {"collection": "vessels", "id": "vessel-001"} one item
+#   {"collection": "vessels", "type": "cargo"}    items of one type
+#   {"collection": "*"}                          everything (the default)
+#
+# Every client starts out subscribed to everything. Its first subscribe
+# replaces that with just what it asked for. Ids and types must be plain
+# values (strings, numbers); ids are compared as strings, so 7 and "7" are the
+# same item.
+#
+# Clients with the same set of subscriptions share a group, and each group is
+# one Socket.IO room. The updater slices each tick's changes once per group
+# and emits the slice (encoded once) to that group's room, so a client only
+# gets what it asked for and a client in several subscriptions still gets one
+# message per tick. Groups are reference counted and dropped when empty.
+#
+# Clients that connected with different wire formats (see wire.py) are kept
+# in separate groups, so each group's messages are encoded exactly once.
+#
+# A group only gets a message when its slice is not empty, so messages carry
+# "prev", the sequence number of the previous message sent to the group. A
+# client whose last applied sequence number is at least prev has not missed
+# anything.
+
+import hashlib
+import json
+import threading
+
+# Subscribing to this collection means everything
+ALL = '*'
+
+# Values an id or type in a subscription may have
+SCALARS = (str, int, float)
+
+def subscription_key(data):
+    """Turn a subscribe/unsubscribe payload into a hashable subscription, or None if it is invalid"""
+    if not isinstance(data, dict):
+        return None
+    collection = data.get('collection', ALL)
+    if not isinstance(collection, str):
+        return None
+    if collection == ALL:
+        return (ALL,)
+    item_id = data.get('id')
+    item_type = data.get('type')
+    if not isinstance(item_id, SCALARS + (type(None),)) or not isinstance(item_type, SCALARS + (type(None),)):
+        return None
+    if item_id is not None:
+        return (collection, 'id', str(item_id))
+    if item_type is not None:
+        return (collection, 'type', item_type)
+    return (collection,)
+
+def find_id(container, item_id):
+    """Get the key a subscribed (string) id has in container, or None
+
+    Items without an id are keyed by their position, an int.
+    """
+    if item_id in container:
+        return item_id
+    if item_id.isdigit() and int(item_id) in container:
+        return int(item_id)
+    return None
+
+class Group:
+    """Clients sharing one set of subscriptions"""
+
+    def __init__(self, subscriptions, fmt=None):
+        self.subscriptions = subscriptions
+        # Wire format of the group's messages, opaque here
+        self.fmt = fmt
+        digest = hashlib.sha1(json.dumps([sorted(subscriptions, key=json.dumps), fmt]).encode('utf-8')).hexdigest()[:16]
+        self.room = f"sub:{digest}"
+        self.members = 0
+        # Sequence number of the last message sent to this group
+        self.last_seq = 0
+
+        self.everything = (ALL,) in subscriptions
+        # collection -> True for the whole collection, or ({ids}, {types})
+        self.filters = {}
+        for subscription in subscriptions:
+            if subscription == (ALL,):
+                continue
+            collection = subscription[0]
+            if len(subscription) == 1:
+                self.filters[collection] = True
+                continue
+            current = self.filters.get(collection)
+            if current is True:
+                continue
+            if current is None:
+                current = self.filters[collection] = (set(), set())
+            ids, types = current
+            if subscription[1] == 'id':
+                ids.add(subscription[2])
+            else:
+                types.add(subscription[2])
+
+    def covers(self, collection_names):
+        """Whether the group subscribed to anything in one of the collections"""
+        return self.everything or any(name in self.filters for name in collection_names)
+
+    def slice(self, items_by_collection, item_type):
+        """Keep only what this group subscribed to
+
+        items_by_collection maps collection -> item id -> anything (item
+        changes or whole items); item_type(collection, item id) returns the
+        item's type.
+        """
+        if self.everything:
+            return items_by_collection
+
+        result = {}
+        for collection, wanted in self.filters.items():
+            items = items_by_collection.get(collection)
+            if not items:
+                continue
+            if wanted is True:
+                result[collection] = items
+                continue
+
+            ids, types = wanted
+            selected = {}
+            for item_id in ids:
+                key = find_id(items, item_id)
+                if key is not None:
+                    selected[key] = items[key]
+            if types:
+                for item_id, value in items.items():
+                    if item_id not in selected and item_type(collection, item_id) in types:
+                        selected[item_id] = value
+            if selected:
+                result[collection] = selected
+        return result
+
+    def select(self, data, positions, item_type):
+        """Keep only the subscribed items of a snapshot's data
+
+        positions maps collection -> item id -> position in its items list.
+        """
+        if self.everything:
+            return data
+
+        result = {}
+        for collection_name, wanted in self.filters.items():
+            collection = data.get(collection_name)
+            if collection is None:
+                continue
+            if wanted is True:
+                result[collection_name] = collection
+                continue
+
+            ids, types = wanted
+            items = collection['items']
+            collection_positions = positions.get(collection_name, {})
+            selected = set(find_id(collection_positions, item_id) for item_id in ids)
+            selected.discard(None)
+            if types:
+                selected.update(item_id for item_id in collection_positions
+                                if item_type(collection_name, item_id) in types)
+            subset = dict(collection)
+            subset['items'] = [items[index] for index in sorted(collection_positions[item_id] for item_id in selected)]
+            result[collection_name] = subset
+        return result
+
+class SubscriptionRegistry:
+    """Tracks what every connected client subscribed to"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.by_key = {}
+
+    def set(self, sid, subscriptions, fmt=None):
+        """Move a client to the group for a new set of subscriptions, returning (old group, new group)
+
+        The client keeps its current wire format unless fmt is given.
+        """
+        subscriptions = frozenset(subscriptions)
+        with self.lock:
+            old = self.clients.get(sid)
+            if fmt is None and old is not None:
+                fmt = old.fmt
+            if old is not None and old.subscriptions == subscriptions and old.fmt == fmt:
+                return old, old
+            if old is not None:
+                self.release(old)
+
+            group = self.by_key.get((subscriptions, fmt))
+            if group is None:
+                group = self.by_key[(subscriptions, fmt)] = Group(subscriptions, fmt)
+            group.members += 1
+            self.clients[sid] = group
+            return old, group
+
+    def subscribe(self, sid, key):
+        """Add a subscription for a client, returning (old group, new group)"""
+        with self.lock:
+            current = self.clients.get(sid)
+            subscriptions = set(current.subscriptions) if current is not None else set()
+        if key == (ALL,) or (ALL,) in subscriptions:
+            # Asking for something specific replaces the default of everything
+            subscriptions = set()
+        subscriptions.add(key)
+        return self.set(sid, subscriptions)
+
+    def unsubscribe(self, sid, key):
+        """Remove a subscription from a client, returning (old group, new group)"""
+        with self.lock:
+            current = self.clients.get(sid)
+            subscriptions = set(current.subscriptions) if current is not None else set()
+        subscriptions.discard(key)
+        return self.set(sid, subscriptions)
+
+    def remove(self, sid):
+        """Forget a disconnected client"""
+        with self.lock:
+            group = self.clients.pop(sid, None)
+            if group is not None:
+                self.release(group)
+            return group
+
+    def group_of(self, sid):
+        with self.lock:
+            return self.clients.get(sid)
+
+    def sids(self):
+        """Return the session ids of every connected client"""
+        with self.lock:
+            return list(self.clients)
+
+    def groups(self):
+        """Return every group that has members"""
+        with self.lock:
+            return list(self.by_key.values())
+
+    def release(self, group):
+        group.members -= 1
+        if group.members <= 0:
+            del self.by_key[(group.subscriptions, group.fmt)]
+
+class RoomRegistry:
+    """Puts clients that asked for the same thing (any hashable key) into one room"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        # member (e.g. (sid, collection)) -> key
+        self.members = {}
+        # key -> [room, member count]
+        self.rooms = {}
+
+    def room_for(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return f"{self.prefix}:{digest}"
+
+    def set(self, member, key):
+        """Move a member to the room for key (None to leave), returning (old room, new room)"""
+        with self.lock:
+            old_key = self.members.get(member)
+            if old_key == key:
+                room = self.rooms[key][0] if key is not None else None
+                return room, room
+            old_room = self.leave(member)
+            new_room = None
+            if key is not None:
+                entry = self.rooms.get(key)
+                if entry is None:
+                    entry = self.rooms[key] = [self.room_for(key), 0]
+                entry[1] += 1
+                self.members[member] = key
+                new_room = entry[0]
+            return old_room, new_room
+
+    def remove(self, match):
+        """Forget every member for which match(member) is true"""
+        with self.lock:
+            for member in [member for member in self.members if match(member)]:
+                self.leave(member)
+
+    def key_of(self, member):
+        """Return the key a member is in the room for, or None"""
+        with self.lock:
+            return self.members.get(member)
+
+    def active(self):
+        """Return (key, room, member count) for every room that has members"""
+        with self.lock:
+            return [(key, room, members) for key, (room, members) in self.rooms.items()]
+
+    def leave(self, member):
+        key = self.members.pop(member, None)
+        if key is None:
+            return None
+        entry = self.rooms[key]
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.rooms[key]
+        return entry[0]
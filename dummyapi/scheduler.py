@@ -0,0 +1,208 @@
+#!/usr/bin/python
+
+# Shared tick scheduler for the dummy APIs.
+#
+# One scheduler thread per process runs every periodic job from a heap of due
+# times, so collections with different update intervals (10 ms up to minutes)
+# are all served by the same loop. Starting it again (e.g. from every
+# dashboard's start_background event) is a no-op.
+#
+# Due times advance by exactly one interval per run instead of "now +
+# interval", so a job's period does not drift with its own run time. If a job
+# falls more than a whole interval behind, the missed ticks are skipped rather
+# than run back to back, and the run is counted as an overrun. A run that takes
+# longer than its interval is an overrun too.
+#
+# Intervals and due times are in simulated seconds of the scheduler's clock
+# (see simclock.py), which is wall time unless the simulation runs faster. In
+# virtual time the scheduler does not wait for the due times: it moves the
+# clock to the next one and runs the jobs due then. Between two such batches
+# it waits VIRTUAL_PAUSE wall seconds on its condition, so request threads get
+# a real chance at the store lock the jobs keep taking.
+
+import heapq
+import itertools
+import threading
+import time
+
+import simclock
+
+# Shortest interval a job may ask for, in seconds
+MIN_INTERVAL = 0.01
+
+# Don't report overruns of the same job more often than this, in seconds
+OVERRUN_REPORT_INTERVAL = 5.0
+
+# Wall seconds a virtual-time scheduler leaves other threads between batches of due jobs
+VIRTUAL_PAUSE = 0.001
+
+class Job:
+    """A periodic job and its run statistics"""
+
+    def __init__(self, name, interval, fn):
+        self.name = name
+        self.interval = max(MIN_INTERVAL, interval)
+        self.fn = fn
+        self.cancelled = False
+        self.runs = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.last_lag = 0.0
+        self.last_report = 0.0
+
+    def stats(self):
+        return {
+            'interval': self.interval,
+            'runs': self.runs,
+            'overruns': self.overruns,
+            'skipped_ticks': self.skipped,
+            'last_duration_ms': round(self.last_duration * 1000, 3),
+            'max_duration_ms': round(self.max_duration * 1000, 3),
+            'last_lag_ms': round(self.last_lag * 1000, 3),
+        }
+
+class TickScheduler:
+    """Runs periodic jobs from one heap-driven timer thread"""
+
+    def __init__(self, on_overrun=None, clock=None):
+        self.clock = clock if clock is not None else simclock.SimClock()
+        self.condition = threading.Condition()
+        self.heap = []
+        self.jobs = {}
+        self.pending = []
+        self.counter = itertools.count()
+        self.thread = None
+        # Called as on_overrun(job, duration, lag) whenever a run overruns
+        self.on_overrun = on_overrun
+
+    def add_job(self, name, interval, fn):
+        """Schedule fn every interval seconds, replacing any job with the same name"""
+        job = Job(name, interval, fn)
+        with self.condition:
+            old = self.jobs.get(name)
+            if old is not None:
+                old.cancelled = True
+            self.jobs[name] = job
+            heapq.heappush(self.heap, (self.clock.elapsed(), next(self.counter), job))
+            self.condition.notify()
+        return job
+
+    def remove_job(self, name):
+        """Stop running a job"""
+        with self.condition:
+            job = self.jobs.pop(name, None)
+            if job is not None:
+                job.cancelled = True
+
+    def call_soon(self, fn):
+        """Run fn once on the scheduler thread, between ticks"""
+        with self.condition:
+            self.pending.append(fn)
+            self.condition.notify()
+
+    def start(self):
+        """Start the scheduler thread, unless it is already running"""
+        with self.condition:
+            if self.thread is not None:
+                return False
+            self.thread = threading.Thread(target=self.run, name='tick-scheduler', daemon=True)
+            self.thread.start()
+            return True
+
+    def stats(self):
+        """Return run statistics for every job"""
+        with self.condition:
+            return {name: job.stats() for name, job in self.jobs.items()}
+
+    def run(self):
+        paused = False
+        while True:
+            with self.condition:
+                while True:
+                    if self.pending:
+                        pending, self.pending = self.pending, []
+                        break
+                    if self.heap:
+                        delay = self.heap[0][0] - self.clock.elapsed()
+                        if delay > 0 and self.clock.is_virtual:
+                            if not paused:
+                                # The batch due now is done, let the server's other threads run
+                                paused = True
+                                self.condition.wait(VIRTUAL_PAUSE)
+                                continue
+                            self.clock.advance_to(self.heap[0][0])
+                            delay = 0
+                        if delay <= 0:
+                            due, _, job = heapq.heappop(self.heap)
+                            pending = None
+                            break
+                        self.condition.wait(self.clock.wall_seconds(delay))
+                    else:
+                        self.condition.wait()
+
+            if pending is not None:
+                for fn in pending:
+                    self.call(fn)
+                continue
+
+            if job.cancelled:
+                continue
+            self.run_job(job, due)
+            paused = False
+
+    def call(self, fn):
+        try:
+            fn()
+        except Exception as e:
+            print(f"Error in scheduled call: {str(e)}")
+
+    def run_job(self, job, due):
+        clock = self.clock
+        start = clock.elapsed()
+        if job.runs == 0:
+            # Jobs are usually added before the scheduler starts, so count from the first run
+            due = start
+        lag = clock.wall_seconds(start - due)
+        wall_start = time.monotonic()
+        try:
+            job.fn()
+        except Exception as e:
+            print(f"Error in job '{job.name}': {str(e)}")
+        wall_end = time.monotonic()
+        end = clock.elapsed()
+
+        # Durations and lag are reported in wall time
+        duration = wall_end - wall_start
+        job.runs += 1
+        job.last_duration = duration
+        job.last_lag = lag
+        job.max_duration = max(job.max_duration, duration)
+
+        # Next due time is one interval after this one. A little late just
+        # runs right away; a whole interval or more behind skips the missed ticks.
+        next_due = due + job.interval
+        overrun = not clock.is_virtual and duration > clock.wall_seconds(job.interval)
+        if end - next_due >= job.interval:
+            missed = int((end - next_due) / job.interval)
+            job.skipped += missed
+            next_due += missed * job.interval
+            overrun = True
+
+        if overrun:
+            job.overruns += 1
+            self.report_overrun(job, duration, lag, wall_end)
+
+        with self.condition:
+            if not job.cancelled:
+                heapq.heappush(self.heap, (next_due, next(self.counter), job))
+
+    def report_overrun(self, job, duration, lag, now):
+        if self.on_overrun is not None:
+            self.on_overrun(job, duration, lag)
+        if now - job.last_report >= OVERRUN_REPORT_INTERVAL:
+            job.last_report = now
+            print(f"Tick overrun in '{job.name}': took {duration * 1000:.1f} ms, "
+                  f"started {lag * 1000:.1f} ms late (interval {job.interval * 1000:.0f} ms, "
+                  f"{job.overruns} overruns so far)")
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+
+# Bounded sending to Socket.IO clients that cannot keep up.
+#
+# An emit only queues the message on each client's engine.io socket. A client
+# on a slow link drains its queue slower than the updates fill it, and with
+# updates every 10 ms its queue (and the server's memory) would grow without
+# bound. So every client's queue is bounded instead:
+#
+# - At most every CHECK_INTERVAL seconds, the broadcast looks at how many
+#   packets wait in each client's queue. A client with max_queued or more is
+#   lagging.
+# - The broadcasts skip lagging clients. What a lagging client misses is
+#   merged into its backlog, which keeps only the newest value of every item
+#   field, so the intermediate ticks are dropped instead of queued.
+# - Once its queue has drained to half of max_queued, the client is sent its
+#   backlog as one message and gets the broadcasts again.
+#
+# A client's queue thus holds at most max_queued packets plus one check
+# interval of ticks, and its backlog at most one value per field it
+# subscribed to. The broadcast never waits for a client either way.
+#
+# The servers report every client's queue at GET /_admin/clients, and the
+# lagging clients in their metrics (see metrics.py).
+
+import threading
+import time
+
+# Packets a client may have waiting before it lags: a second of updates at the
+# 10 ms interval, unless config['client_max_queued'] says otherwise
+MAX_QUEUED = 100
+
+# Seconds between looks at the clients' queues
+CHECK_INTERVAL = 0.1
+
+class SidList(list):
+    """Socket.IO session ids to skip, a list for python-socketio's skip_sid but with set lookups"""
+
+    def __init__(self, sids=()):
+        super().__init__(sids)
+        self.lookup = set(self)
+
+    def __contains__(self, sid):
+        return sid in self.lookup
+
+class Backlog:
+    """What a lagging client has not been sent"""
+
+    def __init__(self, since):
+        # time.monotonic() when the client started lagging
+        self.since = since
+        # Ticks the client was skipped for
+        self.ticks = 0
+        # Sequence numbers of the last patch the client got and of the newest held one
+        self.prev = None
+        self.seq = None
+        # collection -> item id -> field path -> newest value
+        self.changes = {}
+
+    def skip(self):
+        """Count a tick whose message the client does not need, the next one supersedes it"""
+        self.ticks += 1
+
+    def merge(self, prev, seq, changes):
+        """Hold back one patch (collection -> item id -> field path -> value) sent with prev"""
+        if self.prev is None:
+            self.prev = prev
+        self.seq = seq
+        for collection_name, items in changes.items():
+            held = self.changes.setdefault(collection_name, {})
+            for item_id, fields in items.items():
+                current = held.get(item_id)
+                if current is None:
+                    # Copied, the patch's dicts are shared with the change feed
+                    held[item_id] = dict(fields)
+                else:
+                    current.update(fields)
+        self.ticks += 1
+
+class SendQueues:
+    """Tracks the outbound queue of every Socket.IO client and the backlogs of lagging ones"""
+
+    def __init__(self, socketio, max_queued=MAX_QUEUED, check_interval=CHECK_INTERVAL, namespace='/'):
+        self.socketio = socketio
+        self.max_queued = max_queued
+        self.check_interval = check_interval
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        # sid -> Backlog of the lagging clients
+        self.lagging = {}
+        # The lagging clients' sids, for skip_sid; replaced, never changed
+        self.skip = SidList()
+        # sid -> packets queued at the last check
+        self.depths = {}
+        self.checked = 0
+        self.caught_up = 0
+        self.caught_up_ticks = 0
+
+    def queued(self, sid):
+        """Packets waiting in a client's engine.io queue, None if it is gone"""
+        server = self.socketio.server
+        eio_sid = server.manager.eio_sid_from_sid(sid, self.namespace)
+        socket = server.eio.sockets.get(eio_sid) if eio_sid is not None else None
+        return socket.queue.qsize() if socket is not None else None
+
+    def check(self, sids):
+        """Look at the queues of the clients sids() returns, at most once per check interval
+
+        Returns [(sid, backlog)] of the lagging clients whose queue drained.
+        They are no longer skipped, send them their backlog before the next
+        broadcast.
+        """
+        now = time.monotonic()
+        if now - self.checked < self.check_interval:
+            return []
+        self.checked = now
+        depths = {}
+        for sid in sids():
+            queued = self.queued(sid)
+            if queued is not None:
+                depths[sid] = queued
+
+        caught_up = []
+        with self.lock:
+            self.depths = depths
+            for sid, queued in depths.items():
+                backlog = self.lagging.get(sid)
+                if backlog is None:
+                    if queued >= self.max_queued:
+                        self.lagging[sid] = Backlog(now)
+                elif queued <= self.max_queued // 2:
+                    del self.lagging[sid]
+                    self.caught_up += 1
+                    self.caught_up_ticks += backlog.ticks
+                    caught_up.append((sid, backlog))
+            self.skip = SidList(self.lagging)
+        return caught_up
+
+    def backlogs(self):
+        """Return (sid, backlog) of every lagging client"""
+        with self.lock:
+            return list(self.lagging.items())
+
+    def reset(self, sid):
+        """Forget what a lagging client was held back from, e.g. after sending it a snapshot"""
+        with self.lock:
+            backlog = self.lagging.get(sid)
+            if backlog is not None:
+                fresh = self.lagging[sid] = Backlog(backlog.since)
+                fresh.ticks = backlog.ticks
+
+    def remove(self, sid):
+        """Forget a disconnected client"""
+        with self.lock:
+            self.depths.pop(sid, None)
+            if self.lagging.pop(sid, None) is not None:
+                self.skip = SidList(self.lagging)
+
+    def lagging_count(self):
+        return len(self.lagging)
+
+    def max_depth(self):
+        return max(list(self.depths.values()), default=0)
+
+    def max_lag(self):
+        """Seconds the longest lagging client has been held back"""
+        now = time.monotonic()
+        return max((now - backlog.since for backlog in list(self.lagging.values())), default=0.0)
+
+    def held_ticks(self):
+        """Ticks held back from lagging clients so far"""
+        return self.caught_up_ticks + sum(backlog.ticks for backlog in list(self.lagging.values()))
+
+    def stats(self):
+        """Every client's queue at the last check, lagging clients first"""
+        now = time.monotonic()
+        with self.lock:
+            clients = []
+            for sid, queued in self.depths.items():
+                backlog = self.lagging.get(sid)
+                clients.append({
+                    'sid': sid,
+                    'queued': queued,
+                    'lagging': backlog is not None,
+                    'lag_seconds': round(now - backlog.since, 3) if backlog is not None else 0,
+                    'held_ticks': backlog.ticks if backlog is not None else 0,
+                })
+        clients.sort(key=lambda client: (not client['lagging'], -client['queued']))
+        return {'max_queued': self.max_queued, 'lagging': len(self.lagging), 'clients': clients}
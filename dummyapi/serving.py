@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+# How the dummy API servers serve: the development server with one thread per
+# connection (the default), or an event loop for many concurrent clients.
+#
+# The mode comes from the DUMMYAPI_ASYNC environment variable:
+#
+#   threading  (default) Werkzeug with the debugger and reloader, for
+#              development. Every connected client costs a thread.
+#   eventlet   one event loop, every connection a green thread of a few KB.
+#              Emits only queue the message on each client's socket, so a
+#              tick never waits for slow clients.
+#   gevent     the same with gevent.
+#
+#   DUMMYAPI_ASYNC=eventlet python api_geo.py
+#
+# DUMMYAPI_PORT changes the port (5000 by default).
+#
+# The event loop modes monkey-patch the standard library, which has to happen
+# before anything else imports threading, socket or time. That is why the
+# servers import this module first. Their background threads (scheduler,
+# checkpoints, recording) then run as green threads on the same loop.
+
+import os
+
+MODES = ('threading', 'eventlet', 'gevent')
+
+MODE = os.environ.get('DUMMYAPI_ASYNC', 'threading').lower()
+if MODE not in MODES:
+    raise ValueError(f"Unknown DUMMYAPI_ASYNC '{MODE}', expected one of {', '.join(MODES)}")
+
+# Seconds between pings, and how long a silent client has before it is dropped
+PING_INTERVAL = 25
+PING_TIMEOUT = 20
+
+# Largest message a client may send; clients only send small control events,
+# so this keeps the read buffer of every connection small
+MAX_CLIENT_MESSAGE = 64 * 1024
+
+# Open files (connections) to allow, if the hard limit permits
+MAX_CONNECTIONS = 65536
+
+# Connections the kernel queues while the server is busy accepting
+LISTEN_BACKLOG = 2048
+
+if MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+def raise_file_limit(wanted=MAX_CONNECTIONS):
+    """Raise the open file limit towards wanted, every connection takes one"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = wanted if hard == resource.RLIM_INFINITY else min(wanted, hard)
+    if soft < target:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            soft = target
+        except (ValueError, OSError):
+            pass
+    return soft
+
+def socketio_options():
+    """Keyword arguments for SocketIO() in the selected mode"""
+    return {
+        'async_mode': MODE,
+        'ping_interval': PING_INTERVAL,
+        'ping_timeout': PING_TIMEOUT,
+        'max_http_buffer_size': MAX_CLIENT_MESSAGE,
+    }
+
+def shared_listener(port):
+    """A listening socket other processes can bind the same port for, the kernel balances connections between them"""
+    import socket
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind(('0.0.0.0', port))
+    listener.listen(LISTEN_BACKLOG)
+    return listener
+
+def run(socketio, app, port=5000, reuse_port=False):
+    """Serve the app, with the debugger only in the development mode
+
+    DUMMYAPI_PORT overrides the port. With reuse_port, several processes can
+    serve the same port (the replicated workers of sharedstore.py); in the threading
+    mode they run without the debugger and reloader.
+    """
+    port = int(os.environ.get('DUMMYAPI_PORT', port))
+    if MODE == 'threading':
+        if reuse_port:
+            from werkzeug.serving import make_server
+            listener = shared_listener(port)
+            print(f"Replicated worker {os.getpid()} serving on port {port}")
+            make_server('0.0.0.0', port, app, threaded=True, fd=listener.fileno()).serve_forever()
+            return
+        socketio.run(app, host='0.0.0.0', port=port, debug=True)
+        return
+    limit = raise_file_limit()
+    print(f"Serving with {MODE} on port {port}, up to {limit} open connections")
+    if MODE == 'eventlet':
+        # socketio.run() would cap eventlet at 1024 connections and a listen
+        # backlog of 50, which drops clients when thousands connect at once
+        import eventlet.wsgi
+        listener = eventlet.listen(('0.0.0.0', port), backlog=LISTEN_BACKLOG, reuse_port=reuse_port)
+        eventlet.wsgi.server(listener, app, max_size=limit, log_output=False)
+        return
+    if reuse_port:
+        from gevent import pywsgi
+        try:
+            from geventwebsocket.handler import WebSocketHandler
+            options = {'handler_class': WebSocketHandler}
+        except ImportError:
+            options = {}
+        pywsgi.WSGIServer(shared_listener(port), app, log=None, **options).serve_forever()
+        return
+    socketio.run(app, host='0.0.0.0', port=port, debug=False, log_output=False, backlog=LISTEN_BACKLOG)
@@ -0,0 +1,297 @@
+#!/usr/bin/python
+
+# Running one simulation behind several replicated worker processes.
+#
+# With config['workers'] set to N, the server process becomes the simulator:
+# it runs the updates and serves nothing itself. It starts N copies of itself
+# as workers, which all listen on the same port (SO_REUSEPORT, the kernel
+# spreads connections over them) and serve the REST and Socket.IO endpoints.
+# Each worker holds a read replica of the simulator's state, so every worker
+# serves the same data at the same sequence numbers.
+#
+# They share one shared-memory segment, written only by the simulator:
+#
+#   header     magic, sizes, and the counters below
+#   patch ring every tick's changes, encoded once by the simulator, as
+#              records of (uint64 seq, uint32 length, JSON) in a circular
+#              byte buffer; a worker falling a whole ring behind resyncs
+#   snapshots  two areas the simulator takes turns writing the encoded data
+#              store to every few seconds, each with the ring position of
+#              the tick it was taken at
+#
+# A worker starts (or resyncs) from the latest snapshot and then follows the
+# ring. Nothing is locked across processes: the simulator bumps a counter
+# before it overwrites ring space and a version number around every snapshot
+# write, and readers check those after copying to detect being overwritten.
+#
+# Patches are encoded once, in the simulator; workers only decode them into
+# their replica and fan them out to their own clients. Nothing is served
+# straight from the segment: the snapshots there are seconds old, so a worker
+# decodes one into its own copy of the data store and keeps that current from
+# the ring. Memory and decoding time therefore grow with the number of
+# workers, each holding about as much as a single server. What the workers
+# share is the simulation and its encoding, not the objects they serve.
+# Workers need an event loop mode (see serving.py) or Werkzeug's threads, no
+# debugger or reloader.
+
+import json
+import os
+import signal
+import struct
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import replay
+
+MAGIC = b'DAPISHM1'
+
+# Environment variable that tells a server process it is a worker, and of which segment
+ENV_SEGMENT = 'DUMMYAPI_SHARED'
+
+# Segment size unless config['shared_memory_mb'] says otherwise
+DEFAULT_SIZE_MB = 256
+
+# Seconds between snapshots, and between a worker's looks at the ring
+SNAPSHOT_INTERVAL = 5
+POLL_INTERVAL = 0.01
+
+# Header: magic, ring size, snapshot area size, then uint64 counters
+HEADER = struct.Struct('<8sQQ')
+COUNTER = struct.Struct('<Q')
+RING_RESERVED = 24      # ring position up to which the simulator may be writing
+RING_HEAD = 32          # ring position up to which records are complete
+SNAPSHOTS = 40          # number of snapshots published
+AREA_INFO = 48          # per area: version (odd while written), seq, ring position, length
+AREA = struct.Struct('<QQQQ')
+DATA_START = 128
+
+RECORD = struct.Struct('<QI')
+# Record length that means "continue at the start of the ring"
+WRAP = 0xFFFFFFFF
+
+def encode_changes(changes):
+    return json.dumps(replay.changes_to_list(changes), separators=(',', ':')).encode('utf-8')
+
+def decode_changes(data):
+    return replay.changes_from_list(json.loads(data))
+
+class Segment:
+    """The shared memory and its layout"""
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.buf = memory.buf
+        magic, self.ring_size, self.area_size = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory {memory.name} is not a dummy API store")
+        self.ring_start = DATA_START
+        self.area_starts = (DATA_START + self.ring_size, DATA_START + self.ring_size + self.area_size)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def get(self, offset):
+        return COUNTER.unpack_from(self.buf, offset)[0]
+
+    def set(self, offset, value):
+        COUNTER.pack_into(self.buf, offset, value)
+
+class SharedWriter(Segment):
+    """The simulator's side: creates the segment and appends to it"""
+
+    def __init__(self, size_mb=DEFAULT_SIZE_MB):
+        size = int(size_mb * 1024 * 1024)
+        # A quarter for the patch ring, the rest for the two snapshot areas
+        ring_size = size // 4
+        area_size = (size - ring_size - DATA_START) // 2
+        memory = shared_memory.SharedMemory(create=True, size=DATA_START + ring_size + 2 * area_size)
+        HEADER.pack_into(memory.buf, 0, MAGIC, ring_size, area_size)
+        super().__init__(memory)
+        self.head = 0
+        self.snapshots = 0
+        self.warned = set()
+
+    def warn_once(self, key, message):
+        if key not in self.warned:
+            self.warned.add(key)
+            print(message)
+
+    def append(self, seq, changes):
+        """Append one tick's changes to the ring; call with the store lock held so ticks stay in order"""
+        data = encode_changes(changes)
+        need = RECORD.size + len(data)
+        if need > self.ring_size // 2:
+            # Workers will see the gap and resync from the next snapshot
+            self.warn_once('patch', f"A tick's changes ({len(data)} bytes) do not fit the shared ring, "
+                                    f"raise shared_memory_mb")
+            return
+        ring_size = self.ring_size
+        offset = self.head % ring_size
+        start = self.head
+        if ring_size - offset < need:
+            start += ring_size - offset
+        # Tell readers which space is about to be overwritten, then write
+        self.set(RING_RESERVED, start + need)
+        if start != self.head and ring_size - offset >= RECORD.size:
+            RECORD.pack_into(self.buf, self.ring_start + offset, 0, WRAP)
+        at = self.ring_start + start % ring_size
+        RECORD.pack_into(self.buf, at, seq, len(data))
+        self.buf[at + RECORD.size:at + need] = data
+        self.head = start + need
+        self.set(RING_HEAD, self.head)
+
+    def publish_snapshot(self, seq, position, data):
+        """Write an encoded data store, taken at ring position position, to the older snapshot area"""
+        if len(data) > self.area_size:
+            self.warn_once('snapshot', f"The data store ({len(data)} bytes) does not fit the shared memory, "
+                                       f"raise shared_memory_mb")
+            return False
+        area = self.snapshots % 2
+        info = AREA_INFO + area * AREA.size
+        version = self.get(info)
+        self.set(info, version + 1)
+        start = self.area_starts[area]
+        self.buf[start:start + len(data)] = data
+        AREA.pack_into(self.buf, info, version + 2, seq, position, len(data))
+        self.snapshots += 1
+        self.set(SNAPSHOTS, self.snapshots)
+        return True
+
+    def close(self):
+        """Remove the segment's name; the mapping goes with the process, ticks may still write to it"""
+        self.memory.unlink()
+
+class SharedReader(Segment):
+    """A worker's side: follows the ring from the latest snapshot"""
+
+    def __init__(self, name):
+        try:
+            memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 attaching registers the segment with the
+            # resource tracker, which would unlink it when the worker exits
+            memory = shared_memory.SharedMemory(name=name)
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(memory._name, 'shared_memory')
+        super().__init__(memory)
+        self.position = 0
+        self.seq = 0
+        # Workers are started by the simulator
+        self.simulator_pid = os.getppid()
+
+    def simulator_alive(self):
+        return os.getppid() == self.simulator_pid
+
+    def snapshot(self, timeout=60):
+        """Return (seq, data store) of the latest snapshot and follow the ring from there"""
+        deadline = time.monotonic() + timeout
+        while True:
+            published = self.get(SNAPSHOTS)
+            if published:
+                area = (published - 1) % 2
+                info = AREA_INFO + area * AREA.size
+                version, seq, position, length = AREA.unpack_from(self.buf, info)
+                if version % 2 == 0:
+                    start = self.area_starts[area]
+                    data = bytes(self.buf[start:start + length])
+                    if self.get(info) == version:
+                        self.seq = seq
+                        self.position = position
+                        return seq, json.loads(data)
+            if time.monotonic() > deadline:
+                raise TimeoutError("No snapshot from the simulator")
+            time.sleep(POLL_INTERVAL)
+
+    def poll(self):
+        """Return the ticks published since the last call as a list of changes, or None if this reader must resync"""
+        head = self.get(RING_HEAD)
+        position = self.position
+        ring_size = self.ring_size
+        if head - position > ring_size:
+            return None
+        records = []
+        while position < head:
+            offset = position % ring_size
+            if ring_size - offset < RECORD.size:
+                position += ring_size - offset
+                continue
+            seq, length = RECORD.unpack_from(self.buf, self.ring_start + offset)
+            if length == WRAP:
+                position += ring_size - offset
+                continue
+            start = self.ring_start + offset + RECORD.size
+            records.append((seq, bytes(self.buf[start:start + length])))
+            position += RECORD.size + length
+        # Anything the simulator started overwriting while we copied is lost
+        if self.get(RING_RESERVED) - self.position > ring_size:
+            return None
+
+        ticks = []
+        for seq, data in records:
+            if seq != self.seq + 1:
+                return None
+            ticks.append(decode_changes(data))
+            self.seq = seq
+        self.position = position
+        return ticks
+
+def attach_from_env():
+    """Attach to the simulator's segment if this process was started as a worker"""
+    name = os.environ.get(ENV_SEGMENT)
+    return SharedReader(name) if name else None
+
+class SnapshotPublisher:
+    """Background thread that publishes the data store to the shared segment when it changed"""
+
+    def __init__(self, writer, interval, collect):
+        # collect() returns (seq, ring position, data) with the data from an immutable snapshot
+        self.writer = writer
+        self.interval = interval
+        self.collect = collect
+        self.last_seq = None
+        # The thread and config reloads both publish, one at a time
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='shared-snapshots', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def publish(self):
+        with self.lock:
+            seq, position, data = self.collect()
+            if seq == self.last_seq:
+                return
+            encoded = json.dumps(data, separators=(',', ':')).encode('utf-8')
+            if self.writer.publish_snapshot(seq, position, encoded):
+                self.last_seq = seq
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except Exception as e:
+                print(f"Error publishing shared snapshot: {str(e)}")
+
+def run_workers(script, count, segment_name):
+    """Start count workers serving a segment and wait for them; stop them all when one exits"""
+    # Stop the workers on SIGTERM too, not only on Ctrl+C
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    env = dict(os.environ, **{ENV_SEGMENT: segment_name})
+    workers = [subprocess.Popen([sys.executable, script], env=env) for _ in range(count)]
+    print(f"Started {count} replicated workers")
+    try:
+        while all(worker.poll() is None for worker in workers):
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+
+# Simulation time for the dummy APIs.
+#
+# A tick reads the clock once and stamps every item it changes with that one
+# time, so all timestamps of a tick match and an update costs one clock read
+# and one formatting, not one per item.
+#
+# The clock can run faster than wall time:
+#
+#   speed 1   (default) simulated time is wall time
+#   speed N   N times as fast: every update interval is simulated in 1/N of
+#             it, so with N = 60 an hour of updates takes a minute
+#   speed 0   virtual time: ticks run back to back and the clock jumps to
+#             the next one, as fast as the updates can be computed
+#
+# Update intervals stay in simulated seconds, so rules that depend on them
+# (geo_movement's distance per tick) move items by the same amount per tick
+# at any speed. The scheduler (scheduler.py) waits in simulated time. If it
+# cannot keep up with a speed, it skips ticks as it would in wall time and
+# counts overruns; speed 0 never skips.
+#
+# Timestamps are ISO 8601 strings in local time, like datetime.now(), or Unix
+# epoch milliseconds (timestamp_format 'epoch_ms'). Simulated time starts at
+# the wall time the server starts, or at sim_start (an ISO time or Unix
+# seconds).
+#
+# The generic and GeoJSON servers take sim_speed, sim_start and
+# timestamp_format from their config. The sensor servers, which have no
+# config file, read DUMMYAPI_SIM_SPEED, DUMMYAPI_SIM_START and
+# DUMMYAPI_TIMESTAMPS from the environment.
+
+import os
+import time
+from datetime import datetime
+
+ISO = 'iso'
+EPOCH_MS = 'epoch_ms'
+FORMATS = (ISO, EPOCH_MS)
+
+def parse_start(value):
+    """Turn a start time (ISO string or Unix seconds) into Unix seconds"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+class SimClock:
+    """Simulated time, running speed times as fast as wall time, or from tick to tick at speed 0"""
+
+    def __init__(self, speed=1, start=None, timestamp_format=ISO):
+        self.configure(speed, start, timestamp_format)
+
+    def configure(self, speed=1, start=None, timestamp_format=ISO):
+        """Restart the clock with new settings; do it before jobs are scheduled on it"""
+        if not isinstance(speed, (int, float)) or speed < 0:
+            raise ValueError(f"Invalid simulation speed {speed!r}")
+        if timestamp_format not in FORMATS:
+            raise ValueError(f"Unknown timestamp format '{timestamp_format}', expected one of {', '.join(FORMATS)}")
+        self.speed = speed
+        self.timestamp_format = timestamp_format
+        # Unix time the simulation starts at
+        self.epoch = parse_start(start) if start is not None else time.time()
+        self.origin = time.monotonic()
+        # Simulated seconds since the start, at speed 0
+        self.virtual = 0.0
+
+    @property
+    def is_virtual(self):
+        return self.speed == 0
+
+    def elapsed(self):
+        """Simulated seconds since the start; never goes back"""
+        if self.speed == 0:
+            return self.virtual
+        return (time.monotonic() - self.origin) * self.speed
+
+    def advance_to(self, elapsed):
+        """Move virtual time forward to elapsed simulated seconds since the start"""
+        if elapsed > self.virtual:
+            self.virtual = elapsed
+
+    def wall_seconds(self, seconds):
+        """Wall time that simulated seconds take, 0 in virtual time"""
+        return seconds / self.speed if self.speed else 0.0
+
+    def time(self):
+        """Simulated Unix time"""
+        return self.epoch + self.elapsed()
+
+    def stamp(self, now=None):
+        """Format a simulated Unix time (by default the current one) as a timestamp"""
+        if now is None:
+            now = self.time()
+        if self.timestamp_format == EPOCH_MS:
+            return int(now * 1000)
+        return datetime.fromtimestamp(now).isoformat()
+
+    def tick(self):
+        """Read the clock once for a tick, returning (simulated Unix time, timestamp)"""
+        now = self.time()
+        return now, self.stamp(now)
+
+def options(config):
+    """SimClock arguments from a server's config"""
+    return {
+        'speed': config.get('sim_speed', 1),
+        'start': config.get('sim_start'),
+        'timestamp_format': config.get('timestamp_format', ISO),
+    }
+
+def env_options():
+    """SimClock arguments from the DUMMYAPI_SIM_* environment variables"""
+    return {
+        'speed': float(os.environ.get('DUMMYAPI_SIM_SPEED', 1)),
+        'start': os.environ.get('DUMMYAPI_SIM_START'),
+        'timestamp_format': os.environ.get('DUMMYAPI_TIMESTAMPS', ISO),
+    }
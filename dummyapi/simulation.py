@@ -0,0 +1,734 @@
+#!/usr/bin/python
+
+# The simulation behind the generic and GeoJSON APIs.
+#
+# Both servers load collections from a config file, compile their update
+# rules, run them on the shared scheduler and send every tick's patch to
+# their Socket.IO subscribers. A Simulation holds all of that for one server:
+#
+#   loading     load_config() builds the data store and its plans from the
+#               config, or takes it from a recording (replay_file) or from
+#               the simulator's shared memory in a worker (see sharedstore.py)
+#   updating    one scheduler job per update interval runs tick(), which
+#               updates the collections, publishes the patch (change feed,
+#               snapshot, history, recording, shared ring) and sends it
+#   reloading   reload_config() applies a changed config file between ticks
+#               (see hotreload.py)
+#   sending     broadcast() slices a patch per subscription group, catch_up()
+#               and push_snapshots() bring lagging or reloaded clients back
+#   serving     cached_response() and encoded_response() send REST views in
+#               the wire format a request asked for, and the subscribe,
+#               unsubscribe and resync events are registered on the server
+#
+# The servers only add their routes and what differs between them: how a
+# collection is stored (store_entry), where its items keep their type
+# (type_path), and any indexes kept next to the store. The GeoJSON server
+# subclasses Simulation for its spatial indexes, viewports and position
+# streams, with the hooks index_collections, index_collection,
+# publish_changes, prepare_send, send_patch, catch_up and push_snapshots.
+
+import atexit
+import json
+import os
+import threading
+import time
+
+from flask import request
+from flask_socketio import emit, join_room, leave_room
+
+import serving
+import checkpoint
+import columnar
+import generate
+import history
+import hotreload
+import plans
+import replay
+import rooms
+import sendqueue
+import sharedstore
+import simclock
+import wire
+import wirecache
+from changefeed import ChangeFeed
+from scheduler import TickScheduler
+from snapshot import SnapshotStore, get_path
+
+class Simulation:
+    """The data store of one server, the updates that change it and the clients they are sent to"""
+
+    def __init__(self, config_file, app, socketio, send_queues, server_metrics):
+        # Path to the data configuration file
+        self.config_file = config_file
+        self.app = app
+        self.socketio = socketio
+        self.send_queues = send_queues
+        self.server_metrics = server_metrics
+
+        # Global data store
+        self.data_store = {}
+        self.config = {}
+
+        # The config file as it was last loaded, which reloads are diffed against
+        self.config_text = None
+
+        # Columnar engines by collection name, set up when config['engine'] is 'columnar'
+        self.engines = {}
+
+        # Compiled update plans by collection name
+        self.item_plans = {}
+
+        # Seconds between updates, by collection name
+        self.intervals = {}
+
+        # Simulated time, which ticks stamp their changes with (see simclock.py)
+        self.clock = simclock.SimClock()
+
+        # The one timer loop that runs every collection's updates
+        self.scheduler = TickScheduler(on_overrun=server_metrics.on_overrun, clock=self.clock)
+
+        # Sequenced patches of changed fields, broadcast instead of the whole store
+        self.feed = ChangeFeed()
+
+        # Immutable snapshots of data_store, which is only ever touched by the updater.
+        # REST handlers and socket emitters read snapshots.current instead.
+        self.snapshots = None
+
+        # Encoded views of the current snapshot, shared by every response and send
+        self.encoded = wirecache.EncodeCache(on_encode=server_metrics.on_encode)
+
+        # What each connected Socket.IO client subscribed to
+        self.subscriptions = rooms.SubscriptionRegistry()
+
+        # Recent values of the numeric fields each update changed
+        self.history_store = history.HistoryStore()
+
+        # (fingerprint, field paths) to checkpoint, by collection name
+        self.checkpoint_fields = {}
+
+        # Writes checkpoints in the background when config['checkpoint_file'] is set
+        self.checkpointer = None
+
+        # Appends every published patch to a log when config['record_file'] is set
+        self.recorder = None
+
+        # Plays a log back when config['replay_file'] is set
+        self.replayer = None
+
+        # Set in the worker processes of a multi-worker setup, which serve the
+        # simulator's state from shared memory (see sharedstore.py)
+        self.shared_reader = sharedstore.attach_from_env()
+
+        # The simulator's side of the shared memory when config['workers'] is set
+        self.shared_writer = None
+        self.shared_publisher = None
+
+        # Update jobs by name, with the collections each one updates
+        self.scheduled = {}
+
+        # Held while a tick mutates the store, so only one updater runs at a time
+        self.store_lock = threading.Lock()
+
+        self.register_events()
+
+    # Hooks for the servers
+
+    def type_path(self, collection):
+        """Get the field that holds the type of a collection's items"""
+        return 'type'
+
+    def store_entry(self, collection, items):
+        """Build the data store entry of a collection from the config"""
+        return {'items': items}
+
+    def index_collections(self, config_data):
+        """Build the server's own indexes of every collection after loading"""
+        for collection in config_data.get('collections', []):
+            self.index_collection(collection)
+
+    def index_collection(self, collection):
+        """Build (or, for a collection no longer in the store, drop) the server's own indexes of one collection"""
+
+    def prepare_send(self, patch):
+        """Get whatever else send_patch() needs for a patch; runs with store_lock held, right after publishing"""
+        return None
+
+    # Loading and reloading
+
+    def load_config(self):
+        """Load configuration from JSON file"""
+        try:
+            with open(self.config_file, 'r') as f:
+                self.config_text = f.read()
+            config_data = json.loads(self.config_text)
+
+            # Set global configuration
+            config = self.config = config_data.get('config', {})
+            self.send_queues.max_queued = config.get('client_max_queued', sendqueue.MAX_QUEUED)
+            self.clock.configure(**simclock.options(config))
+
+            replay_file = config.get('replay_file')
+            if self.shared_reader is not None:
+                # A worker serves what the simulator publishes (see sharedstore.py)
+                self.feed.seq, self.data_store = self.shared_reader.snapshot()
+                self.item_plans = {}
+                self.engines = {}
+            elif replay_file:
+                # Serve a recording instead of simulating (see replay.py)
+                self.feed.seq, self.data_store = replay.load_start(replay_file)
+                self.item_plans = {}
+                self.engines = {}
+                print(f"Replaying {replay_file} at {config.get('replay_speed', 1) or 'full'} speed")
+            else:
+                self.load_collections(config_data)
+
+            self.index_collections(config_data)
+
+            self.history_store = history.HistoryStore(self.history_sizes(config_data), ignore=plans.STAMP_PATHS)
+
+            # Publish the initial snapshot for readers
+            self.snapshots = SnapshotStore(self.data_store, self.feed.seq, type_path=self.type_path)
+
+            self.schedule_updates()
+
+            print(f"Loaded configuration with {len(self.data_store)} collections")
+            return True
+        except Exception as e:
+            print(f"Error loading configuration: {str(e)}")
+            return False
+
+    def history_sizes(self, config_data):
+        """Samples of history kept per field by collection name, 0 turns it off"""
+        return {
+            collection.get('name'): collection.get('history_size', self.config.get('history_size', history.DEFAULT_SIZE))
+            for collection in config_data.get('collections', []) if collection.get('name')
+        }
+
+    def load_collections(self, config_data):
+        """Build the data store and its update plans from the collections in the config"""
+        # Initialize data store from collections
+        for collection in config_data.get('collections', []):
+            if collection.get('name'):
+                items = self.expand_items(collection)
+                self.add_collection(collection, items, items)
+
+        # Continue from the last checkpoint, before anything reads the values
+        self.restore_checkpoint(self.config.get('checkpoint_file'))
+
+        # Compile the update rules once instead of interpreting them every tick
+        use_columnar = self.use_columnar_engine()
+        self.item_plans = {}
+        self.engines = {}
+        for name, collection in self.data_store.items():
+            self.set_plans(name, *self.compile_collection(name, collection['items'], self.intervals[name], use_columnar))
+
+    def expand_items(self, collection):
+        """Listed items plus the ones a "generate" block describes"""
+        seed = self.config.get('seed')
+        return generate.expand_collection(collection, None if seed is None else f"{seed}:{collection['name']}:generate")
+
+    def update_interval(self, collection):
+        """Collections may override the global update interval"""
+        return collection.get('update_interval', self.config.get('update_interval', 5))
+
+    def add_collection(self, collection, items, fresh):
+        """Put a collection from the config into the data store, with its fresh (not yet stored) items stamped"""
+        collection_name = collection['name']
+        if self.config.get('checkpoint_file'):
+            # Identifies the collection in checkpoints, taken before items are touched
+            self.checkpoint_fields[collection_name] = (checkpoint.fingerprint(collection), checkpoint.rule_paths(items))
+
+        # Add timestamp to each item
+        loaded_at = self.clock.stamp()
+        for item in fresh:
+            item['last_updated'] = loaded_at
+        self.intervals[collection_name] = self.update_interval(collection)
+
+        # Store collection in data_store
+        self.data_store[collection_name] = self.store_entry(collection, items)
+
+    def use_columnar_engine(self):
+        """Whether to batch the random_* rules into NumPy columns"""
+        use_columnar = self.config.get('engine') == 'columnar'
+        if use_columnar and not columnar.available():
+            print("NumPy is not installed, falling back to the python engine")
+            use_columnar = False
+        return use_columnar
+
+    def compile_collection(self, name, items, interval, use_columnar, reuse=None):
+        """Compile a collection's update plans, with its randomness seeded when config['seed'] is set
+
+        Returns the plans and the collection's columnar engine (or None). reuse
+        maps id() of items to plans to keep (see plans.compile_collection).
+        """
+        seed = self.config.get('seed')
+        rng = plans.collection_rng(seed, name)
+        skip_types = columnar.COLUMNAR_RULES if use_columnar else ()
+        ctx = plans.CompileContext(rng=rng, interval=interval, skip_types=skip_types)
+        compiled = plans.compile_collection(name, {'items': items}, ctx, reuse)
+        engine = None
+        if use_columnar:
+            engine_seed = rng.getrandbits(64) if seed is not None else None
+            engine = columnar.ColumnarEngine({name: compiled}, seed=engine_seed)
+        return compiled, engine
+
+    def set_plans(self, name, compiled, engine):
+        self.item_plans[name] = compiled
+        self.engines.pop(name, None)
+        if engine is not None:
+            self.engines[name] = engine
+
+    def reload_config(self, text, config_data):
+        """Apply a changed config file to the running simulation; runs on the scheduler thread, between ticks
+
+        See hotreload.py for what is kept and what is rebuilt.
+        """
+        start = time.perf_counter()
+        diff = hotreload.ConfigDiff(json.loads(self.config_text), config_data)
+        if diff.restart:
+            print(f"Restart the server to apply the new {', '.join(diff.restart)}")
+
+        old_config = self.config
+        config = self.config = config_data.get('config', {})
+        try:
+            # Everything that can fail on a bad config first, without touching the store
+            timestamp_format = simclock.options(config)['timestamp_format']
+            if timestamp_format not in simclock.FORMATS:
+                raise ValueError(f"Unknown timestamp format '{timestamp_format}'")
+            use_columnar = self.use_columnar_engine()
+            built = {}
+            for name in diff.added + diff.changed:
+                collection = diff.new[name]
+                if name in diff.added:
+                    items = fresh = self.expand_items(collection)
+                    reuse = None
+                else:
+                    items, fresh = hotreload.merge_items(diff.old[name], collection, self.data_store[name]['items'],
+                                                         diff.regenerate(name),
+                                                         lambda collection=collection: self.expand_items(dict(collection, items=[])))
+                    # Kept items keep their plans, unless what they were compiled with changed
+                    reuse = None
+                    if not diff.settings_changed(name):
+                        reuse = {id(plan.item): plan for plan in self.item_plans.get(name, ())}
+                compiled, engine = self.compile_collection(name, items, self.update_interval(collection), use_columnar, reuse)
+                built[name] = (collection, items, fresh, compiled, engine)
+        except Exception as e:
+            self.config = old_config
+            print(f"Not reloading {self.config_file}: {str(e)}")
+            return
+
+        self.config_text = text
+        self.send_queues.max_queued = config.get('client_max_queued', sendqueue.MAX_QUEUED)
+        self.clock.timestamp_format = timestamp_format
+        names = diff.names()
+        with self.store_lock:
+            for name in diff.removed:
+                for index in (self.data_store, self.item_plans, self.engines, self.intervals, self.checkpoint_fields):
+                    index.pop(name, None)
+                self.index_collection({'name': name})
+            for name, (collection, items, fresh, compiled, engine) in built.items():
+                self.add_collection(collection, items, fresh)
+                self.set_plans(name, compiled, engine)
+                self.index_collection(collection)
+
+            self.history_store.resize(self.history_sizes(config_data))
+            if names:
+                seq = self.feed.jump()
+                previous = self.snapshots.current
+                # Only the fresh items are copied, the kept ones share their copies in the last snapshot
+                snapshot = self.snapshots.replace(seq, {name: self.data_store.get(name) for name in names},
+                                                  {name: set(id(item) for item in built[name][2]) for name in diff.changed})
+                for name in diff.changed:
+                    # Forget the history of the items no longer in the config
+                    old_positions, positions = previous.positions[name], snapshot.positions[name]
+                    if old_positions is not positions:
+                        self.history_store.drop(name, old_positions.keys() - positions.keys())
+                self.schedule_updates()
+
+        if names:
+            self.push_snapshots(names)
+            if self.shared_publisher is not None:
+                # The workers resync to it when they see the jump in seq
+                self.shared_publisher.publish()
+            if self.recorder is not None:
+                print(f"The recording in {self.recorder.filename} does not include this reload")
+        print(f"Reloaded {self.config_file} ({diff.summary()}) in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def start_config_watch(self):
+        """Reload the config file when it changes, unless config['reload_interval'] is 0"""
+        interval = self.config.get('reload_interval', hotreload.RELOAD_INTERVAL)
+        if not interval:
+            return
+        # Parsed by the watcher thread, applied between ticks
+        watcher = hotreload.ConfigWatcher(self.config_file, interval, self.config_text,
+                                          lambda text, config_data: self.scheduler.call_soon(
+                                              lambda: self.reload_config(text, config_data)))
+        watcher.start()
+
+    # Checkpoints, recording, replay and workers
+
+    def restore_checkpoint(self, filename):
+        """Put the values saved in a checkpoint back into the data store"""
+        saved = checkpoint.load(filename)
+        if saved is None:
+            return
+        try:
+            for name, (digest, paths) in self.checkpoint_fields.items():
+                restored = saved.restore(name, self.data_store[name]['items'], digest)
+                if restored is None:
+                    print(f"Checkpoint does not match collection '{name}', starting it fresh")
+                else:
+                    print(f"Restored {restored} fields of '{name}' from {filename}")
+            # Keep sequence numbers increasing across the restart
+            self.feed.seq = max(self.feed.seq, saved.seq)
+        finally:
+            saved.close()
+
+    def collect_checkpoint(self):
+        """Get the state to checkpoint from the current snapshot, which ticks never mutate"""
+        snapshot = self.snapshots.current
+        # A collection a reload just added may not be in the snapshot yet
+        return snapshot.seq, {name: (digest, snapshot.data[name]['items'], paths)
+                              for name, (digest, paths) in list(self.checkpoint_fields.items()) if name in snapshot.data}
+
+    def start_checkpoints(self):
+        """Start writing checkpoints in the background if the config asks for them"""
+        filename = self.config.get('checkpoint_file')
+        if not filename or self.checkpointer is not None:
+            return
+        self.checkpointer = checkpoint.Checkpointer(
+            filename, self.config.get('checkpoint_interval', checkpoint.DEFAULT_INTERVAL), self.collect_checkpoint)
+        self.checkpointer.start()
+        # One last checkpoint on the way out
+        atexit.register(self.checkpointer.stop)
+
+    def start_recording(self):
+        """Start recording the run if the config asks for it (not while replaying)"""
+        filename = self.config.get('record_file')
+        if not filename or self.config.get('replay_file') or self.recorder is not None:
+            return
+        snapshot = self.snapshots.current
+        self.recorder = replay.Recorder(filename, snapshot.seq, snapshot.data)
+        atexit.register(self.recorder.stop)
+        print(f"Recording to {filename}")
+
+    def start_replay(self):
+        """Start playing the recording back if the config asks for it"""
+        filename = self.config.get('replay_file')
+        if not filename or self.replayer is not None:
+            return
+        self.replayer = replay.Replayer(filename, self.config.get('replay_speed', 1), self.replay_tick)
+        self.replayer.start()
+
+    def collect_shared(self):
+        """Get the current snapshot and the shared ring position it was taken at"""
+        with self.store_lock:
+            snapshot = self.snapshots.current
+            return snapshot.seq, self.shared_writer.head, snapshot.data
+
+    def start_shared_store(self):
+        """Create the shared memory the workers replicate the data store from and publish the first snapshot"""
+        self.shared_writer = sharedstore.SharedWriter(self.config.get('shared_memory_mb', sharedstore.DEFAULT_SIZE_MB))
+        atexit.register(self.shared_writer.close)
+        self.shared_publisher = sharedstore.SnapshotPublisher(self.shared_writer, self.config.get(
+            'shared_snapshot_interval', sharedstore.SNAPSHOT_INTERVAL), self.collect_shared)
+        self.shared_publisher.publish()
+        self.shared_publisher.start()
+        print(f"Replicating the data store to the workers through {self.shared_writer.name}")
+
+    def follow_simulator(self):
+        """Publish and broadcast the simulator's ticks in a worker"""
+        while self.shared_reader.simulator_alive():
+            time.sleep(sharedstore.POLL_INTERVAL)
+            ticks = self.shared_reader.poll()
+            if ticks is None:
+                # Fell behind the ring, or the simulator reloaded its config
+                print("Worker lost track of the simulator, reloading its snapshot")
+                with self.store_lock:
+                    self.load_config()
+                self.push_snapshots()
+                continue
+            for changes in ticks:
+                self.replay_tick(changes)
+        print("The simulator exited, stopping this worker")
+        os._exit(0)
+
+    # Updating
+
+    def update_data(self, collection_names=None):
+        """Update data items according to their compiled update plans
+
+        Updates every collection, or only the given ones. Returns the patch of
+        changed fields (collection -> item id -> field path -> value).
+        """
+        if collection_names is None:
+            collection_names = list(self.item_plans)
+        # One timestamp for every item of the tick
+        timestamp = self.clock.stamp()
+        patch = {}
+        for name in collection_names:
+            patch.update(plans.run_tick({name: self.item_plans[name]}, self.engines.get(name), timestamp))
+        return patch
+
+    def publish_changes(self, changes):
+        """Sequence a tick's changes and publish the snapshot they lead to; call with store_lock held"""
+        if not changes:
+            return None
+        patch = self.feed.publish(changes)
+        self.snapshots.apply(patch)
+        self.history_store.record(self.clock.time(), changes)
+        if self.recorder is not None:
+            self.recorder.record(patch)
+        if self.shared_writer is not None:
+            self.shared_writer.append(patch['seq'], changes)
+        return patch
+
+    def tick(self, collection_names, job_name):
+        """Update some collections, publish the result and broadcast the patch"""
+        with self.store_lock:
+            start = time.perf_counter()
+            changes = self.update_data(collection_names)
+            self.server_metrics.update_seconds.observe((job_name,), time.perf_counter() - start)
+            patch = self.publish_changes(changes)
+            prepared = self.prepare_send(patch) if patch is not None else None
+
+        # Only the changed fields go out, tagged with their sequence number
+        if patch is not None:
+            self.send_patch(patch, prepared)
+
+    def replay_tick(self, changes):
+        """Publish and broadcast one tick of a recording"""
+        with self.store_lock:
+            patch = self.publish_changes(changes)
+            prepared = self.prepare_send(patch) if patch is not None else None
+        if patch is not None:
+            self.send_patch(patch, prepared)
+
+    def schedule_updates(self):
+        """Register one scheduler job per distinct update interval, keeping jobs whose collections are the same"""
+        by_interval = {}
+        for name, interval in self.intervals.items():
+            by_interval.setdefault(interval, []).append(name)
+        jobs = {f"update-{interval}s": (interval, collection_names) for interval, collection_names in by_interval.items()}
+        for job_name in list(self.scheduled):
+            if job_name not in jobs:
+                self.scheduler.remove_job(job_name)
+                del self.scheduled[job_name]
+        for job_name, (interval, collection_names) in jobs.items():
+            if self.scheduled.get(job_name) == collection_names:
+                continue
+            self.scheduled[job_name] = collection_names
+            self.scheduler.add_job(job_name, interval,
+                                   lambda names=collection_names, job_name=job_name: self.tick(names, job_name))
+
+    # Sending
+
+    def get_item_type(self, snapshot, collection_name, item_id):
+        """Get the type of an item in a snapshot"""
+        index = snapshot.positions[collection_name].get(item_id)
+        if index is None:
+            return None
+        return get_path(snapshot.data[collection_name]['items'][index], snapshot.type_paths[collection_name])
+
+    def get_snapshot(self, group=None):
+        """Get the current snapshot (or the part a subscription group asked for) with its sequence number
+
+        Encoded once per version, group and wire format.
+        """
+        snapshot = self.snapshots.current
+        fmt = group.fmt if group is not None else wire.DEFAULT
+        if group is None or group.everything:
+            return self.encoded.get(snapshot.seq, ('snapshot', fmt), lambda: {'seq': snapshot.seq, 'data': snapshot.data},
+                                    wire.encoder(fmt))
+
+        item_type = lambda collection_name, item_id: self.get_item_type(snapshot, collection_name, item_id)
+        return self.encoded.get(snapshot.seq, ('snapshot', group.room), lambda: {
+            'seq': snapshot.seq,
+            'data': group.select(snapshot.data, snapshot.positions, item_type)
+        }, wire.encoder(fmt))
+
+    def broadcast(self, patch, skip):
+        """Send every subscription group its slice of a patch, merging it into the backlogs of the clients in skip"""
+        start = time.perf_counter()
+        held = {}
+        for sid, backlog in self.send_queues.backlogs():
+            held.setdefault(self.subscriptions.group_of(sid), []).append(backlog)
+
+        snapshot = self.snapshots.current
+        item_type = lambda collection_name, item_id: self.get_item_type(snapshot, collection_name, item_id)
+        for group in self.subscriptions.groups():
+            changes = group.slice(patch['changes'], item_type)
+            if not changes:
+                continue
+            # Sliced once and encoded once per group, however many clients are in it
+            message = {'seq': patch['seq'], 'prev': group.last_seq, 'changes': changes}
+            raw = self.server_metrics.encode('patch', wire.encoder(group.fmt), message)
+            self.socketio.emit('data_patch', wire.socket_payload(raw), to=group.room, skip_sid=skip)
+            backlogs = held.get(group, ())
+            for backlog in backlogs:
+                backlog.merge(group.last_seq, patch['seq'], changes)
+            self.server_metrics.emitted('data_patch', raw, group.members - len(backlogs))
+            group.last_seq = patch['seq']
+        self.server_metrics.emit_seconds.observe(('data_patch',), time.perf_counter() - start)
+
+    def send_patch(self, patch, prepared):
+        """Broadcast a published patch to subscribers
+
+        Clients that lag are skipped and caught up once their queue drained (see sendqueue.py).
+        """
+        self.broadcast(patch, self.send_queues.skip)
+        self.catch_up_drained()
+
+    def catch_up_drained(self):
+        """Clients whose queue drained get the broadcasts again from the next tick on"""
+        for sid, backlog in self.send_queues.check(self.subscriptions.sids):
+            self.catch_up(sid, backlog)
+
+    def catch_up(self, sid, backlog):
+        """Send a client that stopped lagging the changes it was held back from, merged into one patch"""
+        group = self.subscriptions.group_of(sid)
+        if group is None or not backlog.changes:
+            return
+        message = {'seq': backlog.seq, 'prev': backlog.prev, 'changes': backlog.changes}
+        raw = self.server_metrics.encode('patch', wire.encoder(group.fmt), message)
+        self.socketio.emit('data_patch', wire.socket_payload(raw), to=sid)
+        self.server_metrics.emitted('data_patch', raw)
+
+    def push_snapshots(self, collection_names=None):
+        """Send a new snapshot to every subscription group covering one of the collections (by default all of them)"""
+        groups = [group for group in self.subscriptions.groups()
+                  if collection_names is None or group.covers(collection_names)]
+        # The snapshots supersede what their lagging clients were held back from
+        for sid, backlog in self.send_queues.backlogs():
+            if self.subscriptions.group_of(sid) in groups:
+                self.send_queues.reset(sid)
+        for group in groups:
+            raw = self.get_snapshot(group)
+            self.socketio.emit('data_snapshot', wire.socket_payload(raw), to=group.room)
+            self.server_metrics.emitted('data_snapshot', raw, group.members)
+            group.last_seq = self.snapshots.current.seq
+
+    # Serving
+
+    def cached_response(self, snapshot, key, build):
+        """Send a view of a snapshot in the wire format the request asked for, encoded once per version and format"""
+        fmt = wire.negotiate(request)
+        return wire.response(self.encoded.get(snapshot.seq, key + (fmt,), build, wire.encoder(fmt)), fmt)
+
+    def encoded_response(self, payload):
+        """Send a one-off payload in the wire format the request asked for"""
+        fmt = wire.negotiate(request)
+        return wire.response(self.server_metrics.encode('response', wire.encoder(fmt), payload), fmt)
+
+    def register_events(self):
+        """Register the Socket.IO events every server handles"""
+        for event, handler in (('connect', self.handle_connect), ('disconnect', self.handle_disconnect),
+                               ('subscribe', self.handle_subscribe), ('unsubscribe', self.handle_unsubscribe),
+                               ('resync', self.handle_resync), ('start_background', self.start_background_task)):
+            self.socketio.on(event)(handler)
+
+    def handle_connect(self):
+        print('Client connected')
+        # Everyone starts out subscribed to everything
+        old_group, group = self.subscriptions.set(request.sid, [(rooms.ALL,)], wire.socket_format(request))
+        join_room(group.room)
+        self.server_metrics.connections.inc()
+        self.send_snapshot(group)  # Send initial data on connect
+
+    def handle_disconnect(self):
+        print('Client disconnected')
+        self.subscriptions.remove(request.sid)
+        self.send_queues.remove(request.sid)
+
+    def send_snapshot(self, group):
+        """Send the current client a snapshot of what its group subscribes to"""
+        raw = self.get_snapshot(group)
+        emit('data_snapshot', wire.socket_payload(raw))
+        self.server_metrics.emitted('data_snapshot', raw)
+
+    def change_subscription(self, old_group, group):
+        """Move the current client to its new subscription group and send it what it now subscribes to"""
+        if old_group is group:
+            return
+        if old_group is not None:
+            leave_room(old_group.room)
+        join_room(group.room)
+        # The snapshot supersedes anything held back for the old subscriptions
+        self.send_queues.reset(request.sid)
+        self.send_snapshot(group)
+
+    def handle_subscribe(self, data=None):
+        """Receive updates for a collection, an item ({collection, id}) or a type ({collection, type})"""
+        key = rooms.subscription_key(data)
+        if key is None:
+            emit('error', {'error': 'Invalid subscription'})
+            return
+        self.change_subscription(*self.subscriptions.subscribe(request.sid, key))
+
+    def handle_unsubscribe(self, data=None):
+        """Stop receiving updates for a subscription"""
+        key = rooms.subscription_key(data)
+        if key is None:
+            emit('error', {'error': 'Invalid subscription'})
+            return
+        self.change_subscription(*self.subscriptions.unsubscribe(request.sid, key))
+
+    def handle_resync(self, data=None):
+        """Catch up a client that detected a gap in the patch sequence"""
+        group = self.subscriptions.group_of(request.sid)
+        if group is None:
+            # Every client gets a group on connect, so this one is gone: it has
+            # no subscriptions or format to resync with and has to reconnect
+            emit('error', {'error': 'Unknown client, reconnect to resync'})
+            return
+        since = data.get('since') if isinstance(data, dict) else None
+        patches = self.feed.since(since) if isinstance(since, int) and since >= 0 else None
+        if patches is None:
+            # Too far behind (or no sequence number given), start over from a snapshot
+            self.send_snapshot(group)
+            return
+
+        snapshot = self.snapshots.current
+        item_type = lambda collection_name, item_id: self.get_item_type(snapshot, collection_name, item_id)
+        prev = since
+        for patch in patches:
+            changes = group.slice(patch['changes'], item_type)
+            if changes:
+                message = {'seq': patch['seq'], 'prev': prev, 'changes': changes}
+                raw = wire.encoder(group.fmt)(message)
+                emit('data_patch', wire.socket_payload(raw))
+                self.server_metrics.emitted('data_patch', raw)
+                prev = patch['seq']
+
+    def start_background_task(self):
+        # Every dashboard asks for this, but there is only ever one scheduler
+        self.scheduler.start()
+
+    # Running
+
+    def main(self, script):
+        """Run the server started as script: a worker, the simulator of some workers, or on its own"""
+        if not self.load_config():
+            print(f"Failed to load configuration from {self.config_file}")
+        elif self.shared_reader is not None:
+            # A worker: serve a replica of the simulator's state, sharing the port with the other workers
+            threading.Thread(target=self.follow_simulator, name='follower', daemon=True).start()
+            serving.run(self.socketio, self.app, port=5000, reuse_port=True)
+        else:
+            if self.config.get('workers'):
+                # This process only simulates, share its data store with the workers
+                self.start_shared_store()
+
+            # Start the background updates, or the replay
+            self.start_recording()
+            self.scheduler.start()
+            self.start_replay()
+            if not self.config.get('replay_file'):
+                self.start_checkpoints()
+                self.start_config_watch()
+
+            if self.config.get('workers'):
+                sharedstore.run_workers(script, self.config['workers'], self.shared_writer.name)
+            else:
+                # Run the Flask app with SocketIO (see serving.py for the async modes)
+                serving.run(self.socketio, self.app, port=5000)
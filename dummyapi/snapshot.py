@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+# Copy-on-write snapshots of the data store.
+#
+# The background updater mutates the live data store in place. Readers (REST
+# handlers, socket emitters) never touch it: they read SnapshotStore.current,
+# an immutable view of the store at one sequence number. After each tick the
+# updater builds the next snapshot from the previous one plus the tick's patch
+# and publishes it with a single reference assignment, so readers never need a
+# lock and never see a half-applied tick.
+#
+# Building the next snapshot only copies what changed: the collections that
+# appear in the patch, their items list, and for each changed item the dicts
+# along the paths of its changed fields. Everything else is shared with the
+# previous snapshot. This relies on patch values never being mutated after
+# they are published (see plans.py), so they can be shared as well.
+#
+# Snapshots are plain dicts and lists so they can be passed straight to
+# jsonify() and emit(). Treat them as read-only.
+#
+# Every snapshot also carries the lookup indexes readers need, as of that
+# snapshot: item id -> position and item type -> positions (in collection
+# order) for every collection, plus where each collection keeps its types.
+# A reader that holds a snapshot uses its indexes, never the store's, so the
+# indexes always match the items it reads. They are copy-on-write like the
+# data: positions only change when a config reload replaces a collection (see
+# hotreload.py), so the id index of a collection is shared by every snapshot
+# until then; a patch that changes an item's type field copies that
+# collection's type index and changes the copy.
+
+import bisect
+import copy
+
+class Snapshot:
+    """The data store as of one sequence number, with its indexes by collection name"""
+
+    __slots__ = ('seq', 'data', 'positions', 'by_type', 'type_paths')
+
+    def __init__(self, seq, data, positions, by_type, type_paths):
+        self.seq = seq
+        self.data = data
+        self.positions = positions
+        self.by_type = by_type
+        self.type_paths = type_paths
+
+def item_positions(items):
+    """Map each item's id (or its position if it has none) to its position in the items list"""
+    return {item.get('id', index): index for index, item in enumerate(items)}
+
+def get_path(item, path):
+    """Get a dot-separated path from an item, or None if it is missing"""
+    value = item
+    for part in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+def type_positions(items, type_path):
+    """Map each item type to the positions of the items of that type"""
+    by_type = {}
+    for index, item in enumerate(items):
+        item_type = get_path(item, type_path)
+        if item_type is not None:
+            by_type.setdefault(item_type, []).append(index)
+    return by_type
+
+def move_type(by_type, index, old_type, new_type):
+    """Move an item to another type in a type index that is not shared with any snapshot yet"""
+    if old_type is not None and old_type in by_type:
+        members = list(by_type[old_type])
+        members.remove(index)
+        if members:
+            by_type[old_type] = members
+        else:
+            del by_type[old_type]
+    if new_type is not None:
+        # Replaced rather than changed in place, the lists are shared with older snapshots
+        members = list(by_type.get(new_type, []))
+        bisect.insort(members, index)
+        by_type[new_type] = members
+
+def with_changes(item, fields):
+    """Return a copy of a snapshot item with the patched fields set, sharing everything else"""
+    new_item = dict(item)
+    copied = {}
+    for path, value in fields.items():
+        parts = path.split('.')
+        container = new_item
+        prefix = ''
+        for part in parts[:-1]:
+            prefix += part + '.'
+            child = copied.get(prefix)
+            if child is None:
+                key = int(part) if isinstance(container, list) else part
+                child = container[key]
+                child = list(child) if isinstance(child, list) else dict(child)
+                container[key] = child
+                copied[prefix] = child
+            container = child
+        key = parts[-1]
+        container[int(key) if isinstance(container, list) else key] = value
+    return new_item
+
+class SnapshotStore:
+    """Publishes immutable snapshots of a live data store"""
+
+    def __init__(self, data_store, seq=0, type_path=None):
+        # type_path(collection) says where a collection's items keep their type
+        self.type_path = type_path or (lambda collection: 'type')
+        positions, by_type, type_paths = {}, {}, {}
+        for name, collection in data_store.items():
+            positions[name], by_type[name], type_paths[name] = self.index(collection)
+        self.current = Snapshot(seq, copy.deepcopy(data_store), positions, by_type, type_paths)
+
+    def apply(self, patch):
+        """Publish the snapshot for a patch from the change feed, and return it"""
+        previous = self.current
+        data = dict(previous.data)
+        # Shared with the previous snapshot unless a type changes
+        by_type = previous.by_type
+
+        for collection_name, item_changes in patch['changes'].items():
+            collection = data.get(collection_name)
+            if collection is None:
+                continue
+            positions = previous.positions[collection_name]
+            type_path = previous.type_paths[collection_name]
+            types = None
+            items = list(collection['items'])
+            for item_id, fields in item_changes.items():
+                index = positions.get(item_id)
+                if index is not None:
+                    if type_path in fields:
+                        if types is None:
+                            if by_type is previous.by_type:
+                                by_type = dict(by_type)
+                            types = by_type[collection_name] = dict(by_type[collection_name])
+                        move_type(types, index, get_path(items[index], type_path), fields[type_path])
+                    items[index] = with_changes(items[index], fields)
+            collection = dict(collection)
+            collection['items'] = items
+            data[collection_name] = collection
+
+        snapshot = Snapshot(patch['seq'], data, previous.positions, by_type, previous.type_paths)
+        self.current = snapshot
+        return snapshot
+
+    def replace(self, seq, collections, fresh=None):
+        """Publish a snapshot with whole collections replaced (by their live collection) or removed (None)
+
+        fresh maps collection name -> id() of the items new since the last
+        snapshot. The other items of those collections are the same live
+        items as before, so their copies are shared with the last snapshot.
+        Collections without an entry are copied whole.
+        """
+        previous = self.current
+        data = dict(previous.data)
+        positions = dict(previous.positions)
+        by_type = dict(previous.by_type)
+        type_paths = dict(previous.type_paths)
+        for name, collection in collections.items():
+            if collection is None:
+                for index in (data, positions, by_type, type_paths):
+                    index.pop(name, None)
+            elif fresh is not None and name in fresh and name in previous.data:
+                data[name], positions[name], by_type[name], type_paths[name] = self.shared_copy(
+                    name, collection, previous, fresh[name])
+            else:
+                data[name] = copy.deepcopy(collection)
+                positions[name], by_type[name], type_paths[name] = self.index(collection)
+        snapshot = Snapshot(seq, data, positions, by_type, type_paths)
+        self.current = snapshot
+        return snapshot
+
+    def index(self, collection):
+        """Build the indexes of a collection: (positions, by_type, type_path)"""
+        type_path = self.type_path(collection)
+        return item_positions(collection['items']), type_positions(collection['items'], type_path), type_path
+
+    def shared_copy(self, name, collection, previous, fresh):
+        """Copy a live collection, sharing the previous snapshot's copies of the items whose id() is not in fresh
+
+        Returns the copy and its indexes. When every item kept its position,
+        only the fresh items are copied, the id index is shared and the type
+        index is copied only if a fresh item changed type. Otherwise the
+        indexes are rebuilt.
+        """
+        live = collection['items']
+        old_items = previous.data[name]['items']
+        positions = previous.positions[name]
+        type_path = self.type_path(collection)
+        result = {key: copy.deepcopy(value) for key, value in collection.items() if key != 'items'}
+
+        if (len(live) == len(old_items) and type_path == previous.type_paths[name]
+                and [item.get('id', index) for index, item in enumerate(live)] == list(positions)):
+            items = list(old_items)
+            by_type = previous.by_type[name]
+            for index in [index for index, item in enumerate(live) if id(item) in fresh]:
+                item = items[index] = copy.deepcopy(live[index])
+                old_type = get_path(old_items[index], type_path)
+                new_type = get_path(item, type_path)
+                if old_type != new_type:
+                    if by_type is previous.by_type[name]:
+                        by_type = dict(by_type)
+                    move_type(by_type, index, old_type, new_type)
+            result['items'] = items
+            return result, positions, by_type, type_path
+
+        items = []
+        for index, item in enumerate(live):
+            old_index = None if id(item) in fresh else positions.get(item.get('id', index))
+            # Items without an id are only known by their position
+            if old_index is not None and ('id' in item or old_index == index):
+                items.append(old_items[old_index])
+            else:
+                items.append(copy.deepcopy(item))
+        result['items'] = items
+        return (result,) + self.index(collection)
@@ -0,0 +1,399 @@
+#!/usr/bin/python
+
+# Spatial index for GeoJSON collections.
+#
+# Point features are kept in a uniform grid of cells, cell_size degrees on a
+# side. A bbox query only visits the cells that overlap the box, so it costs
+# about the number of points in view rather than the size of the collection,
+# and cells that lie completely inside the box are taken without testing
+# their points. A nearest query searches rings of cells outwards from the
+# query point until nothing further out can be closer.
+#
+# The index is maintained incrementally: the updater passes it the new
+# coordinates from each tick's patch, and a point that stays in its cell only
+# has its position updated. Features that are not Points (e.g. LineStrings)
+# are kept with their bounding box and tested one by one; collections
+# usually have few of them and they don't move.
+#
+# Distances are planar in degrees with longitude scaled by the cosine of the
+# query latitude, matching the simplified movement model in api_geo.py.
+#
+# For zoomed out maps the index can also keep cluster levels: for a few zoom
+# levels, a coarser grid with the count and centroid of the points in each
+# cell. A cluster cell is a square of whole grid cells, about the size the
+# zoom level asks for, so a level only has to know which grid cells are
+# occupied: a point moving inside its grid cell never changes cluster cell,
+# and a tick costs the levels nothing but forgetting their centroids. These
+# are summed again from the points when a cell is next queried, so they
+# never drift. A level is only built when a clustered view first asks for it,
+# and is dropped again after CLUSTER_IDLE_TICKS ticks without one.
+
+import math
+import threading
+
+# Rough length of one degree of latitude
+KM_PER_DEGREE = 111.32
+
+# Aim for about this many points per cell when the cell size is not configured
+POINTS_PER_CELL = 16
+
+# Cluster cells across one 256 px map tile at a cluster level's own zoom
+CLUSTER_CELLS_PER_TILE = 8
+
+# Drop a cluster level after this many ticks without a clustered query
+CLUSTER_IDLE_TICKS = 100
+
+def geometry_bounds(geometry):
+    """Get (min_lon, min_lat, max_lon, max_lat) of any GeoJSON geometry, or None if it has no coordinates"""
+    if not isinstance(geometry, dict):
+        return None
+    if geometry.get('type') == 'GeometryCollection':
+        bounds = [geometry_bounds(child) for child in geometry.get('geometries', [])]
+        bounds = [b for b in bounds if b is not None]
+        if not bounds:
+            return None
+        return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+                max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+    lons = []
+    lats = []
+    stack = [geometry.get('coordinates')]
+    while stack:
+        value = stack.pop()
+        if not isinstance(value, list) or not value:
+            continue
+        if isinstance(value[0], (int, float)):
+            if len(value) >= 2:
+                lons.append(value[0])
+                lats.append(value[1])
+        else:
+            stack.extend(value)
+    if not lons:
+        return None
+    return (min(lons), min(lats), max(lons), max(lats))
+
+def point_of(feature):
+    """Get (lon, lat) of a Point feature, or None"""
+    geometry = feature.get('geometry')
+    if isinstance(geometry, dict) and geometry.get('type') == 'Point':
+        coordinates = geometry.get('coordinates')
+        if isinstance(coordinates, list) and len(coordinates) >= 2:
+            return coordinates[0], coordinates[1]
+    return None
+
+def auto_cell_size(points):
+    """Pick a cell size that puts about POINTS_PER_CELL points in each cell"""
+    if len(points) < 2:
+        return 1.0
+    lons = [lon for lon, lat in points]
+    lats = [lat for lon, lat in points]
+    area = max(max(lons) - min(lons), 0.01) * max(max(lats) - min(lats), 0.01)
+    return min(10.0, max(0.001, math.sqrt(area * POINTS_PER_CELL / len(points))))
+
+def parse_bbox(value):
+    """Parse 'minLon,minLat,maxLon,maxLat' (or a list of four numbers), returning a tuple of floats or None if it is invalid"""
+    try:
+        parts = value if isinstance(value, (list, tuple)) else value.split(',')
+        bbox = tuple(float(part) for part in parts)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if len(bbox) != 4 or not all(math.isfinite(v) for v in bbox) or bbox[1] > bbox[3]:
+        return None
+    return bbox
+
+class ClusterLevel:
+    """The grid's cells grouped into the coarser cells of one zoom level, with the centroid and count of each"""
+
+    def __init__(self, zoom, grid_cell_size):
+        self.zoom = zoom
+        # Whole grid cells per side, so a point only changes cluster cell when it changes grid cell
+        self.factor = max(1, round(360.0 / (2 ** zoom) / CLUSTER_CELLS_PER_TILE / grid_cell_size))
+        self.cell_size = self.factor * grid_cell_size
+        # (cell x, cell y) -> set of the occupied grid cells in it
+        self.cells = {}
+        # (cell x, cell y) -> [centroid lon, centroid lat, count], for the grid's version
+        self.clusters = {}
+        self.version = 0
+        # Index tick of the last query, see GridIndex.move()
+        self.last_used = 0
+
+    def cell(self, lon, lat):
+        return (math.floor(lon / self.cell_size), math.floor(lat / self.cell_size))
+
+    def add_cell(self, grid_cell):
+        cell = (grid_cell[0] // self.factor, grid_cell[1] // self.factor)
+        self.cells.setdefault(cell, set()).add(grid_cell)
+
+    def remove_cell(self, grid_cell):
+        cell = (grid_cell[0] // self.factor, grid_cell[1] // self.factor)
+        grid_cells = self.cells[cell]
+        grid_cells.discard(grid_cell)
+        if not grid_cells:
+            del self.cells[cell]
+
+    def cluster(self, cell, totals):
+        """Get [centroid lon, centroid lat, count] of a cell, adding up the totals of its grid cells"""
+        cluster = self.clusters.get(cell)
+        if cluster is None:
+            parts = [totals(grid_cell) for grid_cell in self.cells[cell]]
+            count = sum(part[0] for part in parts)
+            cluster = self.clusters[cell] = [round(math.fsum(part[1] for part in parts) / count, 6),
+                                             round(math.fsum(part[2] for part in parts) / count, 6), count]
+        return cluster
+
+    def query(self, totals, min_lon, min_lat, max_lon, max_lat):
+        """Return [centroid lon, centroid lat, count] for each cell overlapping a bounding box
+
+        totals(grid cell) returns (count, sum of lons, sum of lats) of a grid cell's points.
+        """
+        x0, y0 = self.cell(min_lon, min_lat)
+        x1, y1 = self.cell(max_lon, max_lat)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            candidates = [cell for cell in self.cells if x0 <= cell[0] <= x1 and y0 <= cell[1] <= y1]
+        else:
+            cells = self.cells
+            candidates = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in cells]
+        return [list(self.cluster(cell, totals)) for cell in candidates]
+
+class GridIndex:
+    """Uniform grid over the features of one GeoJSON collection"""
+
+    def __init__(self, cell_size=1.0, cluster_zooms=()):
+        self.cell_size = cell_size
+        self.lock = threading.Lock()
+        # Zoom levels that can be clustered, coarsest first
+        self.cluster_zooms = sorted(cluster_zooms)
+        # zoom -> ClusterLevel, for the levels that were queried lately
+        self.clusters = {}
+        # Ticks moved so far, to find idle cluster levels
+        self.ticks = 0
+        # Bumped by every change to the points, to know when cached totals are stale
+        self.version = 0
+        # (cell x, cell y) -> (count, sum of lons, sum of lats), for totals_version
+        self.totals = {}
+        self.totals_version = 0
+        # (cell x, cell y) -> {item id: (lon, lat)}
+        self.cells = {}
+        # item id -> cell, for points
+        self.cell_of = {}
+        # item id -> bounding box, for other geometries
+        self.extents = {}
+
+    @classmethod
+    def build(cls, features, cell_size=None, cluster_zooms=()):
+        """Index every feature of a collection, keyed by id (or position if it has none)"""
+        points = {}
+        extents = {}
+        for index, feature in enumerate(features):
+            item_id = feature.get('id', index)
+            point = point_of(feature)
+            if point is not None:
+                points[item_id] = point
+            else:
+                bounds = geometry_bounds(feature.get('geometry'))
+                if bounds is not None:
+                    extents[item_id] = bounds
+
+        grid = cls(cell_size or auto_cell_size(list(points.values())), cluster_zooms)
+        for item_id, (lon, lat) in points.items():
+            grid.insert(item_id, lon, lat)
+        grid.extents = extents
+        return grid
+
+    def cell(self, lon, lat):
+        return (math.floor(lon / self.cell_size), math.floor(lat / self.cell_size))
+
+    def insert(self, item_id, lon, lat):
+        """Add a point (call with the lock held once the index is shared)"""
+        cell = self.cell(lon, lat)
+        self.version += 1
+        members = self.cells.get(cell)
+        if members is None:
+            members = self.cells[cell] = {}
+            for level in self.clusters.values():
+                level.add_cell(cell)
+        members[item_id] = (lon, lat)
+        self.cell_of[item_id] = cell
+
+    def remove(self, item_id):
+        """Drop a point, if it is indexed"""
+        cell = self.cell_of.pop(item_id, None)
+        if cell is not None:
+            self.version += 1
+            members = self.cells[cell]
+            del members[item_id]
+            if not members:
+                del self.cells[cell]
+                for level in self.clusters.values():
+                    level.remove_cell(cell)
+
+    def move(self, moves):
+        """Apply new positions from a tick, as (item id, [lon, lat]) pairs"""
+        with self.lock:
+            self.ticks += 1
+            for zoom, level in list(self.clusters.items()):
+                if self.ticks - level.last_used > CLUSTER_IDLE_TICKS:
+                    del self.clusters[zoom]
+            if moves:
+                self.version += 1
+            cells = self.cells
+            cell_of = self.cell_of
+            cell_size = self.cell_size
+            floor = math.floor
+            for item_id, coordinates in moves:
+                lon, lat = coordinates[0], coordinates[1]
+                old_cell = cell_of.get(item_id)
+                new_cell = (floor(lon / cell_size), floor(lat / cell_size))
+                if old_cell == new_cell:
+                    # Most moves stay inside their cell
+                    cells[new_cell][item_id] = (lon, lat)
+                    continue
+                if old_cell is not None:
+                    self.remove(item_id)
+                self.insert(item_id, lon, lat)
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat):
+        """Return the ids of the features inside (or overlapping) a bounding box
+
+        A box with min_lon > max_lon crosses the antimeridian.
+        """
+        if min_lon > max_lon:
+            return (self.query_bbox(min_lon, min_lat, 180.0, max_lat) +
+                    self.query_bbox(-180.0, min_lat, max_lon, max_lat))
+
+        result = []
+        with self.lock:
+            x0, y0 = self.cell(min_lon, min_lat)
+            x1, y1 = self.cell(max_lon, max_lat)
+            if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+                # A box wider than the data, walking the occupied cells is cheaper
+                candidates = [cell for cell in self.cells if x0 <= cell[0] <= x1 and y0 <= cell[1] <= y1]
+            else:
+                cells = self.cells
+                candidates = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1) if (x, y) in cells]
+
+            for x, y in candidates:
+                members = self.cells[(x, y)]
+                if x0 < x < x1 and y0 < y < y1:
+                    # Inner cells are completely inside the box
+                    result.extend(members)
+                    continue
+                for item_id, (lon, lat) in members.items():
+                    if min_lon <= lon <= max_lon and min_lat <= lat <= max_lat:
+                        result.append(item_id)
+
+            for item_id, bounds in self.extents.items():
+                if bounds[0] <= max_lon and bounds[2] >= min_lon and bounds[1] <= max_lat and bounds[3] >= min_lat:
+                    result.append(item_id)
+        return result
+
+    def cluster_zoom(self, zoom):
+        """Get the finest clustered zoom level at or below a zoom level (the coarsest one below them all)"""
+        if not self.cluster_zooms:
+            return None
+        level = self.cluster_zooms[0]
+        for candidate in self.cluster_zooms:
+            if candidate <= zoom:
+                level = candidate
+        return level
+
+    def cluster_level(self, zoom):
+        """Get the cluster level of a clustered zoom level, building it from the grid if it is not kept (call with the lock held)"""
+        level = self.clusters.get(zoom)
+        if level is None:
+            level = self.clusters[zoom] = ClusterLevel(zoom, self.cell_size)
+            for cell in self.cells:
+                level.add_cell(cell)
+        level.last_used = self.ticks
+        if level.version != self.version:
+            level.clusters = {}
+            level.version = self.version
+        return level
+
+    def cell_totals(self, cell):
+        """Get (count, sum of lons, sum of lats) of the points in a grid cell (call with the lock held)"""
+        if self.totals_version != self.version:
+            # The first cell asked for since the points changed, forget the old totals
+            self.totals = {}
+            self.totals_version = self.version
+        totals = self.totals.get(cell)
+        if totals is None:
+            points = self.cells[cell].values()
+            totals = self.totals[cell] = (len(points), math.fsum(lon for lon, lat in points),
+                                          math.fsum(lat for lon, lat in points))
+        return totals
+
+    def query_clusters(self, zoom, min_lon, min_lat, max_lon, max_lat):
+        """Return [centroid lon, centroid lat, count] for the cells of a clustered zoom level in a bounding box"""
+        if zoom is None:
+            return []
+        if min_lon > max_lon:
+            return (self.query_clusters(zoom, min_lon, min_lat, 180.0, max_lat) +
+                    self.query_clusters(zoom, -180.0, min_lat, max_lon, max_lat))
+        with self.lock:
+            return self.cluster_level(zoom).query(self.cell_totals, min_lon, min_lat, max_lon, max_lat)
+
+    def cell_distance(self, cell, lon, lat, scale):
+        """Distance from a point to the closest edge of a cell (0 inside it)"""
+        cs = self.cell_size
+        dlon = max(cell[0] * cs - lon, 0.0, lon - (cell[0] + 1) * cs) * scale
+        dlat = max(cell[1] * cs - lat, 0.0, lat - (cell[1] + 1) * cs)
+        return math.sqrt(dlon * dlon + dlat * dlat)
+
+    def nearest(self, lon, lat, n=10):
+        """Return the n closest points as (distance in km, item id) pairs, closest first"""
+        if n <= 0:
+            return []
+        scale = math.cos(math.radians(lat))
+        cs = self.cell_size
+        best = []
+
+        def distance(point_lon, point_lat):
+            dlon = (point_lon - lon) * scale
+            dlat = point_lat - lat
+            return math.sqrt(dlon * dlon + dlat * dlat)
+
+        with self.lock:
+            cx, cy = self.cell(lon, lat)
+            seen = 0
+            ring = 0
+            while seen < len(self.cells):
+                if (2 * ring + 1) ** 2 > len(self.cells):
+                    # Far from the data, visit the remaining cells closest first instead of more rings
+                    remaining = sorted((self.cell_distance(cell, lon, lat, scale), cell) for cell in self.cells
+                                       if max(abs(cell[0] - cx), abs(cell[1] - cy)) >= ring)
+                    for cell_distance, cell in remaining:
+                        if len(best) >= n:
+                            best.sort(key=lambda pair: pair[0])
+                            del best[n:]
+                            if best[-1][0] <= cell_distance:
+                                break
+                        best.extend((distance(p_lon, p_lat), item_id)
+                                    for item_id, (p_lon, p_lat) in self.cells[cell].items())
+                    break
+                
+                # Visit the cells on the edge of a square ring around the query cell
+                if ring == 0:
+                    ring_cells = [(cx, cy)]
+                else:
+                    ring_cells = [(x, y) for x in range(cx - ring, cx + ring + 1) for y in (cy - ring, cy + ring)]
+                    ring_cells += [(x, y) for x in (cx - ring, cx + ring) for y in range(cy - ring + 1, cy + ring)]
+                for cell in ring_cells:
+                    members = self.cells.get(cell)
+                    if members is None:
+                        continue
+                    seen += 1
+                    best.extend((distance(p_lon, p_lat), item_id) for item_id, (p_lon, p_lat) in members.items())
+                if len(best) > n:
+                    best.sort(key=lambda pair: pair[0])
+                    del best[n:]
+
+                # Anything outside this ring is at least this far away
+                reach = min(lon - (cx - ring) * cs, (cx + ring + 1) * cs - lon) * scale
+                reach = min(reach, lat - (cy - ring) * cs, (cy + ring + 1) * cs - lat)
+                if len(best) >= n and max(d for d, _ in best) <= reach:
+                    break
+                ring += 1
+
+        best.sort(key=lambda pair: pair[0])
+        return [(round(d * KM_PER_DEGREE, 3), item_id) for d, item_id in best[:n]]
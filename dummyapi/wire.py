@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+# Wire formats for the dummy APIs.
+#
+# A wire format is an (encoding, layout) pair:
+#
+#   encoding  'json' (the default) or 'msgpack'
+#   layout    'rows' (the default, items as objects) or 'columnar'
+#
+# REST clients pick one with the Accept header (application/msgpack) or with
+# ?format=msgpack and ?layout=columnar. Socket.IO clients pick one when they
+# connect, with the same query parameters on the connection URL; MessagePack
+# messages are sent as binary frames.
+#
+# The columnar layout replaces every list of items (an 'items', 'features' or
+# 'sensors' list) with one array per field, so keys like id, name, unit,
+# status and last_updated are sent once per collection instead of once per
+# item. Nested objects are flattened into dot-separated fields
+# (properties.speed); a field an item does not have is null in its column:
+#
+#   {"count": 2, "fields": ["id", "properties.speed"],
+#    "columns": [["vessel-001", "vessel-002"], [15.5, 8.2]]}
+#
+# MessagePack is optional. If it is not installed, clients asking for it get
+# JSON (check the Content-Type).
+
+from flask import Response
+
+import wirecache
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ENCODINGS = ('json', 'msgpack')
+LAYOUTS = ('rows', 'columnar')
+
+# The format everyone gets unless they ask for another one
+DEFAULT = ('json', 'rows')
+
+MIMETYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack',
+}
+
+# Keys whose lists of items the columnar layout turns into columns
+ITEM_LISTS = ('items', 'features', 'sensors')
+
+def available():
+    """Return True if MessagePack is installed"""
+    return msgpack is not None
+
+def parse_format(encoding, layout):
+    """Turn requested encoding and layout names into a supported wire format"""
+    encoding = (encoding or 'json').lower()
+    layout = (layout or 'rows').lower()
+    if encoding not in ENCODINGS or (encoding == 'msgpack' and not available()):
+        encoding = 'json'
+    if layout not in LAYOUTS:
+        layout = 'rows'
+    return (encoding, layout)
+
+def negotiate(request):
+    """Pick the wire format for a REST request from ?format=, ?layout= and the Accept header"""
+    encoding = request.args.get('format')
+    if encoding is None:
+        best = request.accept_mimetypes.best_match(['application/json', 'application/msgpack', 'application/x-msgpack'],
+                                                   default='application/json')
+        encoding = 'msgpack' if 'msgpack' in best else 'json'
+    return parse_format(encoding, request.args.get('layout'))
+
+def socket_format(request):
+    """Pick the wire format for a Socket.IO connection from its URL's ?format= and ?layout="""
+    return parse_format(request.args.get('format'), request.args.get('layout'))
+
+def to_columns(items):
+    """Turn a list of items into one array per field"""
+    count = len(items)
+    columns = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        # Walk the nested dicts, writing each leaf into its field's column
+        stack = [('', item)]
+        while stack:
+            prefix, value = stack.pop()
+            for key, child in value.items():
+                if type(child) is dict and child:
+                    stack.append((prefix + key + '.', child))
+                    continue
+                path = prefix + key
+                column = columns.get(path)
+                if column is None:
+                    column = columns[path] = [None] * count
+                column[index] = child
+    return {'count': count, 'fields': list(columns), 'columns': list(columns.values())}
+
+def columnar(obj):
+    """Copy a payload with its lists of items in columnar layout
+
+    Handles the payloads the servers send: a collection or any object with an
+    item list, and a snapshot (item lists inside data.<collection>).
+    """
+    if not isinstance(obj, dict):
+        return obj
+    result = dict(obj)
+    for key in ITEM_LISTS:
+        if isinstance(obj.get(key), list):
+            result[key] = to_columns(obj[key])
+    data = obj.get('data')
+    if isinstance(data, dict):
+        result['data'] = {name: columnar(collection) for name, collection in data.items()}
+    return result
+
+class RawBytes:
+    """Already encoded binary payload"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+def encoder(fmt):
+    """Get the function that encodes a payload in a wire format"""
+    encoding, layout = fmt
+    shape = columnar if layout == 'columnar' else (lambda obj: obj)
+    if encoding == 'msgpack':
+        return lambda obj: RawBytes(msgpack.packb(shape(obj), use_bin_type=True))
+    if layout == 'columnar':
+        return lambda obj: wirecache.encode(columnar(obj))
+    return wirecache.encode
+
+def response(raw, fmt, status=200):
+    """Build a Flask response from a payload encoded in a wire format"""
+    return Response(raw.data, status=status, mimetype=MIMETYPES[fmt[0]])
+
+def socket_payload(raw):
+    """Get what to pass to emit() for an encoded payload: bytes go out as a binary frame"""
+    return raw.data if isinstance(raw, RawBytes) else raw
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+# Serialize-once cache for REST responses and Socket.IO sends.
+#
+# Every view of the store (a raw collection, a GeoJSON FeatureCollection, the
+# schema, the connect snapshot, ...) is encoded to JSON at most once per store
+# version. The encoded text is then reused by every REST response and every
+# socket send until the next tick publishes a new version, which drops the
+# whole cache. Views are keyed by their query parameters too, so the cache
+# keeps at most MAX_ENTRIES of them, dropping the least recently used.
+#
+# Socket.IO normally JSON-encodes the arguments of each emit itself. Passing
+# SocketJSON as the server's json module lets an emit carry an already encoded
+# RawJSON argument, which is spliced into the packet as-is.
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response
+
+class RawJSON:
+    """Already encoded JSON text"""
+
+    __slots__ = ('text', '_data')
+
+    def __init__(self, text):
+        self.text = text
+        self._data = None
+
+    @property
+    def data(self):
+        """The text as UTF-8 bytes, encoded on first use"""
+        if self._data is None:
+            self._data = self.text.encode('utf-8')
+        return self._data
+
+def encode(obj):
+    """Encode an object to compact JSON once"""
+    return RawJSON(json.dumps(obj, separators=(',', ':')))
+
+def json_response(raw, status=200):
+    """Build a Flask response from encoded JSON"""
+    return Response(raw.data, status=status, mimetype='application/json')
+
+# Encoded views kept per store version; the least recently used go first
+MAX_ENTRIES = 1024
+
+# Streamed responses are sent in chunks of about this many bytes
+NDJSON_CHUNK_SIZE = 64 * 1024
+
+def wants_ndjson(request):
+    """Check whether a request asked for newline-delimited JSON (Accept header or ?stream=1)"""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+def ndjson_response(rows):
+    """Stream rows as newline-delimited JSON, one row per line
+
+    Rows are pulled from the iterator as the response is sent, so memory use
+    does not grow with the number of rows.
+    """
+    def generate():
+        chunk = []
+        size = 0
+        for row in rows:
+            line = json.dumps(row, separators=(',', ':')) + '\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= NDJSON_CHUNK_SIZE:
+                yield ''.join(chunk).encode('utf-8')
+                chunk = []
+                size = 0
+        if chunk:
+            yield ''.join(chunk).encode('utf-8')
+    return Response(generate(), mimetype='application/x-ndjson')
+
+class SocketJSON:
+    """json module for Socket.IO that splices RawJSON arguments into packets without re-encoding them"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        if isinstance(obj, RawJSON):
+            return obj.text
+        if isinstance(obj, list) and any(isinstance(value, RawJSON) for value in obj):
+            return '[' + ','.join(value.text if isinstance(value, RawJSON) else json.dumps(value, **kwargs)
+                                  for value in obj) + ']'
+        return json.dumps(obj, **kwargs)
+
+    @staticmethod
+    def loads(*args, **kwargs):
+        return json.loads(*args, **kwargs)
+
+class CacheEntry:
+    """One encoded view, with a lock of its own so only one request encodes it"""
+
+    __slots__ = ('lock', 'raw')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.raw = None
+
+class EncodeCache:
+    """Encoded views of the current store version"""
+
+    def __init__(self, on_encode=None, max_entries=MAX_ENTRIES):
+        self.lock = threading.Lock()
+        self.version = None
+        # Least recently used first
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        # Called as on_encode(key, seconds) for every encode, not for hits
+        self.on_encode = on_encode
+
+    def encode_view(self, key, build, encoder):
+        payload = build()
+        if self.on_encode is None:
+            return encoder(payload)
+        start = time.perf_counter()
+        raw = encoder(payload)
+        self.on_encode(key, time.perf_counter() - start)
+        return raw
+
+    def get(self, version, key, build, encoder=encode):
+        """Return the encoded view for key at this version, building and encoding it on a miss
+
+        Views encoded with another encoder (see wire.py) need their own key.
+
+        Each key has its own lock, held while encoding, so a burst of requests
+        right after a tick still encodes each view only once without holding
+        up the requests for other views.
+        """
+        with self.lock:
+            if self.version is None or version > self.version:
+                # A newer version was published, everything cached is stale
+                self.version = version
+                self.entries = OrderedDict()
+            if version < self.version:
+                # A reader still holding an older snapshot, don't cache it
+                entry = None
+            else:
+                entry = self.entries.get(key)
+                if entry is None:
+                    entry = self.entries[key] = CacheEntry()
+                    # Keys carry query parameters, so clients could otherwise grow the cache without bound
+                    if len(self.entries) > self.max_entries:
+                        self.entries.popitem(last=False)
+                else:
+                    self.entries.move_to_end(key)
+
+        if entry is None:
+            return self.encode_view(key, build, encoder)
+        with entry.lock:
+            if entry.raw is None:
+                entry.raw = self.encode_view(key, build, encoder)
+            return entry.raw